@@ -1,3 +1,41 @@
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from chat.models import ChatRoom, Message, RoomMembership
+from .models import User
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserListTests(TestCase):
+
+    def setUp(self):
+        self.viewer = User.objects.create_user('View', 'Er', 'viewer@example.com', 'password', username='viewer')
+        self.client.force_login(self.viewer)
+
+    def add_contacts(self, count, unread=0):
+        for n in range(User.objects.count(), User.objects.count() + count):
+            contact = User.objects.create_user('Contact', str(n), f'contact{n}@example.com', 'password', username=f'contact{n}')
+            user1, user2 = sorted([self.viewer, contact], key=lambda u: str(u.id))
+            room = ChatRoom.objects.create(user1=user1, user2=user2)
+            RoomMembership.objects.ensure_for_room(room)
+            for _ in range(unread):
+                message = Message.objects.create(room=room, sender=contact, content="hello")
+                RoomMembership.objects.record_message(room, message)
+
+    def test_query_count_does_not_grow_with_users(self):
+        self.add_contacts(2, unread=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('user_list'))
+
+        self.add_contacts(40, unread=2)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('user_list'))
+        self.assertEqual(len(response.context['users']), settings.USER_LIST_PAGE_SIZE)
+
+    def test_unread_counts(self):
+        self.add_contacts(3, unread=2)
+        response = self.client.get(reverse('user_list'))
+        self.assertEqual([user.unread_count for user in response.context['users']], [2, 2, 2])
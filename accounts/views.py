@@ -2,9 +2,11 @@ from allauth.account.utils import complete_signup
 from allauth.account.models import EmailAddress
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
+from django.db.models import Q
 from django.shortcuts import render, redirect
 
-from chat.models import ChatRoom, Message
+from chat.models import RoomMembership
 from .forms import UserForm
 from django.contrib import messages, auth
 
@@ -18,7 +20,6 @@ def register_user(request):
         messages.warning(request, 'Already logged in!')
         return redirect('user_list')
     elif request.method == 'POST':
-        print(request.POST)
         form = UserForm(request.POST)
         if form.is_valid():
             password = form.cleaned_data['password']
@@ -86,19 +87,23 @@ def logout(request):
 @login_required(login_url='login')
 def user_list(request):
     users = User.objects.exclude(id=request.user.id).exclude(is_superadmin=True)
-    
-    # Add unread count for each user
-    for user in users:
-        # We need to find the room between request.user and 'user'
-        user1, user2 = sorted([request.user, user], key=lambda u: str(u.id))
-        room = ChatRoom.objects.filter(user1=user1, user2=user2).first()
-        if room:
-            user.unread_count = Message.objects.filter(room=room, sender=user, is_read=False).count()
-        else:
-            user.unread_count = 0
+    paginator = Paginator(users, settings.USER_LIST_PAGE_SIZE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+
+    # The current user's unread counter in the room shared with each contact on this page. Looked
+    # up for the page only, an annotation is evaluated for every account before the sort
+    contacts = [user.id for user in page_obj]
+    counters = {}
+    for user1_id, user2_id, unread_count in RoomMembership.objects.filter(
+        Q(room__user1__in=contacts) | Q(room__user2__in=contacts),
+        user=request.user
+    ).values_list('room__user1_id', 'room__user2_id', 'unread_count'):
+        counters[user2_id if user1_id == request.user.id else user1_id] = unread_count
+    for user in page_obj:
+        user.unread_count = counters.get(user.id, 0)
 
     context = {
-        "users": users
+        "users": page_obj,
+        "page_obj": page_obj
     }
     return render(request, 'chat/user_list.html', context)
-
@@ -0,0 +1,97 @@
+"""
+Hot-table query latency and database size before and after archive_messages moves 90% of the
+message rows into archive segments: history pages, read marking, counting a room's messages
+and recounting the unread counters.
+
+    python benchmarks/archive.py --rooms 20 --messages 25000
+"""
+import argparse
+import io
+import os
+import tempfile
+from datetime import timedelta
+
+from common import create_room, create_users, measure, report, seed_messages, setup
+
+ARCHIVE_AFTER_DAYS = 90
+
+
+def database_size():
+    from django.db import connection
+
+    from chat.search import rebuild_search_index
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            cursor.execute('VACUUM')
+            rebuild_search_index(connection)
+            cursor.execute('PRAGMA page_count')
+            pages = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            return pages * cursor.fetchone()[0]
+        cursor.execute('SELECT pg_total_relation_size(%s)', ['chat_message'])
+        return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=25000, help="Messages per room")
+    parser.add_argument('--repeat', type=int, default=50)
+    options = parser.parse_args()
+
+    # The segment storage reads its location once, when the models load
+    archive_root = tempfile.TemporaryDirectory()
+    os.environ['CHAT_ARCHIVE_ROOT'] = archive_root.name
+    setup()
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from chat.history import encode_cursor, get_history_page
+    from chat.models import ArchiveSegment, Message, RoomMembership
+
+    users = create_users(options.rooms * 2)
+    rooms = [create_room(users[n], users[n + 1]) for n in range(0, len(users), 2)]
+    # Spread each room's history so 90% of it is older than the archive cutoff
+    step = timedelta(days=ARCHIVE_AFTER_DAYS * 10) / options.messages
+    for room in rooms:
+        seed_messages(room, options.messages, start=timezone.now() - step * options.messages, step=step)
+        for user in (room.user1, room.user2):
+            RoomMembership.objects.mark_read(room, user)
+    room = rooms[0]
+
+    # A page of the history 95% of the way back, in the table before and in the archive after
+    deep = Message.objects.filter(room=room).order_by('timestamp')[options.messages // 20]
+    deep_cursor = encode_cursor(deep)
+
+    queries = {
+        "history, newest page": lambda: get_history_page(room),
+        "history, page 95% back": lambda: get_history_page(room, before=deep_cursor),
+        "mark_read": lambda: RoomMembership.objects.mark_read(room, room.user2),
+        "count room messages": lambda: Message.objects.filter(room=room).count(),
+        "recount unread counters": RoomMembership.objects.find_inconsistent,
+    }
+
+    def run(label):
+        rows = Message.objects.count()
+        print(f"{label}: {rows} rows in chat_message, database {database_size() / 1024 / 1024:.1f} MB")
+        for name, query in queries.items():
+            report(f"{label} {name}", measure(query, options.repeat))
+
+    run("before")
+    archived = measure(lambda: call_command('archive_messages', days=ARCHIVE_AFTER_DAYS, stdout=io.StringIO()), 1)[0]
+    segment_bytes = sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(archive_root.name) for name in names
+    )
+    print(
+        f"archive_messages took {archived:.1f}s, {ArchiveSegment.objects.count()} segments,"
+        f" {segment_bytes / 1024 / 1024:.1f} MB of segment files"
+    )
+    run("after")
+    archive_root.cleanup()
+
+
+if __name__ == '__main__':
+    main()
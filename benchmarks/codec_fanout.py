@@ -0,0 +1,58 @@
+"""
+Cost of encoding one room event for every socket of a room: serializing the payload once per
+recipient, as the event handlers used to, against encoding it once at group_send time with
+each installed JSON codec.
+
+    python benchmarks/codec_fanout.py --recipients 2 10 50 200
+"""
+import argparse
+import timeit
+import uuid
+
+from common import setup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recipients', type=int, nargs='+', default=[2, 10, 50, 200])
+    parser.add_argument('--number', type=int, default=2000, help="Fan-outs timed per measurement")
+    options = parser.parse_args()
+
+    setup(database=False)
+    from chat.codecs import JSON_CODECS, StdlibJSONCodec
+
+    payload = {
+        'type': 'chat_message',
+        'room_id': str(uuid.uuid4()),
+        'message': "Are we still on for the design review tomorrow at ten? I moved it to the big room.",
+        'sender': 'someone@example.com',
+        'sender_id': str(uuid.uuid4()),
+        'timestamp': '14:05',
+        'sent_at': '2026-10-18T14:05:09.123456+00:00',
+        'message_id': str(uuid.uuid4()),
+        'client_id': str(uuid.uuid4()),
+        'seq': 1234,
+    }
+
+    codecs = []
+    for name, codec_class in JSON_CODECS.items():
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            print(f"{name} is not installed")
+
+    def per_fanout(func):
+        return min(timeit.repeat(func, number=options.number, repeat=5)) / options.number * 1000000
+
+    stdlib = StdlibJSONCodec()
+    for recipients in options.recipients:
+        print(f"{recipients} recipients")
+        cost = per_fanout(lambda: [stdlib.dumps(payload) for _ in range(recipients)])
+        print(f"  {'json, once per recipient':<32} {cost:8.1f}us")
+        for codec in codecs:
+            cost = per_fanout(lambda: codec.dumps(payload))
+            print(f"  {codec.name + ', once per event':<32} {cost:8.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Shared setup for the benchmark scripts. Each script runs against a scratch SQLite database
+(BENCHMARK_DB, recreated on every run) unless DB_ENGINE selects another database, which is
+then written to as configured, so point it at a throwaway one.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(database=True, fresh=True):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
+    if database and os.environ.get('DB_ENGINE', 'sqlite') == 'sqlite':
+        path = os.environ.get('BENCHMARK_DB', os.path.join(tempfile.gettempdir(), 'chat-benchmark.sqlite3'))
+        os.environ['SQLITE_PATH'] = path
+        for suffix in ('', '-wal', '-shm'):
+            if fresh and os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    # Lets the test client through ALLOWED_HOSTS and keeps emails in memory
+    setup_test_environment()
+    # Worker processes of a benchmark join the database their parent prepared
+    if database and fresh:
+        call_command('migrate', verbosity=0)
+
+
+def create_users(count, prefix='user'):
+    from accounts.models import User
+
+    users = [
+        User(email=f"{prefix}{n}@example.com", username=f"{prefix}{n}", first_name=prefix, last_name=str(n))
+        for n in range(count)
+    ]
+    return User.objects.bulk_create(users, batch_size=1000)
+
+
+def create_room(user_a, user_b):
+    from chat.models import ChatRoom, RoomMembership
+
+    user1, user2 = sorted([user_a, user_b], key=lambda u: str(u.id))
+    room = ChatRoom.objects.create(user1=user1, user2=user2)
+    RoomMembership.objects.ensure_for_room(room)
+    return room
+
+
+def seed_messages(room, count, start=None, step=timedelta(seconds=30), batch_size=5000, content="message {n}"):
+    """
+    Insert `count` messages alternating between the room's participants, `step` apart and
+    ending now unless `start` is given, then rebuild the unread counters.
+    """
+    from django.utils import timezone
+
+    from chat.models import Message, RoomMembership
+
+    start = start or timezone.now() - step * count
+    senders = (room.user1_id, room.user2_id)
+    for offset in range(0, count, batch_size):
+        Message.objects.bulk_create([
+            Message(room=room, sender_id=senders[n % 2], content=content.format(n=n), timestamp=start + step * n)
+            for n in range(offset, min(offset + batch_size, count))
+        ])
+    RoomMembership.objects.rebuild()
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(label, timings, unit='ms'):
+    scale = {'ms': 1000, 's': 1, 'us': 1000000}[unit]
+    timings = sorted(timings)
+    percentile = lambda p: timings[min(len(timings) - 1, round(p * (len(timings) - 1)))]
+    print(
+        f"{label:<40} p50 {statistics.median(timings) * scale:10.2f}{unit}"
+        f"  p95 {percentile(0.95) * scale:10.2f}{unit}  p99 {percentile(0.99) * scale:10.2f}{unit}"
+        f"  max {timings[-1] * scale:10.2f}{unit}  n={len(timings)}"
+    )
+
+
+async def open_socket(user, path='/ws/chat/', subprotocol='json'):
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+
+    from chat.routing import websocket_urlpatterns
+
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=[subprotocol])
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout=60)
+    assert connected, f"socket for {user} was refused"
+    return communicator
+
+
+async def drain(communicator, wait=0.3):
+    """
+    Return the frames the socket sends until it stays quiet for `wait` seconds.
+    """
+    import json
+
+    frames = []
+    while not await communicator.receive_nothing(wait):
+        frames.append(json.loads(await communicator.receive_from()))
+    return frames
@@ -0,0 +1,79 @@
+"""
+Frame size and encode/decode time of representative chat events in each JSON codec and in
+msgpack, the two WebSocket subprotocols.
+
+    python benchmarks/frame_size.py
+"""
+import argparse
+import timeit
+import uuid
+
+from common import setup
+
+
+def sample_payloads():
+    room_id, user_id, message_id = str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4())
+    attachment_id = str(uuid.uuid4())
+    return {
+        'chat_message': {
+            'type': 'chat_message', 'room_id': room_id, 'message': "On my way, ten minutes.",
+            'sender': 'someone@example.com', 'sender_id': user_id, 'timestamp': '14:05',
+            'sent_at': '2026-10-18T14:05:09.123456+00:00', 'message_id': message_id,
+            'client_id': str(uuid.uuid4()), 'seq': 1234,
+            'cursor': 'MTIzNHwyMDI2LTEwLTE4VDE0OjA1OjA5LjEyMzQ1NiswMDowMA==',
+        },
+        'image message': {
+            'type': 'chat_message', 'room_id': room_id, 'message': '',
+            'file_url': f'/chat/attachment/{attachment_id}/',
+            'preview': {
+                'url': f'/chat/attachment/{attachment_id}/thumbnail/320/',
+                'srcset': f'/chat/attachment/{attachment_id}/thumbnail/320/ 320w, '
+                          f'/chat/attachment/{attachment_id}/thumbnail/960/ 960w',
+                'width': 4032, 'height': 3024,
+            },
+            'sender': 'someone@example.com', 'sender_id': user_id, 'timestamp': 'Just now',
+            'message_id': message_id, 'seq': 1235,
+        },
+        'ack': {
+            'type': 'ack', 'room_id': room_id, 'client_id': str(uuid.uuid4()), 'message_id': message_id,
+            'timestamp': '14:05', 'sent_at': '2026-10-18T14:05:09.123456+00:00', 'duplicate': False,
+        },
+        'user_typing': {'type': 'user_typing', 'room_id': room_id, 'user_id': user_id, 'typing': True},
+        'messages_read': {
+            'type': 'messages_read', 'room_id': room_id, 'user_id': user_id,
+            'last_read_at': '2026-10-18T14:05:11.654321+00:00', 'seq': 1236,
+        },
+        'unread_update': {'type': 'unread_update', 'room_id': room_id, 'contact_id': user_id, 'delta': 1},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help="Encodes or decodes timed per measurement")
+    options = parser.parse_args()
+
+    setup(database=False)
+    from chat.codecs import JSON_CODECS, MsgPackCodec
+
+    codecs = []
+    for codec_class in (*JSON_CODECS.values(), MsgPackCodec):
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            print(f"{codec_class.name} is not installed")
+
+    def per_call(func):
+        return min(timeit.repeat(func, number=options.number, repeat=5)) / options.number * 1000000
+
+    print(f"{'event':<16} {'codec':<8} {'bytes':>6} {'encode':>9} {'decode':>9}")
+    for event, payload in sample_payloads().items():
+        for codec in codecs:
+            frame = codec.dumps(payload)
+            size = len(frame.encode() if isinstance(frame, str) else frame)
+            encode = per_call(lambda: codec.dumps(payload))
+            decode = per_call(lambda: codec.loads(frame))
+            print(f"{event:<16} {codec.name:<8} {size:>6} {encode:>7.2f}us {decode:>7.2f}us")
+
+
+if __name__ == '__main__':
+    main()
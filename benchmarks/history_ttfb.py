@@ -0,0 +1,63 @@
+"""
+Time to first byte of the chat page for a room with a large history: the paginated view,
+which renders the newest page, against rendering every message as the page used to.
+
+    python benchmarks/history_ttfb.py --messages 100000
+"""
+import argparse
+
+from common import create_room, create_users, measure, report, setup, seed_messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--full-repeat', type=int, default=1, help="Runs of the full-history render, which is slow")
+    options = parser.parse_args()
+
+    setup()
+    from django.shortcuts import render
+    from django.test import Client, RequestFactory
+    from django.urls import reverse
+
+    from chat.history import apply_read_state
+    from chat.models import Message
+
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+    seed_messages(room, options.messages)
+    print(f"{options.messages} messages in one room")
+
+    client = Client()
+    client.force_login(alice)
+    url = reverse('chat_room', args=[bob.id])
+
+    request = RequestFactory().get(url)
+    request.user = alice
+    sizes = {}
+
+    def full_history():
+        # The page before pagination: every message of the room, each fetching its sender
+        chat_messages = list(Message.objects.filter(room=room))
+        apply_read_state(room, chat_messages)
+        response = render(request, "chat/chat_room.html", {
+            "room": room,
+            "chat_messages": chat_messages,
+            "other_user": bob
+        })
+        sizes['full'] = len(response.content)
+
+    def paginated():
+        response = client.get(url)
+        assert response.status_code == 200
+        sizes['paginated'] = len(response.content)
+
+    paginated()
+    report("paginated page", measure(paginated, options.repeat))
+    report("full history", measure(full_history, options.full_repeat), unit='s')
+    print(f"page size: paginated {sizes['paginated']} bytes, full history {sizes['full']} bytes")
+
+
+if __name__ == '__main__':
+    main()
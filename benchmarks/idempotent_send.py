@@ -0,0 +1,78 @@
+"""
+Ack latency and exactly-once storage of chat_message sends when 20% of the acks are lost and
+the client retries, half of the retries reaching a process that never saw the first attempt.
+
+    python benchmarks/idempotent_send.py --messages 10000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from common import create_room, create_users, drain, open_socket, report, setup
+
+
+async def replay(user, room, count, retry_every):
+    from channels.db import database_sync_to_async
+    from django.db.models import Count
+
+    from chat.caches import sent_messages
+    from chat.models import Message
+
+    socket = await open_socket(user)
+    await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'room_id': str(room.id)}))
+    await drain(socket)
+
+    async def send_and_wait(n, client_id):
+        await socket.send_to(text_data=json.dumps({
+            'type': 'chat_message', 'room_id': str(room.id), 'message': f"message {n}", 'client_id': client_id
+        }))
+        while True:
+            frame = json.loads(await socket.receive_from(timeout=30))
+            if frame['type'] == 'ack':
+                return frame
+
+    first, retried = [], []
+    for n in range(count):
+        client_id = str(uuid.uuid4())
+        started = time.perf_counter()
+        await send_and_wait(n, client_id)
+        if n % retry_every == 0:
+            # The ack was lost, the client sends again
+            if n % (retry_every * 2) == 0:
+                sent_messages.clear()
+            await send_and_wait(n, client_id)
+            retried.append(time.perf_counter() - started)
+        else:
+            first.append(time.perf_counter() - started)
+    await socket.disconnect()
+
+    @database_sync_to_async
+    def stored():
+        messages = Message.objects.filter(room=room)
+        duplicates = messages.values('sender', 'client_id').annotate(rows=Count('id')).filter(rows__gt=1)
+        return messages.count(), duplicates.count()
+
+    rows, duplicates = await stored()
+    return first, retried, rows, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--retry-every', type=int, default=5, help="Every Nth send loses its ack")
+    options = parser.parse_args()
+
+    setup()
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+    first, retried, rows, duplicates = asyncio.run(replay(alice, room, options.messages, options.retry_every))
+
+    report("ack, first attempt", first)
+    report("ack, after a lost ack", retried)
+    print(f"{options.messages} sends, {len(retried)} retried: {rows} messages stored, {duplicates} duplicates")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Download throughput and server memory of the authenticated attachment view for a large file:
+a full download, a range request and a conditional request, through an ASGI server (uvicorn)
+running in this process.
+
+    python benchmarks/media_streaming.py --size 500
+"""
+import argparse
+import http.client
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+
+from common import create_room, create_users, setup
+
+READ_SIZE = 1024 * 1024
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_server():
+    import uvicorn
+
+    from chatapp.asgi import application
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=port, lifespan='off', log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, port
+
+
+def download(port, path, cookie, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('GET', path, headers={'Cookie': cookie, **(headers or {})})
+    started = time.perf_counter()
+    response = connection.getresponse()
+    received = 0
+    while block := response.read(READ_SIZE):
+        received += len(block)
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return response.status, received, elapsed, response.getheader('ETag')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=500, help="File size in MB")
+    parser.add_argument('--range', type=int, default=100, help="Range request size in MB")
+    options = parser.parse_args()
+
+    setup()
+    from django.conf import settings
+    from django.core.files import File
+    from django.test import Client, override_settings
+
+    from chat.models import Attachment, Message, RoomMembership
+
+    media_root = tempfile.TemporaryDirectory()
+    override_settings(MEDIA_ROOT=media_root.name).enable()
+
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+    size = options.size * 1024 * 1024
+    with tempfile.TemporaryFile() as source:
+        block = os.urandom(READ_SIZE)
+        for _ in range(size // READ_SIZE):
+            source.write(block)
+        source.seek(0)
+        attachment = Attachment.objects.store(File(source, name='large.bin'), 'large.bin')
+    message = Message.objects.create(room=room, sender=alice, attachment=attachment, content="")
+    RoomMembership.objects.record_message(room, message)
+
+    client = Client()
+    client.force_login(bob)
+    cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+
+    server, port = start_server()
+    baseline = peak_rss()
+
+    status, received, elapsed, etag = download(port, attachment.url, cookie)
+    assert status == 200 and received == size, (status, received)
+    print(f"{'full download':<24} {received / elapsed / 1024 / 1024:8.0f} MB/s  {elapsed:6.2f}s")
+
+    length = min(options.range, options.size) * 1024 * 1024
+    status, received, elapsed, _ = download(port, attachment.url, cookie, {'Range': f"bytes=0-{length - 1}"})
+    assert status == 206 and received == length, (status, received)
+    print(f"{'range request':<24} {received / elapsed / 1024 / 1024:8.0f} MB/s  {elapsed:6.2f}s")
+
+    status, received, elapsed, _ = download(port, attachment.url, cookie, {'If-None-Match': etag})
+    assert status == 304, status
+    print(f"{'conditional request':<24} {elapsed * 1000:8.2f}ms")
+
+    growth = peak_rss() - baseline
+    print(f"peak RSS grew by {growth / 1024 / 1024:.1f} MB serving a {options.size} MB file")
+    server.should_exit = True
+    media_root.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Insert throughput, bytes per stored message and history page time of the lean message table
+against the BaseModel-derived one it replaced (the schema as of chat migration 0014, with its
+audit foreign keys, datetimes and their indexes).
+
+    python benchmarks/message_schema.py --messages 20000
+"""
+import argparse
+
+from common import create_room, create_users, measure, report, setup
+
+LEGACY_MIGRATION = ('chat', '0014_archive_segment')
+
+
+def database_size():
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            cursor.execute('PRAGMA page_count')
+            pages = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            return pages * cursor.fetchone()[0]
+        cursor.execute('SELECT pg_total_relation_size(%s)', ['chat_message'])
+        return cursor.fetchone()[0]
+
+
+def run(label, room, count, batch_size, repeat, models, history_page):
+    """
+    `models` is (Message, RoomMembership) of the schema under test, `history_page` fetches the
+    newest page the way that schema's code did.
+    """
+    from django.db import transaction
+    from django.db.models import F
+
+    Message, RoomMembership = models
+    senders = (room.user1_id, room.user2_id)
+
+    def create_one(n):
+        # What save_message does: the row and the recipient's unread counter, in one transaction
+        with transaction.atomic():
+            Message.objects.create(room_id=room.id, sender_id=senders[n % 2], content=f"message {n}")
+            RoomMembership.objects.filter(room_id=room.id, user_id=senders[(n + 1) % 2]).update(
+                unread_count=F('unread_count') + 1
+            )
+
+    size = database_size()
+    created = measure(lambda: [create_one(n) for n in range(count)], 1)[0]
+    grown = database_size() - size
+
+    bulk = measure(lambda: [
+        Message.objects.bulk_create([
+            Message(room_id=room.id, sender_id=senders[n % 2], content=f"message {n}")
+            for n in range(offset, offset + batch_size)
+        ])
+        for offset in range(0, count, batch_size)
+    ], 1)[0]
+
+    print(
+        f"{label:<10} create + counter {count / created:8.0f}/s  bulk_create {count / bulk:8.0f}/s"
+        f"  {grown / count:6.0f} bytes/message"
+    )
+    report(f"{label} history page", measure(history_page, repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    options = parser.parse_args()
+
+    setup()
+    from django.core.management import call_command
+    from django.db import connection
+    from django.db.migrations.loader import MigrationLoader
+
+    from chat.history import get_history_page, get_page_size
+    from chat.models import Message, RoomMembership
+    from chat.search import rebuild_search_index
+
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+
+    call_command('migrate', *LEGACY_MIGRATION, verbosity=0)
+    legacy = MigrationLoader(connection).project_state(LEGACY_MIGRATION).apps
+    LegacyMessage = legacy.get_model('chat', 'Message')
+
+    def legacy_history_page():
+        # Whole rows and whole related rows, as chat_room loaded them before the projections
+        list(LegacyMessage.objects.filter(room_id=room.id).select_related('sender', 'attachment')
+             .order_by('-timestamp', '-id')[:get_page_size(None)])
+
+    run(
+        "before", room, options.messages, options.batch_size, options.repeat,
+        (LegacyMessage, legacy.get_model('chat', 'RoomMembership')), legacy_history_page
+    )
+
+    LegacyMessage.objects.all().delete()
+    call_command('migrate', verbosity=0)
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+        rebuild_search_index(connection)
+    run(
+        "after", room, options.messages, options.batch_size, options.repeat,
+        (Message, RoomMembership), lambda: get_history_page(room)
+    )
+
+
+if __name__ == '__main__':
+    main()
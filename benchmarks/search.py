@@ -0,0 +1,88 @@
+"""
+Message search latency over a large synthetic history: the database's full-text index (FTS5
+on SQLite, tsvector on PostgreSQL) against the icontains scan used where there is none.
+
+    python benchmarks/search.py --messages 1000000
+"""
+import argparse
+import random
+from datetime import timedelta
+
+from common import create_users, measure, report, setup
+
+COMMON_WORDS = (
+    "the and you that was for are with his they this have from one had word but not what all were "
+    "when your can said there use each which she how their will other about out many then them these "
+    "meeting lunch tomorrow today deploy review ticket build release coffee weekend call later thanks"
+).split()
+
+
+def make_vocabulary(rng, size):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--contacts', type=int, default=40, help="Rooms the searching user takes part in")
+    parser.add_argument('--repeat', type=int, default=10)
+    options = parser.parse_args()
+
+    setup()
+    from django.db.models import Q
+    from django.utils import timezone
+
+    from chat.models import ChatRoom, Message
+    from chat.search import search_messages, search_scan
+
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(rng, 20000)
+    users = create_users(options.users)
+    searcher = users[0]
+
+    # The searcher talks to `contacts` users, everyone else talks in pairs among themselves
+    pairs = [(searcher, other) for other in users[1:options.contacts + 1]]
+    pairs += [(users[n], users[n + 1]) for n in range(options.contacts + 1, len(users) - 1, 2)]
+    rooms = ChatRoom.objects.bulk_create([
+        ChatRoom(user1=min(a, b, key=lambda u: str(u.id)), user2=max(a, b, key=lambda u: str(u.id)))
+        for a, b in pairs
+    ])
+
+    start = timezone.now() - timedelta(days=365)
+    batch = []
+    for n in range(options.messages):
+        room = rng.choice(rooms)
+        words = [rng.choice(COMMON_WORDS) if rng.random() < 0.7 else rng.choice(vocabulary)
+                 for _ in range(rng.randint(3, 25))]
+        batch.append(Message(
+            room=room, sender_id=rng.choice((room.user1_id, room.user2_id)),
+            content=' '.join(words), timestamp=start + timedelta(seconds=n * 30)
+        ))
+        if len(batch) == 10000:
+            Message.objects.bulk_create(batch)
+            batch = []
+    Message.objects.bulk_create(batch)
+    visible = Message.objects.filter(room__in=rooms[:options.contacts]).count()
+    print(f"{options.messages} messages, {visible} visible to the searching user")
+
+    rare = vocabulary[rng.randrange(len(vocabulary))]
+    queries = {
+        'rare term': rare,
+        'common term': 'meeting',
+        'two terms': 'deploy tomorrow',
+        'prefix': rare[:3],
+    }
+    rooms_of_searcher = ChatRoom.objects.filter(Q(user1=searcher) | Q(user2=searcher)).values('id')
+    for label, query in queries.items():
+        terms = query.split()
+        report(f"{label} ({query}), index", measure(lambda: search_messages(searcher, query), options.repeat))
+        report(
+            f"{label} ({query}), scan",
+            measure(lambda: search_scan(terms, rooms_of_searcher, 0, 21), max(1, options.repeat // 2))
+        )
+
+
+if __name__ == '__main__':
+    main()
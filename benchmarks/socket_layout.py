@@ -0,0 +1,79 @@
+"""
+Connections and server memory for simulated users with several live conversations: one socket
+per open room plus the presence socket, as the pages used to open, against one multiplexed
+socket per user subscribed to every room. One user in ten has the contact list open, which
+subscribes to presence.
+
+    python benchmarks/socket_layout.py --users 200 --rooms 5
+"""
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+
+from common import create_room, create_users, open_socket, setup
+
+
+def prepare(user_count, room_count):
+    users = create_users(user_count)
+    rooms = {user.id: [] for user in users}
+    # Each user has conversations open with the next `room_count` users
+    for n, user in enumerate(users):
+        for offset in range(1, room_count + 1):
+            room = create_room(user, users[(n + offset) % user_count])
+            rooms[user.id].append(str(room.id))
+    return users, rooms
+
+
+async def connect(layout, users, rooms):
+    sockets = []
+    for n, user in enumerate(users):
+        if layout == 'per room':
+            sockets.append(await open_socket(user, '/ws/presence/'))
+            for room_id in rooms[user.id]:
+                sockets.append(await open_socket(user, f'/ws/chat/{room_id}/'))
+        else:
+            socket = await open_socket(user)
+            for room_id in rooms[user.id]:
+                await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'room_id': room_id}))
+            if n % 10 == 0:
+                await socket.send_to(text_data=json.dumps({'type': 'subscribe_presence'}))
+            sockets.append(socket)
+    return sockets
+
+
+async def compare(users, rooms):
+    for layout in ('per room', 'multiplexed'):
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        sockets = await connect(layout, users, rooms)
+        # Let the last subscriptions settle before measuring
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(
+            f"{layout:<12} {len(sockets):>6} sockets  {used / 1024 / 1024:7.1f} MB"
+            f"  {used / len(users) / 1024:6.1f} KB/user  connected in {elapsed:5.1f}s"
+        )
+        for socket in sockets:
+            await socket.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=5, help="Conversations each user opens")
+    options = parser.parse_args()
+
+    setup()
+    users, rooms = prepare(options.users, options.rooms)
+    asyncio.run(compare(users, rooms))
+
+
+if __name__ == '__main__':
+    main()
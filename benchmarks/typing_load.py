@@ -0,0 +1,101 @@
+"""
+Channel layer messages per second caused by typing indicators: 500 simulated typists each
+sending a typing frame per keystroke, with every frame broadcast to the room as before
+coalescing against the coalesced transitions the server sends now.
+
+    python benchmarks/typing_load.py --typists 500 --seconds 10
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from common import create_room, create_users, drain, open_socket, setup
+
+
+async def type_for(socket, room_id, seconds, keystroke_interval, rng):
+    """
+    Keystrokes in bursts of 20 to 60, a sent message after each burst and a pause before the next.
+    """
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for _ in range(rng.randint(20, 60)):
+            await socket.send_to(text_data=json.dumps({'type': 'typing', 'room_id': room_id, 'typing': True}))
+            await asyncio.sleep(keystroke_interval * rng.uniform(0.5, 1.5))
+            if time.monotonic() >= deadline:
+                return
+        await socket.send_to(text_data=json.dumps({'type': 'chat_message', 'room_id': room_id, 'message': "done"}))
+        await asyncio.sleep(rng.uniform(1, 3))
+
+
+async def run(label, pairs, seconds, keystroke_interval):
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    group_send = layer.group_send
+    counts = {'user_typing': 0, 'other': 0}
+
+    async def counting_group_send(group, message):
+        counts['user_typing' if message['type'] == 'user_typing' else 'other'] += 1
+        await group_send(group, message)
+
+    sockets = []
+    for typist, reader, room in pairs:
+        for user in (typist, reader):
+            socket = await open_socket(user)
+            await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'room_id': str(room.id)}))
+            sockets.append(socket)
+    for socket in sockets:
+        await drain(socket, wait=0.05)
+
+    layer.group_send = counting_group_send
+    rng = random.Random(1)
+    await asyncio.gather(*[
+        type_for(sockets[2 * n], str(room.id), seconds, keystroke_interval, random.Random(rng.random()))
+        for n, (_, _, room) in enumerate(pairs)
+    ])
+    layer.group_send = group_send
+
+    print(
+        f"{label:<24} {counts['user_typing'] / seconds:8.0f} user_typing group sends/s"
+        f"  {counts['other'] / seconds:6.0f} other/s"
+    )
+    for socket in sockets:
+        await socket.disconnect()
+
+
+async def compare(pairs, seconds, keystroke_interval):
+    from chat.consumers import RoomChannel
+
+    set_typing = RoomChannel.set_typing
+
+    async def broadcast_every_frame(self, is_typing, reset_interval=False):
+        # Before coalescing: each typing frame went to the whole room
+        await self.broadcast({'type': 'user_typing', 'user_id': str(self.user.id), 'typing': is_typing})
+
+    RoomChannel.set_typing = broadcast_every_frame
+    await run("every frame", pairs, seconds, keystroke_interval)
+    RoomChannel.set_typing = set_typing
+    await run("coalesced", pairs, seconds, keystroke_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--typists', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--keystroke-interval', type=float, default=0.15, help="Seconds between keystrokes")
+    options = parser.parse_args()
+
+    setup()
+    # Each typist talks to a reader of their own, who receives the indicators
+    users = create_users(options.typists * 2)
+    pairs = []
+    for n in range(options.typists):
+        typist, reader = users[2 * n], users[2 * n + 1]
+        pairs.append((typist, reader, create_room(typist, reader)))
+    asyncio.run(compare(pairs, options.seconds, options.keystroke_interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Response time of the user directory with 1k and 10k accounts: the paginated view reading the
+unread counters of the page's contacts, against the old page that looked up the room and counted
+unread messages per user and rendered every account.
+
+    python benchmarks/user_list.py --users 1000 10000
+"""
+import argparse
+
+from common import create_room, create_users, measure, report, seed_messages, setup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--rooms', type=int, default=200, help="Users the viewer has a room with")
+    parser.add_argument('--messages', type=int, default=20, help="Messages per room")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--old-repeat', type=int, default=3, help="Runs of the old page, which is slow")
+    options = parser.parse_args()
+
+    setup()
+    from django.shortcuts import render
+    from django.test import Client, RequestFactory
+    from django.urls import reverse
+
+    from accounts.models import User
+    from chat.models import ChatRoom, Message, RoomMembership
+
+    viewer = create_users(1, prefix='viewer')[0]
+    contacts = create_users(options.rooms, prefix='contact')
+    for contact in contacts:
+        room = create_room(viewer, contact)
+        seed_messages(room, options.messages)
+    # Half of each room is unread for the viewer
+    RoomMembership.objects.filter(user=viewer).update(unread_count=options.messages // 2)
+
+    client = Client()
+    client.force_login(viewer)
+    url = reverse('user_list')
+    request = RequestFactory().get(url)
+    request.user = viewer
+
+    def paginated():
+        response = client.get(url)
+        assert response.status_code == 200
+
+    def old_page():
+        # Before pagination: a room lookup and an unread COUNT per account, all accounts rendered
+        users = list(User.objects.exclude(id=viewer.id).exclude(is_superadmin=True))
+        for user in users:
+            user1, user2 = sorted([viewer, user], key=lambda u: str(u.id))
+            room = ChatRoom.objects.filter(user1=user1, user2=user2).first()
+            if room:
+                last_read_at = RoomMembership.objects.get(room=room, user=viewer).last_read_at
+                unread = Message.objects.filter(room=room, sender=user)
+                if last_read_at:
+                    unread = unread.filter(timestamp__gt=last_read_at)
+                user.unread_count = unread.count()
+            else:
+                user.unread_count = 0
+        render(request, 'chat/user_list.html', {'users': users})
+
+    created = 0
+    for total in sorted(options.users):
+        create_users(total - options.rooms - created, prefix=f'user{total}-')
+        created = total - options.rooms
+        print(f"{User.objects.count()} accounts, the viewer has {options.rooms} rooms")
+        report(f"{total} users, paginated page", measure(paginated, options.repeat))
+        report(f"{total} users, old page", measure(old_page, options.old_repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Sustained chat_message throughput of one socket, storing each message before it is broadcast
+against the write-behind pipeline (CHAT_WRITE_BEHIND). A run ends once every message is acked
+and stored.
+
+    python benchmarks/write_behind.py --messages 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from common import create_room, create_users, drain, open_socket, setup
+
+
+async def send_messages(user, room, count, window):
+    from channels.db import database_sync_to_async
+
+    from chat.models import Message
+    from chat.pipeline import get_message_writer
+
+    socket = await open_socket(user)
+    await socket.send_to(text_data=json.dumps({'type': 'subscribe', 'room_id': str(room.id)}))
+    await drain(socket)
+    stored_before = await database_sync_to_async(Message.objects.filter(room=room).count)()
+
+    started = time.perf_counter()
+    sent = acked = 0
+    while acked < count:
+        # Keep up to `window` messages waiting for their ack, like a client pipelining sends
+        while sent < count and sent - acked < window:
+            await socket.send_to(text_data=json.dumps({
+                'type': 'chat_message',
+                'room_id': str(room.id),
+                'message': f"message {sent}",
+                'client_id': str(uuid.uuid4())
+            }))
+            sent += 1
+        frame = json.loads(await socket.receive_from(timeout=30))
+        if frame['type'] == 'ack':
+            acked += 1
+    acked_at = time.perf_counter()
+    await get_message_writer().flush()
+    stored_at = time.perf_counter()
+
+    stored = await database_sync_to_async(Message.objects.filter(room=room).count)() - stored_before
+    await socket.disconnect()
+    assert stored == count, f"{stored} of {count} messages stored"
+    return acked_at - started, stored_at - started
+
+
+async def compare(user, room, count, window):
+    from django.test import override_settings
+
+    # One event loop for both runs, the message writer stays bound to the loop it started on
+    for label, write_behind in (("store then broadcast", False), ("write-behind", True)):
+        with override_settings(CHAT_WRITE_BEHIND=write_behind):
+            acked, stored = await send_messages(user, room, count, window)
+        print(f"{label:<24} {count / acked:8.0f} msg/s acked  {count / stored:8.0f} msg/s stored")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--window', type=int, default=50, help="Messages in flight before waiting for acks")
+    options = parser.parse_args()
+
+    setup()
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+    asyncio.run(compare(alice, room, options.messages, options.window))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Write contention under each database profile: several processes with several threads each
+store messages (with their unread counter update) and read history pages, closing their
+connection after every operation the way a request does.
+
+    python benchmarks/write_contention.py
+    DB_ENGINE=postgresql DB_NAME=chat_benchmark python benchmarks/write_contention.py --postgresql
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from common import create_room, create_users, setup
+
+# Profile name -> environment of its processes. "sqlite-legacy" is SQLite as configured before
+# the profiles existed: rollback journal and deferred transactions.
+SQLITE_PROFILES = {
+    'sqlite-legacy': {'DB_ENGINE': 'sqlite', 'SQLITE_WAL': 'False'},
+    'sqlite': {'DB_ENGINE': 'sqlite', 'SQLITE_WAL': 'True'},
+}
+POSTGRESQL_PROFILES = {
+    'postgresql': {'DB_ENGINE': 'postgresql', 'DB_CONN_MAX_AGE': '0', 'DB_POOL': 'False'},
+    'postgresql-persistent': {'DB_ENGINE': 'postgresql', 'DB_CONN_MAX_AGE': '60', 'DB_POOL': 'False'},
+    'postgresql-pool': {'DB_ENGINE': 'postgresql', 'DB_POOL': 'True'},
+}
+
+
+def prepare():
+    setup()
+    alice, bob = create_users(2)
+    room = create_room(alice, bob)
+    print(room.id)
+
+
+def work(profile, room_id, threads, operations, write_ratio):
+    setup(fresh=False)
+    from django.conf import settings
+    from django.db import OperationalError, close_old_connections, transaction
+
+    from chat.history import get_history_page
+    from chat.models import ChatRoom, Message, RoomMembership
+
+    if profile == 'sqlite-legacy':
+        settings.DATABASES['default']['OPTIONS'].pop('transaction_mode', None)
+
+    room = ChatRoom.objects.get(id=room_id)
+    close_old_connections()
+    results = {'writes': 0, 'reads': 0, 'errors': 0, 'latencies': []}
+    lock = threading.Lock()
+
+    def run(seed):
+        rng = random.Random(seed)
+        for n in range(operations):
+            started = time.perf_counter()
+            write = rng.random() < write_ratio
+            try:
+                if write:
+                    with transaction.atomic():
+                        message = Message.objects.create(
+                            room=room, sender_id=rng.choice((room.user1_id, room.user2_id)), content=f"message {n}"
+                        )
+                        RoomMembership.objects.record_message(room, message)
+                else:
+                    get_history_page(room)
+                outcome = 'writes' if write else 'reads'
+            except OperationalError:
+                outcome = 'errors'
+            finally:
+                # End of "request", persistent profiles keep the connection
+                close_old_connections()
+            with lock:
+                results[outcome] += 1
+                results['latencies'].append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=run, args=(f"{os.getpid()}-{n}",)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(json.dumps(results))
+
+
+def run_profile(profile, environment, options):
+    env = {**os.environ, **environment}
+    script = os.path.abspath(__file__)
+    room_id = subprocess.run(
+        [sys.executable, script, '--prepare'], env=env, check=True, capture_output=True, text=True
+    ).stdout.split()[-1]
+
+    started = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, script, '--worker', profile, room_id,
+             '--threads', str(options.threads), '--operations', str(options.operations)],
+            env=env, stdout=subprocess.PIPE, text=True
+        )
+        for _ in range(options.processes)
+    ]
+    totals = {'writes': 0, 'reads': 0, 'errors': 0, 'latencies': []}
+    for process in processes:
+        output, _ = process.communicate()
+        results = json.loads(output.splitlines()[-1])
+        for key, value in results.items():
+            totals[key] += value
+    elapsed = time.perf_counter() - started
+
+    # Failed operations do not count towards throughput
+    operations = totals['writes'] + totals['reads']
+    print(
+        f"{profile:<24} writes {totals['writes']:>6}  reads {totals['reads']:>6}  errors {totals['errors']:>6}"
+        f"  {operations / elapsed:7.0f} ops/s  p50 {statistics.median(totals['latencies']) * 1000:7.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--operations', type=int, default=100, help="Operations per thread")
+    parser.add_argument('--postgresql', action='store_true', help="Run the PostgreSQL profiles instead of SQLite")
+    parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', nargs=2, metavar=('PROFILE', 'ROOM_ID'), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.prepare:
+        prepare()
+    elif options.worker:
+        work(*options.worker, options.threads, options.operations, write_ratio=0.75)
+    else:
+        profiles = POSTGRESQL_PROFILES if options.postgresql else SQLITE_PROFILES
+        for profile, environment in profiles.items():
+            run_profile(profile, environment, options)
+
+
+if __name__ == '__main__':
+    main()
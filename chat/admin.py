@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 # Register your models here.
-from chat.models import ChatRoom, Message
+from chat.models import ArchiveSegment, Attachment, ChatRoom, Message, RoomMembership
 
 
 class ChatRoomAdmin(admin.ModelAdmin):
@@ -9,8 +9,24 @@ class ChatRoomAdmin(admin.ModelAdmin):
 
 
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('room', 'sender', 'timestamp', 'is_read')
+    list_display = ('room', 'sender', 'timestamp')
+    list_select_related = ('room__user1', 'room__user2', 'sender')
+
+
+class RoomMembershipAdmin(admin.ModelAdmin):
+    list_display = ('room', 'user', 'unread_count', 'last_read_at')
+
+
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'sha256', 'size', 'ref_count')
+
+
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ('room', 'start_timestamp', 'end_timestamp', 'message_count', 'size')
 
 
 admin.site.register(Message, MessageAdmin)
 admin.site.register(ChatRoom, ChatRoomAdmin)
+admin.site.register(RoomMembership, RoomMembershipAdmin)
+admin.site.register(Attachment, AttachmentAdmin)
+admin.site.register(ArchiveSegment, ArchiveSegmentAdmin)
@@ -0,0 +1,154 @@
+import gzip
+import json
+import uuid
+from collections import Counter
+
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models import F, Prefetch, prefetch_related_objects
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from accounts.models import User
+
+from .caches import archive_segments
+from .models import ArchiveSegment, Attachment, Message, RoomMembership
+
+ARCHIVE_FIELDS = ('id', 'sender_id', 'content', 'attachment_id', 'timestamp')
+
+
+def encode_segment(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({
+            'id': str(row['id']),
+            'sender_id': str(row['sender_id']),
+            'content': row['content'],
+            'attachment_id': str(row['attachment_id']) if row['attachment_id'] else None,
+            'timestamp': row['timestamp'].isoformat(),
+        }, separators=(',', ':')))
+    return gzip.compress('\n'.join(lines).encode())
+
+
+def decode_segment(data):
+    rows = []
+    for line in gzip.decompress(data).decode().splitlines():
+        row = json.loads(line)
+        row['id'] = uuid.UUID(row['id'])
+        row['sender_id'] = uuid.UUID(row['sender_id'])
+        row['attachment_id'] = uuid.UUID(row['attachment_id']) if row['attachment_id'] else None
+        row['timestamp'] = parse_datetime(row['timestamp'])
+        rows.append(row)
+    return rows
+
+
+def archive_cutoff(room, older_than):
+    """
+    Messages before the returned moment may be archived: they are older than `older_than` and
+    both participants have read them, so the unread counters never need them again.
+    """
+    watermarks = RoomMembership.objects.read_watermarks(room)
+    last_read = [watermarks.get(room.user1_id), watermarks.get(room.user2_id)]
+    if None in last_read:
+        return None
+    return min(older_than, *last_read)
+
+
+def archive_segment(room, cutoff, segment_size):
+    """
+    Move up to `segment_size` of the room's oldest messages before `cutoff` into a new
+    segment file. Returns the segment, or None when nothing is left to archive.
+    """
+    segment = None
+    try:
+        with transaction.atomic():
+            queryset = Message.objects.filter(room=room, timestamp__lt=cutoff).order_by('timestamp', 'id')
+            if connection.features.has_select_for_update:
+                queryset = queryset.select_for_update()
+            rows = list(queryset.values(*ARCHIVE_FIELDS)[:segment_size])
+            if not rows:
+                return None
+
+            attachments = Counter(str(row['attachment_id']) for row in rows if row['attachment_id'])
+            data = encode_segment(rows)
+            segment = ArchiveSegment(
+                room=room,
+                start_timestamp=rows[0]['timestamp'],
+                end_timestamp=rows[-1]['timestamp'],
+                message_count=len(rows),
+                size=len(data),
+                attachments=dict(attachments)
+            )
+            segment.file.save(f"{segment.id}.jsonl.gz", ContentFile(data), save=False)
+            segment.save(force_insert=True)
+
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            # Deleting released the attachments, the archived copies still refer to them
+            for attachment_id, count in attachments.items():
+                Attachment.objects.filter(id=attachment_id).update(
+                    ref_count=F('ref_count') + count, updated_at=timezone.now()
+                )
+    except Exception:
+        if segment is not None and segment.file:
+            segment.file.delete(save=False)
+        raise
+    return segment
+
+
+def archive_room(room, older_than, segment_size, max_segments=None):
+    cutoff = archive_cutoff(room, older_than)
+    segments = []
+    while cutoff is not None and (max_segments is None or len(segments) < max_segments):
+        segment = archive_segment(room, cutoff, segment_size)
+        if segment is None:
+            break
+        segments.append(segment)
+    return segments
+
+
+def read_segment(segment):
+    rows = archive_segments.get(segment.id)
+    if rows is None:
+        with segment.file.open('rb') as archive:
+            rows = decode_segment(archive.read())
+        archive_segments.set(segment.id, rows)
+    return rows
+
+
+def get_archived_messages(room, before=None, limit=50):
+    """
+    Return up to `limit` archived messages of the room older than the `before`
+    (timestamp, id) pair, ordered oldest first. They are unsaved Message instances with
+    their sender and attachment loaded.
+    """
+    segments = ArchiveSegment.objects.filter(room=room).order_by('-end_timestamp')
+    if before:
+        segments = segments.filter(start_timestamp__lte=before[0])
+
+    found = []
+    for segment in segments:
+        rows = read_segment(segment)
+        if before:
+            rows = [row for row in rows if (row['timestamp'], row['id']) < before]
+        if rows:
+            found = rows[-(limit - len(found)):] + found
+        if len(found) >= limit:
+            break
+
+    messages = [
+        Message(
+            id=row['id'],
+            room=room,
+            sender_id=row['sender_id'],
+            content=row['content'],
+            attachment_id=row['attachment_id'],
+            timestamp=row['timestamp']
+        )
+        for row in found
+    ]
+    prefetch_related_objects(
+        messages,
+        Prefetch('sender', User.objects.only('email')),
+        Prefetch('attachment', Attachment.objects.only('name', 'width', 'height', 'thumbnails'))
+    )
+    return messages
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TTLCache:
+    """
+    Process-local LRU cache whose entries also expire after `ttl` seconds. It is shared by
+    the event loop and the database threads, so every operation takes a lock.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# room id -> (user1_id, user2_id), invalidated when the room is deleted
+room_participants = TTLCache(settings.CHAT_ROOM_CACHE_SIZE, settings.CHAT_ROOM_CACHE_TTL)
+
+# (sender id, client id) -> (message id, timestamp) of messages already stored and broadcast
+sent_messages = TTLCache(settings.CHAT_SENT_CACHE_SIZE, settings.CHAT_SENT_CACHE_TTL)
+
+# archive segment id -> decoded messages, so paging back through one segment reads it once
+archive_segments = TTLCache(settings.CHAT_ARCHIVE_CACHE_SIZE, settings.CHAT_ARCHIVE_CACHE_TTL)
+
+# room id -> RoomEventBuffer of the room's recent events, replayed to reconnecting clients
+room_events = TTLCache(settings.CHAT_SYNC_BUFFER_ROOMS, settings.CHAT_SYNC_BUFFER_TTL)
@@ -0,0 +1,124 @@
+import json
+
+from django.conf import settings
+
+from .outbound import supersede_key
+
+
+class StdlibJSONCodec:
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(self, text):
+        return json.loads(text)
+
+
+class UJSONCodec:
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+
+        self.ujson = ujson
+
+    def dumps(self, data):
+        return self.ujson.dumps(data, ensure_ascii=False)
+
+    def loads(self, text):
+        return self.ujson.loads(text)
+
+
+class ORJSONCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+
+        self.orjson = orjson
+
+    def dumps(self, data):
+        # WebSocket text frames need str, orjson produces UTF-8 bytes
+        return self.orjson.dumps(data).decode()
+
+    def loads(self, text):
+        return self.orjson.loads(text)
+
+
+class MsgPackCodec:
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        return self.msgpack.packb(data)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data)
+
+
+JSON_CODECS = {
+    'json': StdlibJSONCodec,
+    'ujson': UJSONCodec,
+    'orjson': ORJSONCodec,
+}
+
+_json_codec = None
+
+
+def get_json_codec():
+    """
+    Return the codec named by CHAT_JSON_CODEC. "auto" picks the fastest installed one.
+    """
+    global _json_codec
+    if _json_codec is None:
+        if settings.CHAT_JSON_CODEC == 'auto':
+            for name in ('orjson', 'ujson', 'json'):
+                try:
+                    _json_codec = JSON_CODECS[name]()
+                    break
+                except ImportError:
+                    continue
+        else:
+            _json_codec = JSON_CODECS[settings.CHAT_JSON_CODEC]()
+    return _json_codec
+
+
+_msgpack_codec = None
+
+
+def get_msgpack_codec():
+    global _msgpack_codec
+    if _msgpack_codec is None:
+        _msgpack_codec = MsgPackCodec()
+    return _msgpack_codec
+
+
+def encode_event(payload):
+    """
+    Build a channel layer event carrying `payload` pre-encoded for both wire formats.
+    """
+    event = {
+        'type': payload['type'],
+        'text': get_json_codec().dumps(payload),
+        'bytes': get_msgpack_codec().dumps(payload)
+    }
+    key = supersede_key(payload)
+    if key:
+        # Lets the outbound queue of a slow socket drop this event once a newer one replaces it
+        event['supersedes'] = key
+    return event
+
+
+def encode_room_event(room_id, payload):
+    """
+    encode_event for an event of one room. The room id is added to the payload, so clients
+    sharing one socket between rooms can route it, and to the event for the receiving consumer.
+    """
+    event = encode_event({**payload, 'room_id': str(room_id)})
+    event['room_id'] = str(room_id)
+    return event
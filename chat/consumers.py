@@ -1,223 +1,665 @@
-import json
+import asyncio
+import logging
+import time
+import uuid
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import ChatRoom, Message
+from django.db import IntegrityError, transaction
+from .caches import room_participants, sent_messages
+from .codecs import encode_event, encode_room_event, get_json_codec, get_msgpack_codec
+from .executors import DatabaseUnavailable, run_in_executor
+from .metrics import (
+    group_members, layer_send_seconds, ws_connections, ws_frames_received, ws_frames_sent, ws_receive_seconds
+)
+from .models import Attachment, ChatRoom, Message, MessageTombstone, RoomMembership
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue
+from .pipeline import get_message_writer
+from .presence import PRESENCE_GROUP, get_presence_registry
+from .sync import (
+    buffered_events, decode_sync_cursor, encode_sync_cursor, get_sequencer, missed_events, record_event, sequence_event
+)
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Frame types clients send, anything else is counted as "other" to keep metric labels bounded
+FRAME_TYPES = {
+    'subscribe', 'unsubscribe', 'subscribe_presence', 'unsubscribe_presence', 'chat_message', 'mark_read', 'typing',
+    'delete_message'
+}
 
-    async def connect(self):
-        # We accept first to give the client a stable connection while we validate
-        await self.accept()
-        
-        user = self.scope["user"]
-        print(f"WS Connect attempt by: {user} (Anonymous: {user.is_anonymous})")
 
-        if user.is_anonymous:
-            print("WS Rejecting: User is anonymous")
-            await self.close()
-            return
+def parse_uuid(value):
+    try:
+        return uuid.UUID(str(value)) if value else None
+    except ValueError:
+        return None
 
-        # Update online status
-        await self.update_user_status(user, True)
 
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f"chat_{self.room_id}"
+def user_group_name(user_id):
+    # Personal group of a user, every socket of theirs on ws/chat/ hears its unread updates
+    return f"user_{user_id}"
 
-        # Use a single sync_to_async call to handle DB logic
-        membership_valid = await self.check_room_membership(user)
-        
-        if not membership_valid:
-            # We already updated status to True, but if membership fails we disconnect
-            # and status update in disconnect will handle it.
-            await self.close()
-            return
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+async def join_group(consumer, group):
+    await consumer.channel_layer.group_add(group, consumer.channel_name)
+    group_members.joined(group)
 
-        # Mark messages as read immediately when connecting
-        await self.mark_messages_as_read(user)
 
-        # Notify the room that messages have been read
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'messages_read',
-                'user_id': str(user.id)
-            }
-        )
-        print(f"WS Connected successfully to {self.room_group_name}")
+async def leave_group(consumer, group):
+    await consumer.channel_layer.group_discard(group, consumer.channel_name)
+    group_members.left(group)
 
-    async def disconnect(self, close_code):
-        user = self.scope["user"]
-        if not user.is_anonymous:
-            await self.update_user_status(user, False)
 
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
-        print(f"WS Disconnected code: {close_code}")
+async def group_send(consumer, group, event):
+    with layer_send_seconds.time(event['type']):
+        await consumer.channel_layer.group_send(group, event)
 
-    async def receive(self, text_data):
-        try:
-            data = json.loads(text_data)
-            message_type = data.get('type', 'chat_message')
-            user = self.scope['user']
 
+@run_in_executor('critical')
+def get_member_room(user, room_id):
+    """
+    Return the room with `room_id` when `user` takes part in it, None otherwise.
+    """
+    try:
+        room_key = str(uuid.UUID(str(room_id)))
+        participants = room_participants.get(room_key)
+        if participants is None:
+            participants = ChatRoom.objects.filter(id=room_key).values_list('user1_id', 'user2_id').first()
+            if participants is None:
+                logger.info("ws room not found room=%s user=%s", room_id, user.id)
+                return None
+            room_participants.set(room_key, participants)
+
+        if user.id not in participants:
+            logger.warning("ws room membership denied room=%s user=%s", room_id, user.id)
+            return None
+
+        # Held for as long as the socket stays in the room so frames never look it up again
+        return ChatRoom(id=room_key, user1_id=participants[0], user2_id=participants[1])
+    except Exception:
+        logger.exception("ws room membership check failed room=%s user=%s", room_id, user.id)
+        return None
+
+
+class RoomChannel:
+    """
+    A socket's participation in one room: the room group subscription, the connection's typing
+    state in the room and the handling of its frames. ChatConsumer holds one, UserConsumer one
+    per subscribed room. Frames the socket sends about the room carry its room_id.
+    """
+
+    def __init__(self, consumer, room):
+        self.consumer = consumer
+        self.user = consumer.scope['user']
+        self.room = room
+        self.room_key = str(room.id)
+        self.group_name = f"chat_{self.room_key}"
+        self.recipient_id = room.user2_id if self.user.id == room.user1_id else room.user1_id
+        # Only typing transitions are broadcast to the room
+        self.is_typing = False
+        self.typing_changed_at = 0.0
+        self.typing_expiry = None
+
+    async def join(self, cursor=None, read=False):
+        await join_group(self.consumer, self.group_name)
+        logger.debug("ws joined room=%s user=%s", self.room_key, self.user.id)
+
+        # A reconnecting client passes the cursor of the last event it saw
+        if cursor:
+            try:
+                await self.catch_up(cursor)
+            except DatabaseUnavailable as e:
+                await self.send_error(e, 'sync')
+
+        # Only a client showing the room asks for it to be marked read, a sidebar subscription
+        # must leave the unread badge alone. The socket stays usable if this fails
+        if read:
+            try:
+                await self.mark_read()
+            except DatabaseUnavailable as e:
+                await self.send_error(e, 'mark_read')
+
+    async def leave(self):
+        await self.set_typing(False)
+        await leave_group(self.consumer, self.group_name)
+
+    async def handle(self, data):
+        message_type = data.get('type', 'chat_message')
+        user = self.user
+        try:
             if message_type == 'chat_message':
                 message_text = data.get('message', '').strip()
                 file_url = data.get('file_url')
                 message_id = data.get('message_id')
 
                 if file_url and message_id:
-                    # Message already saved, just broadcast
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
+                    # Message already saved by the upload view, broadcast its stored attachment
+                    attachment = await self.get_message_attachment(message_id)
+                    if attachment:
+                        await self.publish({
                             'type': 'chat_message',
                             'message': message_text,
-                            'file_url': file_url,
+                            'file_url': attachment.url,
+                            'preview': attachment.preview,
                             'sender': user.email,
                             'sender_id': str(user.id),
                             'timestamp': 'Just now',
                             'message_id': message_id
-                        }
-                    )
+                        })
+                        await self.notify_recipient()
                 elif message_text:
-                    message_obj = await self.save_message(user, message_text)
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message_text,
-                            'sender': user.email,
-                            'sender_id': str(user.id),
-                            'timestamp': timezone.localtime(message_obj.timestamp).strftime('%H:%M'),
-                            'message_id': str(message_obj.id)
-                        }
-                    )
+                    # Sending ends the typing burst, the next keystroke starts a new one at once
+                    await self.set_typing(False, reset_interval=True)
+                    client_id = parse_uuid(data.get('client_id'))
+                    sent = sent_messages.get((user.id, client_id)) if client_id else None
+                    if sent:
+                        # A retry of a message that was already stored and broadcast
+                        await self.send_ack(client_id, *sent, duplicate=True)
+                        return
+
+                    if settings.CHAT_WRITE_BEHIND:
+                        # Broadcast right away, the writer persists the message in the next batch
+                        message_obj = Message(room=self.room, sender=user, content=message_text, client_id=client_id)
+                        created = True
+                        await get_message_writer().submit(message_obj)
+                    else:
+                        message_obj, created = await self.save_message(message_text, client_id)
+                    if client_id:
+                        await self.send_ack(client_id, message_obj.id, message_obj.timestamp, duplicate=not created)
+                    # A retry found in the database is broadcast again in case the first attempt
+                    # never was, clients skip message ids they already show
+                    await self.publish({
+                        'type': 'chat_message',
+                        'message': message_obj.content,
+                        'sender': user.email,
+                        'sender_id': str(user.id),
+                        'timestamp': timezone.localtime(message_obj.timestamp).strftime('%H:%M'),
+                        'sent_at': message_obj.timestamp.isoformat(),
+                        'message_id': str(message_obj.id),
+                        'client_id': str(client_id) if client_id else None
+                    })
+                    if created:
+                        await self.notify_recipient()
+                    if client_id:
+                        sent_messages.set((user.id, client_id), (message_obj.id, message_obj.timestamp))
 
             elif message_type == 'mark_read':
-                await self.mark_messages_as_read(user)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'messages_read',
-                        'user_id': str(user.id)
-                    }
-                )
+                await self.mark_read()
             elif message_type == 'typing':
-                is_typing = data.get('typing', False)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'user_typing',
-                        'user_id': str(user.id),
-                        'typing': is_typing
-                    }
-                )
+                await self.set_typing(bool(data.get('typing', False)))
             elif message_type == 'delete_message':
                 message_id = data.get('message_id')
-                if await self.delete_message_from_db(user, message_id):
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'message_deleted',
-                            'message_id': message_id
-                        }
-                    )
-        except Exception as e:
-            print(f"WS Receive Error: {e}")
+                if settings.CHAT_WRITE_BEHIND:
+                    # The message may still be waiting in the write-behind queue
+                    await get_message_writer().flush()
+                if await self.delete_message_from_db(message_id):
+                    await self.publish({
+                        'type': 'message_deleted',
+                        'message_id': message_id
+                    })
+        except DatabaseUnavailable as e:
+            # Only this sender learns that the request was dropped
+            logger.warning("ws database unavailable request=%s code=%s error=%s", message_type, e.code, e)
+            await self.send_error(e, message_type, client_id=data.get('client_id'))
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'file_url': event.get('file_url'),
-            'sender': event['sender'],
-            'sender_id': event['sender_id'],
-            'timestamp': event.get('timestamp', 'Just now'),
-            'message_id': event.get('message_id')
+    async def mark_read(self):
+        last_read_at = await self.mark_messages_as_read()
+        # The other participant sees the read ticks, the user's other sockets clear the badge
+        await self.publish({
+            'type': 'messages_read',
+            'user_id': str(self.user.id),
+            'last_read_at': last_read_at.isoformat()
+        })
+        await group_send(self.consumer, user_group_name(self.user.id), encode_room_event(self.room_key, {
+            'type': 'unread_update',
+            'contact_id': str(self.recipient_id),
+            'unread_count': 0
         }))
 
-    async def messages_read(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'messages_read',
-            'user_id': event['user_id']
+    async def notify_recipient(self):
+        # Badges of the recipient's other conversations grow without them joining this room
+        await group_send(self.consumer, user_group_name(self.recipient_id), encode_room_event(self.room_key, {
+            'type': 'unread_update',
+            'contact_id': str(self.user.id),
+            'delta': 1
         }))
 
-    async def user_typing(self, event):
-        await self.send(text_data=json.dumps({
+    async def set_typing(self, is_typing, reset_interval=False):
+        if self.typing_expiry:
+            self.typing_expiry.cancel()
+            self.typing_expiry = None
+        if reset_interval:
+            self.typing_changed_at = 0.0
+
+        if is_typing:
+            # Typing stops on its own unless the client keeps reporting it
+            self.typing_expiry = asyncio.get_running_loop().call_later(
+                settings.CHAT_TYPING_TIMEOUT, lambda: asyncio.ensure_future(self.set_typing(False))
+            )
+            if self.is_typing:
+                return
+            # Restarting right after a stop frame or an expiry is dropped to absorb flapping
+            # clients, a stop caused by sending a message does not hold the next start back
+            if time.monotonic() - self.typing_changed_at < settings.CHAT_TYPING_MIN_INTERVAL:
+                return
+        elif not self.is_typing:
+            return
+
+        self.is_typing = is_typing
+        if is_typing or not reset_interval:
+            self.typing_changed_at = time.monotonic()
+        await self.broadcast({
             'type': 'user_typing',
-            'user_id': event['user_id'],
-            'typing': event['typing']
-        }))
+            'user_id': str(self.user.id),
+            'typing': is_typing
+        })
 
-    async def message_deleted(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'message_deleted',
-            'message_id': event['message_id']
-        }))
+    async def broadcast(self, payload):
+        # Encoded once here in both wire formats, every socket in the group forwards one of them
+        await group_send(self.consumer, self.group_name, encode_room_event(self.room_key, payload))
 
-    @database_sync_to_async
-    def check_room_membership(self, user):
+    async def publish(self, payload):
+        # Room events that change what clients show are sequenced so reconnects can replay them
+        await group_send(self.consumer, self.group_name, await sequence_event(self.room_key, payload))
 
+    async def catch_up(self, cursor):
+        """
+        Send the events this client missed after `cursor`, from the room's event buffer when it
+        holds all of them and rebuilt from the database otherwise, then a fresh cursor.
+        """
         try:
-            # select_related helps fetch the users in the same query
-            room = ChatRoom.objects.select_related('user1', 'user2').get(id=self.room_id)
-            if user == room.user1 or user == room.user2:
-                print(f"WS Room Membership Valid: {user.email}")
-                return True
-            print(f"WS Room Membership Invalid: {user.email}")
-            return False
-        except Exception as e:
-            print(f"WS Membership Check Error: {e}")
-            return False
+            seq, since_at = decode_sync_cursor(cursor)
+        except ValueError:
+            return
+        synced_at = timezone.now()
+        current = await get_sequencer().current(self.room_key)
+
+        events = buffered_events(self.room_key, seq, current)
+        if events is None:
+            if settings.CHAT_WRITE_BEHIND:
+                # Messages still queued for writing would be missing from the database
+                await get_message_writer().flush()
+            events = await self.load_missed_events(since_at)
+        if events is None:
+            await self.send({'type': 'sync_reset'})
+            return
+
+        for event in events:
+            await self.consumer.send_event(event)
+        await self.send({
+            'type': 'synced',
+            'seq': current,
+            'cursor': encode_sync_cursor(current, synced_at)
+        })
+
+    async def send(self, payload):
+        # A frame for this socket only
+        await self.consumer.send_event(encode_room_event(self.room_key, payload))
 
-    @database_sync_to_async
-    def save_message(self, user, message):
-        room = ChatRoom.objects.get(id=self.room_id)
-        return Message.objects.create(
-            room=room,
-            sender=user,
-            content=message
-        )
-
-    @database_sync_to_async
-    def mark_messages_as_read(self, user):
-        room = ChatRoom.objects.get(id=self.room_id)
-        Message.objects.filter(room=room).exclude(sender=user).update(is_read=True)
-
-    @database_sync_to_async
-    def delete_message_from_db(self, user, message_id):
+    async def send_error(self, error, request_type, client_id=None):
+        payload = {
+            'type': 'error',
+            'code': error.code,
+            'request': request_type,
+            'message': str(error)
+        }
+        if client_id:
+            payload['client_id'] = client_id
+        await self.send(payload)
+
+    async def send_ack(self, client_id, message_id, timestamp, duplicate=False):
+        # Sent before the room broadcast, so the sender learns the canonical id first
+        await self.send({
+            'type': 'ack',
+            'client_id': str(client_id),
+            'message_id': str(message_id),
+            'timestamp': timezone.localtime(timestamp).strftime('%H:%M'),
+            'sent_at': timestamp.isoformat(),
+            'duplicate': duplicate
+        })
+
+    @run_in_executor('critical')
+    def save_message(self, message, client_id=None):
+        """
+        Store a message and return it with whether it was created. A client id that was already
+        used returns the message stored by the first attempt.
+        """
+        try:
+            with transaction.atomic():
+                message_obj = Message.objects.create(
+                    room=self.room,
+                    sender=self.user,
+                    content=message,
+                    client_id=client_id
+                )
+                RoomMembership.objects.record_message(self.room, message_obj)
+        except IntegrityError:
+            if client_id is None:
+                raise
+            message_obj = Message.objects.only('id', 'content', 'timestamp').get(
+                room=self.room, sender=self.user, client_id=client_id
+            )
+            return message_obj, False
+        return message_obj, True
+
+    @run_in_executor('critical')
+    def get_message_attachment(self, message_id):
+        return Attachment.objects.filter(
+            messages__id=message_id, messages__room=self.room, messages__sender=self.user
+        ).only('width', 'height', 'thumbnails').first()
+
+    @run_in_executor('bulk')
+    def load_missed_events(self, since_at):
+        return missed_events(self.room, since_at)
+
+    @run_in_executor('bulk')
+    def mark_messages_as_read(self):
+        return RoomMembership.objects.mark_read(self.room, self.user)
+
+    @run_in_executor('critical')
+    def delete_message_from_db(self, message_id):
         try:
             # Only sender can delete their own message
-            msg = Message.objects.get(id=message_id, sender=user)
-            msg.delete()
+            # Only what release_message and the attachment signal read
+            msg = Message.objects.only('sender_id', 'timestamp', 'attachment_id').get(
+                id=message_id, room=self.room, sender=self.user
+            )
+            with transaction.atomic():
+                RoomMembership.objects.release_message(self.room, msg)
+                MessageTombstone.objects.create(room=self.room, message_id=msg.id)
+                msg.delete()
             return True
         except Message.DoesNotExist:
-            print(f"WS Delete Error: Message {message_id} not found or not owned by {user}")
+            logger.info("ws delete refused message=%s user=%s", message_id, self.user.id)
+            return False
+        except Exception:
+            logger.exception("ws delete failed message=%s user=%s", message_id, self.user.id)
             return False
-        except Exception as e:
-            print(f"WS Delete Error: {e}")
+
+
+def open_outbound_queue(consumer, write):
+    async def evict():
+        await consumer.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    return OutboundQueue(
+        write,
+        evict,
+        max_size=settings.CHAT_SEND_QUEUE_SIZE,
+        high_water=settings.CHAT_SEND_HIGH_WATER,
+        slow_timeout=settings.CHAT_SEND_SLOW_TIMEOUT
+    )
+
+
+class ChatSocketConsumer(AsyncWebsocketConsumer):
+    """
+    Shared by the chat sockets: subprotocol negotiation, authentication, presence counting and
+    forwarding pre-encoded room events in the negotiated wire format through the socket's
+    outbound queue.
+    """
+
+    # WebSocket subprotocols in order of preference, "msgpack" clients get binary frames
+    subprotocols = ('msgpack', 'json')
+    subprotocol = None
+    outbound = None
+    endpoint = None
+
+    async def start(self):
+        offered = self.scope.get('subprotocols', [])
+        self.subprotocol = next((name for name in self.subprotocols if name in offered), None)
+
+        # We accept first to give the client a stable connection while we validate
+        await self.accept(subprotocol=self.subprotocol)
+        self.outbound = open_outbound_queue(self, self.write_event)
+        ws_connections.inc(self.endpoint)
+
+        user = self.scope["user"]
+        logger.debug("ws connect endpoint=%s user=%s", self.endpoint, user.id)
+
+        if user.is_anonymous:
+            logger.info("ws rejected anonymous endpoint=%s", self.endpoint)
+            await self.close()
             return False
 
-    @database_sync_to_async
-    def update_user_status(self, user, is_online):
-        User.objects.filter(id=user.id).update(
-            is_online=is_online,
-            last_seen=timezone.now()
-        )
+        # Count this socket towards the user's presence
+        await get_presence_registry().connect(user.id)
+        return True
+
+    async def stop(self, close_code):
+        if self.outbound:
+            self.outbound.close()
+            ws_connections.dec(self.endpoint)
+        user = self.scope["user"]
+        if not user.is_anonymous:
+            await get_presence_registry().disconnect(user.id)
+        logger.debug("ws disconnect endpoint=%s user=%s code=%s", self.endpoint, user.id, close_code)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        frame_type = 'invalid'
+        try:
+            try:
+                data = self.decode(text_data, bytes_data)
+            except ValueError as e:
+                logger.info("ws undecodable frame endpoint=%s error=%r", self.endpoint, e)
+                return
+            frame_type = data.get('type', 'chat_message')
+            if frame_type not in FRAME_TYPES:
+                frame_type = 'other'
+            await self.handle_frame(data)
+        except Exception:
+            logger.exception("ws receive failed endpoint=%s type=%s", self.endpoint, frame_type)
+        finally:
+            ws_frames_received.inc(frame_type)
+            ws_receive_seconds.observe(time.perf_counter() - started, frame_type)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            return get_msgpack_codec().loads(bytes_data)
+        return get_json_codec().loads(text_data)
+
+    async def send_event(self, event):
+        # Returns right away, the queue's task writes the frame
+        self.outbound.put(event)
+
+    async def write_event(self, event):
+        ws_frames_sent.inc(event['type'])
+        if self.subprotocol == 'msgpack':
+            await self.send(bytes_data=event['bytes'])
+        else:
+            await self.send(text_data=event['text'])
+
+    async def send_room_event(self, event):
+        if 'seq' in event:
+            record_event(event['room_id'], event)
+        await self.send_event(event)
+
+    async def chat_message(self, event):
+        await self.send_room_event(event)
+
+    async def messages_read(self, event):
+        await self.send_room_event(event)
+
+    async def user_typing(self, event):
+        await self.send_event(event)
+
+    async def message_deleted(self, event):
+        await self.send_room_event(event)
+
+    async def attachment_ready(self, event):
+        await self.send_event(event)
+
+
+class ChatConsumer(ChatSocketConsumer):
+    """
+    One socket per room at ws/chat/<room_id>/, optionally catching up from ?since=<cursor>.
+    """
+
+    endpoint = 'room'
+    room_channel = None
+
+    async def connect(self):
+        if not await self.start():
+            return
+
+        user = self.scope["user"]
+        room_id = self.scope['url_route']['kwargs']['room_id']
+        try:
+            room = await get_member_room(user, room_id)
+        except DatabaseUnavailable as e:
+            await self.send_event(encode_event({
+                'type': 'error',
+                'code': e.code,
+                'request': 'connect',
+                'message': str(e)
+            }))
+            await self.outbound.flush()
+            room = None
+
+        if room is None:
+            # We already counted this socket, but if membership fails we disconnect
+            # and the presence registry releases it in disconnect.
+            await self.close()
+            return
+
+        self.room_channel = RoomChannel(self, room)
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since')
+        # The per-room socket belongs to the open room page, connecting has always marked it read
+        await self.room_channel.join(since[0] if since else None, read=True)
+
+    async def disconnect(self, close_code):
+        if self.room_channel:
+            await self.room_channel.leave()
+        await self.stop(close_code)
+
+    async def handle_frame(self, data):
+        if self.room_channel:
+            await self.room_channel.handle(data)
 
 
+class UserConsumer(ChatSocketConsumer):
+    """
+    One socket per user at ws/chat/ for any number of rooms. Rooms are joined with
+    {"type": "subscribe", "room_id", "since", "read"} and left with "unsubscribe", every other
+    frame names its room_id. Only a subscribe with "read": true marks the room read. The user's
+    personal group delivers unread updates for all of their rooms. Presence updates are only
+    sent after {"type": "subscribe_presence"}, so pages that show no contacts are left out of
+    every status change.
+    """
+
+    endpoint = 'user'
+
+    async def connect(self):
+        self.room_channels = {}
+        self.presence_subscribed = False
+        if not await self.start():
+            return
+
+        user = self.scope["user"]
+        await join_group(self, user_group_name(user.id))
+
+    async def disconnect(self, close_code):
+        for room_channel in self.room_channels.values():
+            await room_channel.leave()
+        self.room_channels.clear()
+
+        user = self.scope["user"]
+        if not user.is_anonymous:
+            await leave_group(self, user_group_name(user.id))
+        await self.unsubscribe_presence()
+        await self.stop(close_code)
+
+    async def handle_frame(self, data):
+        message_type = data.get('type')
+        room_id = parse_uuid(data.get('room_id'))
+        room_key = str(room_id) if room_id else None
+
+        if message_type == 'subscribe':
+            await self.subscribe(room_key, data.get('since'), data.get('read') is True)
+        elif message_type == 'unsubscribe':
+            room_channel = self.room_channels.pop(room_key, None)
+            if room_channel:
+                await room_channel.leave()
+        elif message_type == 'subscribe_presence':
+            if not self.presence_subscribed:
+                self.presence_subscribed = True
+                await join_group(self, PRESENCE_GROUP)
+        elif message_type == 'unsubscribe_presence':
+            await self.unsubscribe_presence()
+        elif room_key in self.room_channels:
+            await self.room_channels[room_key].handle(data)
+
+    async def subscribe(self, room_key, cursor=None, read=False):
+        if room_key in self.room_channels:
+            return
+        if len(self.room_channels) >= settings.CHAT_MAX_SUBSCRIPTIONS:
+            await self.refuse(room_key, 'limit', f"At most {settings.CHAT_MAX_SUBSCRIPTIONS} rooms per socket")
+            return
+
+        try:
+            room = await get_member_room(self.scope["user"], room_key) if room_key else None
+        except DatabaseUnavailable as e:
+            await self.refuse(room_key, e.code, str(e))
+            return
+        if room is None:
+            await self.refuse(room_key, 'forbidden', "Room not found")
+            return
+
+        room_channel = self.room_channels[room_key] = RoomChannel(self, room)
+        await room_channel.join(cursor, read)
+
+    async def unsubscribe_presence(self):
+        if self.presence_subscribed:
+            self.presence_subscribed = False
+            await leave_group(self, PRESENCE_GROUP)
+
+    async def refuse(self, room_key, code, message):
+        await self.send_event(encode_event({
+            'type': 'error',
+            'code': code,
+            'request': 'subscribe',
+            'room_id': room_key,
+            'message': message
+        }))
+
+    async def unread_update(self, event):
+        await self.send_event(event)
+
+    async def presence_update(self, event):
+        await self.send_event(event)
+
+
+class PresenceConsumer(AsyncWebsocketConsumer):
+    """
+    Presence updates only, for older clients. Connecting is the subscription.
+    """
+
+    endpoint = 'presence'
+    outbound = None
+
+    async def connect(self):
+        if self.scope["user"].is_anonymous:
+            await self.close()
+            return
+
+        await join_group(self, PRESENCE_GROUP)
+        await self.accept()
+        self.outbound = open_outbound_queue(self, self.write_event)
+        ws_connections.inc(self.endpoint)
+
+    async def disconnect(self, close_code):
+        if self.outbound:
+            self.outbound.close()
+            ws_connections.dec(self.endpoint)
+            await leave_group(self, PRESENCE_GROUP)
 
+    async def presence_update(self, event):
+        self.outbound.put(event)
 
+    async def write_event(self, event):
+        ws_frames_sent.inc(event['type'])
+        await self.send(text_data=event['text'])
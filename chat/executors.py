@@ -0,0 +1,150 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import Counter, Gauge, db_call_errors, db_call_seconds
+
+
+class DatabaseUnavailable(Exception):
+    """
+    A database call was not answered. `code` is sent to WebSocket clients in error frames.
+    """
+    code = 'unavailable'
+
+
+class ExecutorSaturated(DatabaseUnavailable):
+    code = 'overloaded'
+
+
+class ExecutorTimeout(DatabaseUnavailable):
+    code = 'timeout'
+
+
+class DatabaseExecutor:
+    """
+    A bounded thread pool for synchronous database calls made from async code. At most
+    `max_queue` calls may be waiting or running, and callers stop waiting after `timeout`
+    seconds. A call that timed out still finishes in its thread and keeps its slot until then,
+    so a stuck database fills the queue and further calls fail fast.
+    """
+
+    def __init__(self, name, max_workers, max_queue, timeout):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"db-{name}")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def run(self, func, *args, timeout=..., **kwargs):
+        method = getattr(func, '__name__', 'call')
+        started = time.perf_counter()
+        try:
+            return await self.submit(func, *args, timeout=timeout, **kwargs)
+        except DatabaseUnavailable as e:
+            db_call_errors.inc(self.name, method, e.code)
+            raise
+        finally:
+            db_call_seconds.observe(time.perf_counter() - started, self.name, method)
+
+    async def submit(self, func, *args, timeout=..., **kwargs):
+        with self.lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                raise ExecutorSaturated(f"{self.name} database pool has {self.pending} calls pending")
+            self.pending += 1
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(self.call, func, *args, **kwargs)
+        )
+        timeout = self.timeout if timeout is ... else timeout
+        try:
+            # shield() keeps the thread's result from being cancelled when the wait times out
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise ExecutorTimeout(f"{self.name} database call took longer than {timeout}s")
+
+    def call(self, func, *args, **kwargs):
+        with self.lock:
+            self.running += 1
+        # Same connection handling as channels' database_sync_to_async
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+            with self.lock:
+                self.running -= 1
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'running': self.running,
+                'queued': self.pending - self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+            }
+
+
+_executors = {}
+
+
+def get_executor(name):
+    if name not in _executors:
+        options = settings.CHAT_DB_EXECUTORS[name]
+        _executors[name] = DatabaseExecutor(
+            name,
+            max_workers=options['workers'],
+            max_queue=options['queue'],
+            timeout=options['timeout']
+        )
+    return _executors[name]
+
+
+def executor_stats():
+    return {name: executor.stats() for name, executor in _executors.items()}
+
+
+pool_calls = Gauge(
+    'chat_db_pool_calls', "Calls running on or queued for a database pool", ['pool', 'state'],
+    collect=lambda: {
+        (name, state): stats[state] for name, stats in executor_stats().items() for state in ('running', 'queued')
+    }
+)
+pool_rejected = Counter(
+    'chat_db_pool_rejected_total', "Calls refused because the pool queue was full", ['pool'],
+    collect=lambda: {(name,): stats['rejected'] for name, stats in executor_stats().items()}
+)
+pool_timeouts = Counter(
+    'chat_db_pool_timeouts_total', "Calls the caller stopped waiting for", ['pool'],
+    collect=lambda: {(name,): stats['timeouts'] for name, stats in executor_stats().items()}
+)
+
+
+def run_in_executor(name):
+    """
+    Decorator turning a synchronous database function into a coroutine run on the named pool,
+    the executor counterpart of @database_sync_to_async.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await get_executor(name).run(func, *args, **kwargs)
+        return wrapper
+    return decorator
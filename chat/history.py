@@ -0,0 +1,95 @@
+import base64
+import uuid
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .archive import get_archived_messages
+from .models import Message, RoomMembership
+
+# Columns a rendered or serialized message needs, the rest of the sender and attachment rows stay behind
+MESSAGE_FIELDS = (
+    'id', 'sender__email', 'content', 'timestamp', 'client_id',
+    'attachment__name', 'attachment__width', 'attachment__height', 'attachment__thumbnails',
+)
+
+
+def encode_cursor(message):
+    # The cursor is the (timestamp, id) pair of the oldest message on a page
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = raw.split('|', 1)
+        timestamp = parse_datetime(timestamp)
+        message_id = uuid.UUID(message_id)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid history cursor")
+    if timestamp is None:
+        raise ValueError("Invalid history cursor")
+    return timestamp, message_id
+
+
+def get_page_size(limit=None):
+    page_size = settings.CHAT_HISTORY_PAGE_SIZE
+    if limit:
+        page_size = min(max(int(limit), 1), page_size)
+    return page_size
+
+
+def get_history_page(room, before=None, limit=None):
+    """
+    Return one page of messages older than the `before` cursor (newest page when
+    no cursor is given), ordered oldest first, plus the cursor for the next page.
+    Pages continue into the room's archive once the message table runs out.
+    """
+    page_size = get_page_size(limit)
+    queryset = Message.objects.filter(room=room).select_related('sender', 'attachment').only(*MESSAGE_FIELDS)
+
+    cursor = decode_cursor(before) if before else None
+    if cursor:
+        timestamp, message_id = cursor
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+
+    page = list(queryset.order_by('-timestamp', '-id')[:page_size + 1])
+    if len(page) <= page_size:
+        # Archived messages are all older than the ones left in the table
+        if page:
+            cursor = (page[-1].timestamp, page[-1].id)
+        page += reversed(get_archived_messages(room, cursor, page_size + 1 - len(page)))
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    page = page[:page_size]
+    page.reverse()
+    apply_read_state(room, page)
+    return page, next_cursor
+
+
+def apply_read_state(room, messages):
+    # A message is read once the recipient's read watermark has passed it
+    watermarks = RoomMembership.objects.read_watermarks(room)
+    for message in messages:
+        recipient_id = room.user2_id if message.sender_id == room.user1_id else room.user1_id
+        last_read_at = watermarks.get(recipient_id)
+        message.is_read = last_read_at is not None and message.timestamp <= last_read_at
+
+
+def serialize_message(message):
+    return {
+        'message': message.content or '',
+        'file_url': message.attachment.url if message.attachment else None,
+        'preview': message.attachment.preview if message.attachment else None,
+        'sender': message.sender.email,
+        'sender_id': str(message.sender_id),
+        'timestamp': timezone.localtime(message.timestamp).strftime('%H:%M'),
+        'sent_at': message.timestamp.isoformat(),
+        'message_id': str(message.id),
+        'client_id': str(message.client_id) if message.client_id else None,
+        'is_read': message.is_read,
+    }
@@ -0,0 +1,17 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BackgroundStreamHandler(QueueHandler):
+    """
+    Formats records where they are logged and hands them to a thread that writes them to
+    stderr, so code on the event loop never waits on the stream.
+    """
+
+    def __init__(self):
+        super().__init__(queue.SimpleQueue())
+        self.listener = QueueListener(self.queue, logging.StreamHandler())
+        self.listener.start()
+        atexit.register(self.listener.stop)
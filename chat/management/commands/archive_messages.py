@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_room
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = "Move old messages that both participants have read into compressed archive segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this many days"
+        )
+        parser.add_argument(
+            '--segment-size', type=int, default=settings.CHAT_ARCHIVE_SEGMENT_SIZE,
+            help="Maximum number of messages per segment file"
+        )
+        parser.add_argument(
+            '--max-segments', type=int, default=0,
+            help="Stop after writing this many segments so a run stays short, 0 for no limit"
+        )
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options['days'])
+        remaining = options['max_segments'] or None
+        segments = 0
+        messages = 0
+        size = 0
+
+        # Each segment is its own transaction, an interrupted run simply resumes on the next one
+        for room in list(ChatRoom.objects.only('id', 'user1_id', 'user2_id')):
+            written = archive_room(room, older_than, options['segment_size'], max_segments=remaining)
+            segments += len(written)
+            messages += sum(segment.message_count for segment in written)
+            size += sum(segment.size for segment in written)
+            if remaining is not None:
+                remaining -= len(written)
+                if remaining <= 0:
+                    break
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {messages} messages into {segments} segments, {size} bytes."
+        ))
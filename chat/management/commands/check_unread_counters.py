@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import RoomMembership
+
+
+class Command(BaseCommand):
+    help = "Report per-room unread counters that do not match the message table"
+
+    def handle(self, *args, **options):
+        inconsistent = RoomMembership.objects.find_inconsistent()
+        for membership, expected in inconsistent:
+            self.stdout.write(
+                f"room {membership.room_id} user {membership.user_id}: "
+                f"stored {membership.unread_count}, expected {expected}"
+            )
+
+        if inconsistent:
+            raise CommandError(f"{len(inconsistent)} unread counters are inconsistent, run rebuild_unread_counters.")
+        self.stdout.write(self.style.SUCCESS("All unread counters are consistent."))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.models import UploadSession
+from chat.uploads import discard_part
+
+
+class Command(BaseCommand):
+    help = "Delete resumable uploads that have not received a chunk recently, freeing their quota"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help="Age after which an idle upload is stale")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        stale = UploadSession.objects.filter(Q(updated_at__lt=cutoff) | Q(updated_at__isnull=True))
+        count = 0
+        for session in stale.iterator():
+            discard_part(session)
+            session.delete()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} stale uploads."))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import Attachment
+
+
+class Command(BaseCommand):
+    help = "Delete attachment blobs that no message references any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-minutes', type=int, default=60,
+            help="Keep unreferenced attachments this long so in-flight uploads can still reuse them"
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(minutes=options['grace_minutes'])
+        deleted = 0
+        freed = 0
+        for attachment in Attachment.objects.collectable(cutoff).iterator():
+            if options['dry_run']:
+                self.stdout.write(f"{attachment.sha256} {attachment.name} ({attachment.size} bytes)")
+            else:
+                # Re-check in the delete itself so a message created or an upload reusing the
+                # blob meanwhile keeps it
+                rows, _ = Attachment.objects.collectable(cutoff).filter(id=attachment.id).delete()
+                if not rows:
+                    continue
+                attachment.delete_files()
+            deleted += 1
+            freed += attachment.size
+
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {deleted} attachments, {freed} bytes."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Attachment
+from chat.thumbnails import process_attachment
+
+
+class Command(BaseCommand):
+    help = "Generate metadata and thumbnails for attachments the background workers have not processed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Reprocess every attachment")
+
+    def handle(self, *args, **options):
+        attachments = Attachment.objects.all()
+        if not options['all']:
+            attachments = attachments.filter(processed_at__isnull=True)
+
+        count = 0
+        for attachment in attachments.iterator():
+            process_attachment(attachment)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Processed {count} attachments."))
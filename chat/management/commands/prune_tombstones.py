@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import MessageTombstone
+
+
+class Command(BaseCommand):
+    help = "Delete tombstones of deleted messages that are too old for any client to catch up on"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHAT_SYNC_RETENTION_DAYS,
+            help="Age after which a tombstone is deleted"
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        count, _ = MessageTombstone.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} tombstones."))
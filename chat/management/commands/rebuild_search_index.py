@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the SQLite message search index, e.g. after a VACUUM renumbered the rows"
+
+    def handle(self, *args, **options):
+        rebuild_search_index(connection)
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
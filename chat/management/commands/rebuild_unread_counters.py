@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import RoomMembership
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-room unread counters from the message table"
+
+    def handle(self, *args, **options):
+        fixed = RoomMembership.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Unread counters rebuilt, {fixed} corrected."))
@@ -0,0 +1,198 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Seconds, from a fast cache hit to a database call that is about to time out
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    """
+    A metric of this process in the Prometheus text format. Values are kept per tuple of label
+    values, and gauges built with `collect` read them from elsewhere when scraped.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = defaultdict(float)
+        # Updated from the event loop and from database and request threads alike
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        if self.collect is not None:
+            return [(self.name, labels, value) for labels, value in self.collect().items()]
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labels, labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def dec(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] -= amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (format_value(bound),), cumulative))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            label_names = self.labels + ('le',) if name.endswith('_bucket') else self.labels
+            lines.append(f"{name}{format_labels(label_names, labels)} {format_value(value)}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+registry = []
+
+
+class GroupMembers:
+    """
+    Channel layer group memberships held by sockets of this process, reported per kind of group
+    (chat rooms, users, presence) rather than per group to keep the number of series small.
+    """
+
+    def __init__(self):
+        self.members = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def joined(self, group):
+        with self.lock:
+            self.members[group] += 1
+
+    def left(self, group):
+        with self.lock:
+            self.members[group] -= 1
+            if self.members[group] <= 0:
+                del self.members[group]
+
+    def by_kind(self):
+        with self.lock:
+            sizes = list(self.members.items())
+        groups, members, largest = defaultdict(int), defaultdict(int), defaultdict(int)
+        for group, size in sizes:
+            kind = (group.split('_', 1)[0],)
+            groups[kind] += 1
+            members[kind] += size
+            largest[kind] = max(largest[kind], size)
+        return groups, members, largest
+
+
+group_members = GroupMembers()
+
+ws_connections = Gauge('chat_ws_connections', "Open WebSocket connections", ['endpoint'])
+ws_groups = Gauge(
+    'chat_ws_groups', "Channel layer groups with a socket of this process in them", ['kind'],
+    collect=lambda: group_members.by_kind()[0]
+)
+ws_group_members = Gauge(
+    'chat_ws_group_members', "Sockets of this process in channel layer groups", ['kind'],
+    collect=lambda: group_members.by_kind()[1]
+)
+ws_group_max_members = Gauge(
+    'chat_ws_group_max_members', "Sockets of this process in the largest group of a kind", ['kind'],
+    collect=lambda: group_members.by_kind()[2]
+)
+ws_frames_received = Counter('chat_ws_frames_received_total', "Frames received from clients", ['type'])
+ws_frames_sent = Counter('chat_ws_frames_sent_total', "Frames written to clients", ['type'])
+ws_receive_seconds = Histogram('chat_ws_receive_seconds', "Time to handle a received frame", ['type'])
+db_call_seconds = Histogram(
+    'chat_db_call_seconds', "Database calls made from async code, including time queued for a thread",
+    ['pool', 'method']
+)
+db_call_errors = Counter('chat_db_call_errors_total', "Database calls that were not answered", ['pool', 'method', 'code'])
+layer_send_seconds = Histogram('chat_channel_layer_send_seconds', "Time to hand an event to the channel layer", ['type'])
+upload_bytes = Histogram(
+    'chat_upload_bytes', "Size of completed uploads", ['kind'],
+    buckets=tuple(1024 * 4 ** n for n in range(11))
+)
+upload_seconds = Histogram(
+    'chat_upload_seconds', "Time from starting an upload to completing it", ['kind'],
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 86400)
+)
@@ -0,0 +1,64 @@
+# Generated by Django 5.2 on 2026-10-18 17:42
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_memberships(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    RoomMembership = apps.get_model('chat', 'RoomMembership')
+
+    unread = Message.objects.filter(is_read=False).order_by().values('room_id', 'sender_id').annotate(count=Count('id'))
+    unread_counts = {(row['room_id'], row['sender_id']): row['count'] for row in unread}
+
+    memberships = []
+    for room in ChatRoom.objects.all().iterator():
+        # Each participant's counter holds the unread messages sent by the other one
+        memberships.append(RoomMembership(
+            room_id=room.id, user_id=room.user1_id, unread_count=unread_counts.get((room.id, room.user2_id), 0)
+        ))
+        memberships.append(RoomMembership(
+            room_id=room.id, user_id=room.user2_id, unread_count=unread_counts.get((room.id, room.user1_id), 0)
+        ))
+    RoomMembership.objects.bulk_create(memberships, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_unread_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomMembership',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('deleted_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('custom_order', models.BigIntegerField(blank=True, null=True)),
+                ('alt_txt', models.CharField(blank=True, max_length=250, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('deleted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deleted_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chat.chatroom')),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='updated_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'room_membership',
+                'verbose_name_plural': 'room_memberships',
+                'db_table': 'chat_room_membership',
+                'unique_together': {('room', 'user')},
+            },
+        ),
+        migrations.RunPython(populate_memberships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2 on 2026-10-18 17:43
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def set_watermarks(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    RoomMembership = apps.get_model('chat', 'RoomMembership')
+
+    # The watermark starts at the newest message from the other participant already marked read
+    read_messages = Message.objects.filter(
+        room=OuterRef('room'), is_read=True
+    ).exclude(sender=OuterRef('user')).order_by().values('room').annotate(last=Max('timestamp')).values('last')
+    RoomMembership.objects.update(last_read_at=Subquery(read_messages))
+
+    # Counters are re-derived from the watermark so both agree from the start
+    other_messages = Message.objects.filter(room=OuterRef('room')).exclude(sender=OuterRef('user')).order_by()
+    unread_after_watermark = other_messages.filter(timestamp__gt=OuterRef('last_read_at'))
+    RoomMembership.objects.filter(last_read_at__isnull=False).update(
+        unread_count=Coalesce(Subquery(count_per_room(unread_after_watermark)), 0)
+    )
+    RoomMembership.objects.filter(last_read_at__isnull=True).update(
+        unread_count=Coalesce(Subquery(count_per_room(other_messages)), 0)
+    )
+
+
+def count_per_room(messages):
+    return messages.values('room').annotate(count=Count('id')).values('count')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_roommembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommembership',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_watermarks, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_message_unread_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.2 on 2026-10-18 17:55
+
+import os
+
+import chat.models
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models, transaction
+from django.db.models import F
+
+from chat.uploads import content_checksum
+
+
+def move_files_to_attachments(apps, schema_editor):
+    Attachment = apps.get_model('chat', 'Attachment')
+    Message = apps.get_model('chat', 'Message')
+    moved = []
+
+    for message in Message.objects.exclude(file='').exclude(file__isnull=True).iterator():
+        name = message.file.name
+        if not message.file.storage.exists(name):
+            continue
+        with message.file.open('rb'):
+            sha256, size = content_checksum(message.file)
+            attachment = Attachment.objects.filter(sha256=sha256).first()
+            if attachment is None:
+                attachment = Attachment(sha256=sha256, name=os.path.basename(name), size=size)
+                attachment.file.save(name, message.file, save=False)
+                attachment.save()
+
+        Attachment.objects.filter(id=attachment.id).update(ref_count=F('ref_count') + 1)
+        message.attachment = attachment
+        message.save(update_fields=['attachment'])
+        moved.append((message.file.storage, name))
+
+    # The old copies are only removed once the new rows are committed
+    transaction.on_commit(
+        lambda: [storage.delete(name) for storage, name in moved], using=schema_editor.connection.alias
+    )
+
+
+def restore_message_files(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for message in Message.objects.filter(attachment__isnull=False).select_related('attachment').iterator():
+        message.file = message.attachment.file.name
+        message.save(update_fields=['file'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_uploadsession'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('deleted_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('custom_order', models.BigIntegerField(blank=True, null=True)),
+                ('alt_txt', models.CharField(blank=True, max_length=250, null=True)),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(max_length=255, upload_to=chat.models.attachment_path)),
+                ('name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('deleted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deleted_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='updated_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'attachment',
+                'verbose_name_plural': 'attachments',
+                'db_table': 'chat_attachment',
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='attachment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='chat.attachment'),
+        ),
+        migrations.RunPython(move_files_to_attachments, restore_message_files),
+        migrations.RemoveField(
+            model_name='message',
+            name='file',
+        ),
+    ]
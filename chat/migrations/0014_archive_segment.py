@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-18 18:17
+
+import chat.models
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('deleted_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('custom_order', models.BigIntegerField(blank=True, null=True)),
+                ('alt_txt', models.CharField(blank=True, max_length=250, null=True)),
+                ('file', models.FileField(max_length=255, storage=chat.models.archive_storage, upload_to=chat.models.archive_segment_path)),
+                ('start_timestamp', models.DateTimeField()),
+                ('end_timestamp', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('attachments', models.JSONField(blank=True, default=dict)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('deleted_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='deleted_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='chat.chatroom')),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='updated_by_%(class)s_objects', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'archive_segment',
+                'verbose_name_plural': 'archive_segments',
+                'db_table': 'chat_archive_segment',
+                'indexes': [models.Index(fields=['room', 'end_timestamp'], name='chat_archive_room_end_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from chat.search import create_search_index
+
+
+def create_index(apps, schema_editor):
+    # Removing columns rebuilds chat_message on SQLite, which drops the search triggers
+    create_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_archive_segment'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, create_index),
+        migrations.RemoveField(
+            model_name='message',
+            name='alt_txt',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='created_at',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='created_by',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='custom_order',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='deleted_at',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='deleted_by',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_deleted',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='updated_at',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='updated_by',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='chat.chatroom'),
+        ),
+        migrations.RunPython(create_index, migrations.RunPython.noop),
+    ]
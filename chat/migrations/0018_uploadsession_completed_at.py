@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_message_client_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,10 +1,21 @@
-from django.db import models
+import os
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from accounts.models import User
 from base.models import BaseModel
 
+from .uploads import content_checksum
+
 
 class ChatRoom(BaseModel):
     user1 = models.ForeignKey(User, related_name='chats_initiated', on_delete=models.CASCADE)
@@ -20,19 +31,339 @@ class ChatRoom(BaseModel):
         unique_together = ('user1', 'user2')
 
 
-class Message(BaseModel):
-    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
-    sender = models.ForeignKey(User, on_delete=models.CASCADE)
+def attachment_path(instance, filename):
+    # Blobs are named by their content hash and sharded so no directory grows too large
+    extension = os.path.splitext(filename)[1].lower()
+    return f"attachments/{instance.sha256[:2]}/{instance.sha256[2:4]}/{instance.sha256}{extension}"
+
+
+class AttachmentManager(models.Manager):
+
+    def store(self, file, name, sha256=None):
+        """
+        Return the attachment holding the content of `file`, writing the blob only when
+        no attachment with the same SHA-256 exists yet.
+        """
+        if sha256 is None:
+            sha256, size = content_checksum(file)
+        else:
+            size = file.size
+
+        attachment = self.filter(sha256=sha256).first()
+        if attachment is not None:
+            # Restarts the garbage collection grace period, the message about to reference
+            # this blob has not been created yet
+            self.filter(id=attachment.id).update(updated_at=timezone.now())
+            return attachment
+
+        attachment = self.model(sha256=sha256, name=os.path.basename(name)[:255], size=size)
+        attachment.file.save(name, file, save=False)
+        try:
+            with transaction.atomic():
+                attachment.save(force_insert=True)
+        except IntegrityError:
+            # A concurrent upload of the same content won the insert, keep its blob
+            attachment.file.delete(save=False)
+            return self.get(sha256=sha256)
+        return attachment
+
+    def collectable(self, older_than):
+        # Unreferenced attachments that have not been touched recently enough to be reused
+        return self.filter(ref_count__lte=0, updated_at__lt=older_than)
+
+
+# Raster formats browsers render without running anything, the only ones served inline
+INLINE_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+
+class Attachment(BaseModel):
+    """
+    A stored file shared by every message that carries the same content.
+    `ref_count` is the number of messages pointing at it.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=attachment_path, max_length=255)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    # Filled in by the thumbnail workers after upload
+    mime_type = models.CharField(max_length=100, blank=True, null=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    thumbnails = models.JSONField(default=dict, blank=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    objects = AttachmentManager()
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def url(self):
+        # Served by the attachment_file view so only room participants can download it
+        return reverse('attachment_file', args=[self.id])
+
+    @property
+    def inline(self):
+        # Only images Pillow decoded, the mime type of anything else (SVG, HTML named .png) is a guess
+        return self.width is not None and self.mime_type in INLINE_MIME_TYPES
+
+    def thumbnail_url(self, size):
+        return reverse('attachment_thumbnail', args=[self.id, int(size)])
+
+    @property
+    def preview(self):
+        """
+        Thumbnail URLs for rendering an image attachment, None until thumbnails exist.
+        """
+        if not self.thumbnails:
+            return None
+        sizes = sorted(self.thumbnails, key=int)
+        # Thumbnails are bounded by their longest side, srcset wants their actual width
+        scale = lambda size: round(self.width * min(1, int(size) / max(self.width, self.height)))
+        return {
+            'url': self.thumbnail_url(sizes[0]),
+            'srcset': ', '.join(f"{self.thumbnail_url(size)} {scale(size)}w" for size in sizes),
+            'width': self.width,
+            'height': self.height,
+        }
+
+    def delete_files(self):
+        for name in self.thumbnails.values():
+            self.file.storage.delete(name)
+        self.file.delete(save=False)
+
+    class Meta:
+        db_table = 'chat_attachment'
+        verbose_name = _('attachment')
+        verbose_name_plural = _('attachments')
+
+
+class Message(models.Model):
+    """
+    A chat message. Unlike the other models it does not extend BaseModel: it is the table
+    that grows with traffic, so it only carries the fields the chat protocol uses.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Covered by the (room, timestamp) index
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, db_index=False)
+    # Covered by the (sender, client_id) constraint
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     content = models.TextField(blank=True, null=True)
-    file = models.FileField(upload_to='chat_files/', blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    attachment = models.ForeignKey(
+        Attachment, blank=True, null=True, related_name='messages', on_delete=models.PROTECT
+    )
+    # Assigned when the message object is built so a broadcast can precede the insert
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Chosen by the sending client, a retried send with the same id is not stored twice
+    client_id = models.UUIDField(blank=True, null=True, editable=False)
 
     def __str__(self):
-        return f"{self.sender.email}"
+        return f"{self.sender_id} at {self.timestamp:%Y-%m-%d %H:%M}"
 
     class Meta:
         db_table = 'chat_message'
         verbose_name = _('message')
         verbose_name_plural = _('messages')
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp'], name='chat_message_room_ts_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_id'], name='chat_message_sender_client_uniq'),
+        ]
+
+
+class MessageTombstone(BaseModel):
+    """
+    Records a deleted message so clients catching up after a reconnect can remove it too.
+    Tombstones older than CHAT_SYNC_RETENTION_DAYS are removed by prune_tombstones.
+    """
+    room = models.ForeignKey(ChatRoom, related_name='tombstones', on_delete=models.CASCADE)
+    message_id = models.UUIDField()
+
+    def __str__(self):
+        return f"{self.message_id} in {self.room_id}"
+
+    class Meta:
+        db_table = 'chat_message_tombstone'
+        verbose_name = _('message_tombstone')
+        verbose_name_plural = _('message_tombstones')
+        indexes = [
+            models.Index(fields=['room', 'created_at'], name='chat_tombstone_room_idx'),
+        ]
+
+
+class RoomMembershipManager(models.Manager):
+
+    def ensure_for_room(self, room):
+        self.bulk_create(
+            [self.model(room=room, user_id=room.user1_id), self.model(room=room, user_id=room.user2_id)],
+            ignore_conflicts=True
+        )
+
+    def record_message(self, room, message, count=1):
+        # A new message is unread for the participant who did not send it
+        recipient_id = room.user2_id if message.sender_id == room.user1_id else room.user1_id
+        with transaction.atomic(savepoint=False):
+            updated = self.filter(room=room, user_id=recipient_id).update(unread_count=F('unread_count') + count)
+            if not updated:
+                self.ensure_for_room(room)
+                self.filter(room=room, user_id=recipient_id).update(unread_count=F('unread_count') + count)
+
+    def record_late_messages(self, room, messages):
+        """
+        Count messages of one sender that are stored after they were broadcast. The recipient
+        may have read past some of them in the meantime, those are not unread.
+        """
+        recipient_id = room.user2_id if messages[0].sender_id == room.user1_id else room.user1_id
+        with transaction.atomic(savepoint=False):
+            # Locked so a mark_read cannot slip in between reading the watermark and counting
+            last_read_at = self.select_for_update().filter(
+                room=room, user_id=recipient_id
+            ).values_list('last_read_at', flat=True).first()
+            unread = [message for message in messages if last_read_at is None or message.timestamp > last_read_at]
+            if unread:
+                self.record_message(room, unread[0], count=len(unread))
+
+    def release_message(self, room, message):
+        # Deleting a message above the recipient's read watermark takes it back out of their counter
+        recipient_id = room.user2_id if message.sender_id == room.user1_id else room.user1_id
+        self.filter(
+            Q(last_read_at__isnull=True) | Q(last_read_at__lt=message.timestamp),
+            room=room,
+            user_id=recipient_id,
+            unread_count__gt=0
+        ).update(unread_count=F('unread_count') - 1)
+
+    def mark_read(self, room, user):
+        """
+        Move the user's read watermark in the room to now and return it.
+        """
+        last_read_at = timezone.now()
+        latest_message = Message.objects.filter(room=room).exclude(sender=user).order_by('-timestamp', '-id')
+        updated = self.filter(room=room, user=user).update(
+            unread_count=0,
+            last_read_at=last_read_at,
+            last_read_message=Subquery(latest_message.values('id')[:1])
+        )
+        if not updated:
+            self.ensure_for_room(room)
+            return self.mark_read(room, user)
+        return last_read_at
+
+    def read_watermarks(self, room):
+        return dict(self.filter(room=room).values_list('user_id', 'last_read_at'))
+
+    def with_expected_unread_count(self):
+        """
+        Annotate each membership with the unread count recomputed from the message table.
+        """
+        unread_messages = Message.objects.filter(
+            room=OuterRef('room'),
+            timestamp__gt=OuterRef('watermark')
+        ).exclude(sender=OuterRef('user')).order_by().values('room').annotate(count=Count('id')).values('count')
+
+        return self.annotate(
+            watermark=Coalesce('last_read_at', Value(datetime.min.replace(tzinfo=dt_timezone.utc))),
+        ).annotate(
+            expected_unread_count=Coalesce(Subquery(unread_messages), 0)
+        )
+
+    def find_inconsistent(self):
+        """
+        Return (membership, expected_count) pairs whose stored counter has drifted.
+        """
+        memberships = self.with_expected_unread_count().exclude(unread_count=F('expected_unread_count'))
+        return [(membership, membership.expected_unread_count) for membership in memberships.iterator()]
+
+    def rebuild(self):
+        with transaction.atomic():
+            for room in ChatRoom.objects.only('id', 'user1_id', 'user2_id').iterator():
+                self.ensure_for_room(room)
+
+            inconsistent = self.find_inconsistent()
+            for membership, expected in inconsistent:
+                membership.unread_count = expected
+            self.bulk_update([membership for membership, _ in inconsistent], ['unread_count'], batch_size=500)
+        return len(inconsistent)
+
+
+class RoomMembership(BaseModel):
+    room = models.ForeignKey(ChatRoom, related_name='memberships', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='room_memberships', on_delete=models.CASCADE)
+    unread_count = models.PositiveIntegerField(default=0)
+    # Read watermark: every message from the other participant up to this moment has been read
+    last_read_at = models.DateTimeField(blank=True, null=True)
+    last_read_message = models.ForeignKey(
+        Message, blank=True, null=True, related_name='+', on_delete=models.SET_NULL
+    )
+
+    objects = RoomMembershipManager()
+
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id}"
+
+    class Meta:
+        db_table = 'chat_room_membership'
+        verbose_name = _('room_membership')
+        verbose_name_plural = _('room_memberships')
+        unique_together = ('room', 'user')
+
+
+def archive_storage():
+    return FileSystemStorage(location=settings.CHAT_ARCHIVE_ROOT)
+
+
+def archive_segment_path(instance, filename):
+    return f"{instance.room_id}/{filename}"
+
+
+class ArchiveSegment(BaseModel):
+    """
+    A gzip file of JSON lines holding a run of a room's oldest messages, moved out of
+    chat_message by the archive_messages command. Segments of a room never overlap and are
+    always older than the room's remaining messages. `attachments` maps attachment ids to the
+    number of archived messages that still hold a reference to them.
+    """
+    room = models.ForeignKey(ChatRoom, related_name='archive_segments', on_delete=models.CASCADE)
+    file = models.FileField(upload_to=archive_segment_path, storage=archive_storage, max_length=255)
+    start_timestamp = models.DateTimeField()
+    end_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    attachments = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.room_id} {self.start_timestamp:%Y-%m-%d} - {self.end_timestamp:%Y-%m-%d}"
+
+    class Meta:
+        db_table = 'chat_archive_segment'
+        verbose_name = _('archive_segment')
+        verbose_name_plural = _('archive_segments')
+        indexes = [
+            models.Index(fields=['room', 'end_timestamp'], name='chat_archive_room_end_idx'),
+        ]
+
+
+class UploadSession(BaseModel):
+    """
+    A resumable chunked upload. Chunks are appended to a part file until `received`
+    reaches `size`, the message is only created when the upload is completed. `completed_at`
+    is set by the one request that completes it.
+    """
+    user = models.ForeignKey(User, related_name='upload_sessions', on_delete=models.CASCADE)
+    room = models.ForeignKey(ChatRoom, related_name='upload_sessions', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    checksum = models.CharField(max_length=64, blank=True, null=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+    class Meta:
+        db_table = 'chat_upload_session'
+        verbose_name = _('upload_session')
+        verbose_name_plural = _('upload_sessions')
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Close code of sockets evicted for falling behind, clients reconnect and catch up from their cursor
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Event types that carry state rather than news, with the payload fields naming what the state is
+# about. A queued event is dropped once a newer one about the same thing is queued behind it.
+SUPERSEDED_BY_NEWER = {
+    'user_typing': ('room_id', 'user_id'),
+    'messages_read': ('room_id', 'user_id'),
+    'presence_update': ('user_id',),
+}
+
+
+def supersede_key(payload):
+    fields = SUPERSEDED_BY_NEWER.get(payload['type'])
+    if fields is None:
+        return None
+    return ':'.join([payload['type'], *(str(payload.get(field)) for field in fields)])
+
+
+class OutboundQueue:
+    """
+    Events on their way to one socket, written by a task of their own so that a slow client
+    never holds up the consumer's channel layer receive loop. Queued typing, read and presence
+    events are dropped when a newer one replaces them. A socket whose queue stays above
+    `high_water` events for `slow_timeout` seconds, or reaches `max_size`, is evicted.
+    """
+
+    def __init__(self, write, evict, max_size, high_water, slow_timeout):
+        self.write = write
+        self.evict = evict
+        self.max_size = max_size
+        self.high_water = high_water
+        self.slow_timeout = slow_timeout
+        # Entries are one-item lists so a superseded event can be blanked in place
+        self.entries = deque()
+        self.latest = {}
+        self.depth = 0
+        self.above_since = None
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = asyncio.ensure_future(self.run())
+        _queues.add(self)
+
+    def put(self, event):
+        if self.closed:
+            return
+        key = event.get('supersedes')
+        if key:
+            entry = self.latest.get(key)
+            if entry is not None and entry[0] is not None:
+                entry[0] = None
+                self.depth -= 1
+                _counters['coalesced'] += 1
+
+        entry = [event]
+        self.entries.append(entry)
+        if key:
+            self.latest[key] = entry
+        self.depth += 1
+        if len(self.entries) > 2 * self.max_size:
+            # Blanked entries pile up when a stuck socket keeps getting superseded events
+            self.entries = deque(entry for entry in self.entries if entry[0] is not None)
+        self.idle.clear()
+        self.ready.set()
+        self.check_pressure()
+
+    def check_pressure(self):
+        if self.depth >= self.max_size:
+            self.close(evicted=True)
+        elif self.depth > self.high_water:
+            now = time.monotonic()
+            if self.above_since is None:
+                self.above_since = now
+            elif now - self.above_since >= self.slow_timeout:
+                self.close(evicted=True)
+        else:
+            self.above_since = None
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.entries:
+                entry = self.entries.popleft()
+                event = entry[0]
+                if event is None:
+                    continue
+                entry[0] = None
+                key = event.get('supersedes')
+                if key and self.latest.get(key) is entry:
+                    del self.latest[key]
+                self.depth -= 1
+                if self.depth <= self.high_water:
+                    self.above_since = None
+                try:
+                    await self.write(event)
+                except Exception as e:
+                    logger.warning("ws send failed type=%s error=%r", event['type'], e)
+                    self.close()
+                    return
+            self.idle.set()
+
+    async def flush(self):
+        """
+        Wait until every event queued so far has been written.
+        """
+        if not self.closed:
+            await self.idle.wait()
+
+    def close(self, evicted=False):
+        if self.closed:
+            return
+        depth = self.depth
+        self.closed = True
+        self.entries.clear()
+        self.latest.clear()
+        self.depth = 0
+        self.idle.set()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        if evicted:
+            _counters['evicted'] += 1
+            logger.warning("ws evicting slow consumer depth=%d", depth)
+            asyncio.ensure_future(self.evict())
+
+
+_queues = weakref.WeakSet()
+_counters = {'coalesced': 0, 'evicted': 0}
+
+
+def outbound_stats():
+    depths = [queue.depth for queue in _queues if not queue.closed]
+    return {
+        'sockets': len(depths),
+        'queued': sum(depths),
+        'max_depth': max(depths, default=0),
+        'above_high_water': sum(depth > settings.CHAT_SEND_HIGH_WATER for depth in depths),
+        **_counters,
+    }
+
+
+outbound_queued = Gauge(
+    'chat_ws_outbound_queued', "Events waiting in socket outbound queues",
+    collect=lambda: {(): outbound_stats()['queued']}
+)
+outbound_max_depth = Gauge(
+    'chat_ws_outbound_max_depth', "Events waiting in the longest socket outbound queue",
+    collect=lambda: {(): outbound_stats()['max_depth']}
+)
+outbound_above_high_water = Gauge(
+    'chat_ws_outbound_above_high_water', "Sockets whose outbound queue is above the high-water mark",
+    collect=lambda: {(): outbound_stats()['above_high_water']}
+)
+outbound_superseded = Counter(
+    'chat_ws_outbound_superseded_total', "Queued events dropped because a newer one replaced them",
+    collect=lambda: {(): _counters['coalesced']}
+)
+outbound_evicted = Counter(
+    'chat_ws_outbound_evicted_total', "Sockets closed for falling behind",
+    collect=lambda: {(): _counters['evicted']}
+)
@@ -0,0 +1,157 @@
+import asyncio
+import atexit
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .executors import get_executor
+from .models import Message, RoomMembership
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages. Consumers broadcast a message as soon as it
+    has a server-assigned id and timestamp, then hand it to the writer, which inserts
+    queued messages with bulk_create once `batch_size` are waiting or `flush_interval`
+    seconds have passed. The queue is bounded, so producers wait when the database falls
+    behind instead of buffering without limit.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending, max_retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        # Messages taken off the queue whose batch has not been written yet
+        self.in_flight = []
+        self.task = None
+
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def submit(self, message):
+        self.ensure_running()
+        await self.queue.put(message)
+
+    async def flush(self):
+        """
+        Wait until every message submitted so far has been written.
+        """
+        self.ensure_running()
+        await self.queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self.in_flight = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.write_with_retries(batch)
+            finally:
+                self.in_flight = []
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def write_with_retries(self, batch):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                # No timeout: a batch abandoned mid-write would be inserted twice by the retry
+                await get_executor('critical').run(self.write, batch, timeout=None)
+                return
+            except Exception as e:
+                logger.warning("message write failed attempt=%d messages=%d error=%r", attempt, len(batch), e)
+                await asyncio.sleep(self.flush_interval * attempt)
+        logger.error("message write gave up dropped=%d", len(batch))
+
+    def write(self, batch):
+        batch = self.without_retries(batch)
+
+        # Unread counters move once per (room, sender) instead of once per message
+        per_sender = defaultdict(list)
+        for message in batch:
+            per_sender[(message.room_id, message.sender_id)].append(message)
+
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            for messages in per_sender.values():
+                RoomMembership.objects.record_late_messages(messages[0].room, messages)
+
+    def without_retries(self, batch):
+        # Retries are deduplicated by the consumer within a process, one that reached another
+        # process after the first attempt was written would violate the client id constraint
+        keys = {(message.sender_id, message.client_id) for message in batch if message.client_id}
+        if not keys:
+            return batch
+        stored = set(Message.objects.filter(
+            sender_id__in={sender_id for sender_id, _ in keys},
+            client_id__in={client_id for _, client_id in keys}
+        ).values_list('sender_id', 'client_id'))
+
+        unique = []
+        for message in batch:
+            if message.client_id:
+                key = (message.sender_id, message.client_id)
+                if key in stored:
+                    continue
+                stored.add(key)
+            unique.append(message)
+        return unique
+
+    def flush_sync(self):
+        """
+        Persist whatever is still queued when the process exits without an event loop.
+        """
+        batch, self.in_flight = self.in_flight, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+            self.queue.task_done()
+        if batch:
+            self.write(batch)
+
+
+_writer = None
+
+
+def get_message_writer():
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(
+            batch_size=settings.CHAT_WRITE_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_FLUSH_INTERVAL,
+            max_pending=settings.CHAT_WRITE_MAX_PENDING
+        )
+        atexit.register(_writer.flush_sync)
+    return _writer
+
+
+async def lifespan(scope, receive, send):
+    # ASGI servers that speak the lifespan protocol get a clean flush on shutdown
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _writer is not None:
+                await _writer.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from .codecs import encode_event
+from .executors import run_in_executor
+from .metrics import layer_send_seconds
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = "presence"
+
+# Decrements and drops the key once it reaches zero in one step, so an incr from another
+# process cannot land between the two and have its count deleted. A remaining count gets its
+# expiry renewed for the sockets still open.
+DECR_AND_RELEASE = """
+local count = redis.call('DECR', KEYS[1])
+if count <= 0 then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return count
+"""
+
+
+class InMemoryConnectionCounter:
+    """
+    Open sockets per user, only visible to the current process.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    async def incr(self, user_id):
+        self.counts[user_id] += 1
+        return self.counts[user_id]
+
+    async def decr(self, user_id):
+        self.counts[user_id] -= 1
+        if self.counts[user_id] <= 0:
+            del self.counts[user_id]
+            return 0
+        return self.counts[user_id]
+
+    async def get(self, user_id):
+        return self.counts.get(user_id, 0)
+
+    async def touch(self, user_ids):
+        pass
+
+
+class RedisConnectionCounter:
+    """
+    Open sockets per user shared by every process using the same Redis server.
+    """
+
+    def __init__(self, url, ttl):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url)
+        # Keys expire so counts left behind by a crashed process cannot pin a user online forever
+        self.ttl = ttl
+
+    def key(self, user_id):
+        return f"presence:{user_id}"
+
+    async def incr(self, user_id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            count, _ = await pipe.incr(self.key(user_id)).expire(self.key(user_id), self.ttl).execute()
+        return count
+
+    async def decr(self, user_id):
+        return await self.redis.eval(DECR_AND_RELEASE, 1, self.key(user_id), self.ttl)
+
+    async def get(self, user_id):
+        return int(await self.redis.get(self.key(user_id)) or 0)
+
+    async def touch(self, user_ids):
+        """
+        Renew the expiry of users whose sockets are still open.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.expire(self.key(user_id), self.ttl)
+            await pipe.execute()
+
+
+class PresenceRegistry:
+    """
+    Reference-counts WebSocket connections per user so a user only goes offline when their
+    last socket closes, waits out a grace period before announcing it so reconnects do not
+    flap, and writes is_online/last_seen to the database in periodic batches. Every
+    `touch_interval` seconds it renews the shared counts of the users connected to this process,
+    so long-lived sockets outlast the counter's expiry.
+    """
+
+    def __init__(self, counter, offline_grace, flush_interval, touch_interval=None):
+        self.counter = counter
+        self.offline_grace = offline_grace
+        self.flush_interval = flush_interval
+        self.touch_interval = touch_interval
+        self.touched_at = time.monotonic()
+        # Open sockets per user in this process
+        self.local = defaultdict(int)
+        self.pending = {}
+        self.offline_tasks = {}
+        self.flush_task = None
+
+    async def connect(self, user_id):
+        self.ensure_flushing()
+        self.local[user_id] += 1
+        count = await self.counter.incr(user_id)
+
+        offline_task = self.offline_tasks.pop(user_id, None)
+        if offline_task:
+            # Reconnected within the grace period, the user never appeared offline
+            offline_task.cancel()
+        elif count == 1:
+            await self.set_status(user_id, True)
+
+    async def disconnect(self, user_id):
+        self.local[user_id] -= 1
+        if self.local[user_id] <= 0:
+            del self.local[user_id]
+        count = await self.counter.decr(user_id)
+        if count == 0 and user_id not in self.offline_tasks:
+            self.offline_tasks[user_id] = asyncio.ensure_future(self.go_offline(user_id))
+
+    async def go_offline(self, user_id):
+        try:
+            await asyncio.sleep(self.offline_grace)
+            # Another process may have picked the user up again meanwhile
+            if await self.counter.get(user_id) == 0:
+                await self.set_status(user_id, False)
+        finally:
+            if self.offline_tasks.get(user_id) is asyncio.current_task():
+                del self.offline_tasks[user_id]
+
+    async def set_status(self, user_id, is_online):
+        last_seen = timezone.now()
+        self.pending[user_id] = is_online
+        # Encoded for both wire formats, multiplexed chat sockets may speak msgpack
+        with layer_send_seconds.time('presence_update'):
+            await get_channel_layer().group_send(PRESENCE_GROUP, encode_event({
+                'type': 'presence_update',
+                'user_id': str(user_id),
+                'is_online': is_online,
+                'last_seen': last_seen.isoformat()
+            }))
+
+    def ensure_flushing(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            await self.touch()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await self.write_statuses(pending)
+        except Exception as e:
+            # Keep the batch for the next flush unless newer statuses replaced it
+            self.pending = {**pending, **self.pending}
+            logger.warning("presence flush failed users=%d error=%r", len(pending), e)
+
+    async def touch(self):
+        if self.touch_interval is None or time.monotonic() - self.touched_at < self.touch_interval:
+            return
+        self.touched_at = time.monotonic()
+        try:
+            await self.counter.touch(list(self.local))
+        except Exception as e:
+            logger.warning("presence touch failed users=%d error=%r", len(self.local), e)
+
+    @run_in_executor('bulk')
+    def write_statuses(self, pending):
+        now = timezone.now()
+        online_ids = [user_id for user_id, is_online in pending.items() if is_online]
+        offline_ids = [user_id for user_id, is_online in pending.items() if not is_online]
+        if online_ids:
+            User.objects.filter(id__in=online_ids).update(is_online=True, last_seen=now)
+        if offline_ids:
+            User.objects.filter(id__in=offline_ids).update(is_online=False, last_seen=now)
+
+
+_registry = None
+
+
+def get_presence_registry():
+    global _registry
+    if _registry is None:
+        touch_interval = None
+        if settings.PRESENCE_BACKEND == 'redis':
+            counter = RedisConnectionCounter(settings.REDIS_URL, settings.PRESENCE_REDIS_TTL)
+            # Renewed several times per expiry, one missed touch does not drop anyone
+            touch_interval = settings.PRESENCE_REDIS_TTL / 3
+        else:
+            counter = InMemoryConnectionCounter()
+        _registry = PresenceRegistry(
+            counter,
+            offline_grace=settings.PRESENCE_OFFLINE_GRACE,
+            flush_interval=settings.PRESENCE_FLUSH_INTERVAL,
+            touch_interval=touch_interval
+        )
+    return _registry
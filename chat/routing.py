@@ -1,7 +1,9 @@
 from django.urls import re_path
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, PresenceConsumer, UserConsumer
 
 websocket_urlpatterns = [
+    re_path(r'^ws/chat/$', UserConsumer.as_asgi()),
     re_path(r'^ws/chat/(?P<room_id>[a-f0-9-]+)/$', ChatConsumer.as_asgi()),
+    re_path(r'^ws/presence/$', PresenceConsumer.as_asgi()),
 ]
 
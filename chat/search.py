@@ -0,0 +1,171 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import ChatRoom, Message
+
+# Highlight markers that cannot occur in user text, swapped for <mark> after escaping
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+# SQLite keeps an external-content FTS5 table in step with chat_message through triggers.
+# The index is keyed on the implicit rowid, as the primary key is a UUID. Rebuilding chat_message
+# (e.g. a migration that alters it on SQLite) drops the triggers and renumbers rows, so such
+# migrations must call create_search_index again. VACUUM may renumber the rows too, it must be
+# followed by rebuild_search_index.
+SQLITE_REBUILD = "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')"
+
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+        content, content='chat_message', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.rowid, new.content);
+    END
+    """,
+    SQLITE_REBUILD,
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+# PostgreSQL needs no sync, the GIN index covers the expression search_postgresql queries
+POSTGRES_CREATE = [
+    """
+    CREATE INDEX IF NOT EXISTS chat_message_search_idx ON chat_message
+    USING gin (to_tsvector('simple'::regconfig, COALESCE(content, '')))
+    """,
+]
+
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS chat_message_search_idx",
+]
+
+
+def create_search_index(schema_editor):
+    statements = {'sqlite': SQLITE_CREATE, 'postgresql': POSTGRES_CREATE}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def drop_search_index(schema_editor):
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def rebuild_search_index(connection):
+    """
+    Re-read every message into the SQLite index, after a VACUUM has renumbered the rows.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(SQLITE_REBUILD)
+
+
+def highlight(snippet):
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def search_messages(user, query, page=1):
+    """
+    Return (messages, has_next) for one page of the user's messages matching `query`, best
+    match first. Each message carries a `snippet` with the matched terms in <mark>.
+    """
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return [], False
+
+    page_size = settings.CHAT_SEARCH_PAGE_SIZE
+    offset = (max(page, 1) - 1) * page_size
+    rooms = ChatRoom.objects.filter(Q(user1=user) | Q(user2=user)).values('id')
+
+    search = {
+        'sqlite': search_sqlite,
+        'postgresql': search_postgresql,
+    }.get(connection.vendor, search_scan)
+    messages = search(terms, rooms, offset, page_size + 1)
+
+    for message in messages:
+        message.snippet = highlight(message.snippet)
+    return messages[:page_size], len(messages) > page_size
+
+
+def search_sqlite(terms, rooms, offset, limit):
+    # Every term must match, the last one as a prefix so partial words find results
+    match = ' '.join('"%s"' % term.replace('"', '""') for term in terms) + '*'
+    rooms_sql, rooms_params = rooms.query.sql_with_params()
+    sql = f"""
+        SELECT m.*, snippet(chat_message_fts, 0, %s, %s, '…', 12) AS snippet, bm25(chat_message_fts) AS rank
+        FROM chat_message_fts
+        JOIN chat_message m ON m.rowid = chat_message_fts.rowid
+        WHERE chat_message_fts MATCH %s AND m.room_id IN ({rooms_sql})
+        ORDER BY rank, m.timestamp DESC
+        LIMIT %s OFFSET %s
+    """
+    params = [MARK_START, MARK_END, match, *rooms_params, limit, offset]
+    return list(Message.objects.raw(sql, params).prefetch_related('sender', 'room__user1', 'room__user2'))
+
+
+def search_postgresql(terms, rooms, offset, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+    vector = SearchVector('content', config='simple')
+    # Terms are plain words, so they can be quoted into a raw tsquery with a prefix on the last one
+    search_query = SearchQuery(
+        ' & '.join("'%s'" % term.lower() for term in terms) + ':*', config='simple', search_type='raw'
+    )
+    messages = Message.objects.annotate(search=vector).filter(search=search_query, room__in=rooms).annotate(
+        rank=SearchRank(vector, search_query)
+    ).select_related('sender', 'room__user1', 'room__user2').order_by('-rank', '-timestamp')
+    messages = list(messages[offset:offset + limit])
+    # ts_headline drops anything that looks like markup, so snippets are cut in Python
+    for message in messages:
+        message.snippet = make_snippet(message.content, terms)
+    return messages
+
+
+def search_scan(terms, rooms, offset, limit):
+    # Databases without a full-text index fall back to a scan, newest first
+    messages = Message.objects.filter(room__in=rooms).select_related('sender', 'room__user1', 'room__user2')
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    messages = list(messages.order_by('-timestamp')[offset:offset + limit])
+    for message in messages:
+        message.snippet = make_snippet(message.content, terms)
+    return messages
+
+
+def make_snippet(content, terms, context=60):
+    """
+    Cut `content` around the first matched term and wrap every match in highlight markers.
+    """
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    first = pattern.search(content)
+    start = max(first.start() - context, 0) if first else 0
+    end = start + 3 * context
+    snippet = content[start:end]
+    snippet = pattern.sub(lambda match: MARK_START + match.group() + MARK_END, snippet)
+    return ('…' if start else '') + snippet + ('…' if end < len(content) else '')
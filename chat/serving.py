@@ -0,0 +1,137 @@
+import mimetypes
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header, parse_etags, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Read size when streaming to ASGI servers, each block is one thread hop
+STREAM_BLOCK_SIZE = 256 * 1024
+
+
+class RangeFile:
+    """
+    Read-only view of `length` bytes of an open file starting at `start`.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Return the (start, end) byte positions of a single-range Range header, None when the
+    header is absent or not understood so the whole file is sent. Raises ValueError for
+    a range that lies outside the file.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def serve_file(request, storage, name, etag, filename=None, as_attachment=False, content_type=None):
+    """
+    Return a response for the stored file `name` that honours If-None-Match, If-Range and single
+    byte ranges. With CHAT_MEDIA_ACCEL_REDIRECT set the body is left to the front proxy.
+    """
+    etag = quote_etag(etag)
+    content_type = content_type or mimetypes.guess_type(filename or name)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': etag,
+        # Contents never change for a given URL, but only participants may see them
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+        # Uploaded content comes from the other participant, a file opened in the browser must
+        # not run scripts on this origin nor be sniffed into something that does
+        'Content-Security-Policy': 'sandbox',
+        'X-Content-Type-Options': 'nosniff',
+    }
+
+    if etag in parse_etags(request.headers.get('If-None-Match', '')) or request.headers.get('If-None-Match') == '*':
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if settings.CHAT_MEDIA_ACCEL_REDIRECT:
+        # nginx serves the file from an internal location, including Range requests
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Accel-Redirect'] = settings.CHAT_MEDIA_ACCEL_REDIRECT.rstrip('/') + '/' + name
+        set_disposition(response, filename, as_attachment)
+        return response
+
+    size = storage.size(name)
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1
+    handle = storage.open(name, 'rb')
+    status = 200 if byte_range is None else 206
+    if isinstance(request, ASGIRequest):
+        # Django consumes a synchronous iterator into memory before serving it over ASGI
+        response = StreamingHttpResponse(
+            stream_file(handle, start, length), status=status, content_type=content_type, headers=headers
+        )
+    elif byte_range is None:
+        # WSGI servers send whole files with wsgi.file_wrapper, usually via sendfile()
+        response = FileResponse(handle, content_type=content_type, headers=headers)
+    else:
+        response = FileResponse(RangeFile(handle, start, length), status=status, content_type=content_type, headers=headers)
+    response['Content-Length'] = length
+    if byte_range is not None:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    set_disposition(response, filename, as_attachment)
+    return response
+
+
+async def stream_file(handle, start, length):
+    read = sync_to_async(handle.read, thread_sensitive=False)
+    try:
+        await sync_to_async(handle.seek, thread_sensitive=False)(start)
+        while length > 0:
+            block = await read(min(STREAM_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        handle.close()
+
+
+def set_disposition(response, filename, as_attachment):
+    if filename:
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
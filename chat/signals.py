@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caches import room_participants
+from .models import ArchiveSegment, Attachment, ChatRoom, Message
+
+
+@receiver(post_delete, sender=ChatRoom)
+def forget_room_participants(sender, instance, **kwargs):
+    room_participants.delete(str(instance.id))
+
+
+@receiver(post_save, sender=Message)
+def acquire_attachment(sender, instance, created, **kwargs):
+    if created and instance.attachment_id:
+        Attachment.objects.filter(id=instance.attachment_id).update(
+            ref_count=F('ref_count') + 1, updated_at=timezone.now()
+        )
+
+
+@receiver(post_delete, sender=Message)
+def release_attachment(sender, instance, **kwargs):
+    # The blob itself is removed later by gc_attachments
+    if instance.attachment_id:
+        Attachment.objects.filter(id=instance.attachment_id).update(
+            ref_count=F('ref_count') - 1, updated_at=timezone.now()
+        )
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def release_archive_segment(sender, instance, **kwargs):
+    for attachment_id, count in instance.attachments.items():
+        Attachment.objects.filter(id=attachment_id).update(
+            ref_count=F('ref_count') - count, updated_at=timezone.now()
+        )
+    transaction.on_commit(lambda: instance.file.delete(save=False))
@@ -0,0 +1,181 @@
+import base64
+import bisect
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .caches import room_events
+from .codecs import encode_room_event
+from .history import MESSAGE_FIELDS, apply_read_state, serialize_message
+from .models import Message, MessageTombstone, RoomMembership
+
+
+class InMemorySequencer:
+    """
+    Event sequence numbers per room, only consistent within the current process.
+    """
+
+    def __init__(self):
+        self.values = defaultdict(int)
+
+    async def next(self, room_id):
+        self.values[room_id] += 1
+        return self.values[room_id]
+
+    async def current(self, room_id):
+        return self.values.get(room_id, 0)
+
+
+class RedisSequencer:
+    """
+    Event sequence numbers per room shared by every process using the same Redis server.
+    """
+
+    def __init__(self, url):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url)
+
+    def key(self, room_id):
+        return f"sync:seq:{room_id}"
+
+    async def next(self, room_id):
+        return await self.redis.incr(self.key(room_id))
+
+    async def current(self, room_id):
+        return int(await self.redis.get(self.key(room_id)) or 0)
+
+
+_sequencer = None
+
+
+def get_sequencer():
+    global _sequencer
+    if _sequencer is None:
+        if settings.CHAT_SYNC_BACKEND == 'redis':
+            _sequencer = RedisSequencer(settings.REDIS_URL)
+        else:
+            _sequencer = InMemorySequencer()
+    return _sequencer
+
+
+def encode_sync_cursor(seq, at):
+    # The cursor is the last sequence number a client has seen and when it was assigned
+    raw = f"{seq}|{at.isoformat()}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_sync_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        seq, at = raw.split('|', 1)
+        seq = int(seq)
+        at = parse_datetime(at)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid sync cursor")
+    if at is None or seq < 0:
+        raise ValueError("Invalid sync cursor")
+    return seq, at
+
+
+class RoomEventBuffer:
+    """
+    The last `size` sequenced events of a room seen by this process, in sequence order.
+    Events can arrive out of order from the channel layer and once per local socket, so
+    they are inserted by sequence number and duplicates are ignored.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.seqs = []
+        self.events = []
+
+    def add(self, seq, event):
+        index = bisect.bisect_left(self.seqs, seq)
+        if index < len(self.seqs) and self.seqs[index] == seq:
+            return
+        if index == 0 and len(self.seqs) >= self.size:
+            return
+        self.seqs.insert(index, seq)
+        self.events.insert(index, event)
+        if len(self.seqs) > self.size:
+            del self.seqs[0], self.events[0]
+
+    def since(self, seq, current):
+        """
+        Return the events after `seq` up to `current`, or None unless all of them are buffered.
+        """
+        start = bisect.bisect_right(self.seqs, seq)
+        end = bisect.bisect_right(self.seqs, current)
+        # Sequence numbers are unique, so the right count and last number means no gaps
+        if end - start != current - seq or (end > start and self.seqs[end - 1] != current):
+            return None
+        return self.events[start:end]
+
+
+async def sequence_event(room_id, payload):
+    """
+    Stamp a room event with the room's next sequence number and a cursor pointing at it,
+    and encode it for the channel layer.
+    """
+    seq = await get_sequencer().next(room_id)
+    event = encode_room_event(room_id, {**payload, 'seq': seq, 'cursor': encode_sync_cursor(seq, timezone.now())})
+    event['seq'] = seq
+    return event
+
+
+def record_event(room_id, event):
+    buffer = room_events.get(room_id)
+    if buffer is None:
+        buffer = RoomEventBuffer(settings.CHAT_SYNC_BUFFER_SIZE)
+    buffer.add(event['seq'], event)
+    # Set again so the buffer of an active room does not expire
+    room_events.set(room_id, buffer)
+
+
+def buffered_events(room_id, seq, current):
+    if seq > current:
+        # The sequence was reset (in-memory sequencer after a restart), the buffer cannot tell
+        return None
+    if seq == current:
+        return []
+    buffer = room_events.get(room_id)
+    return buffer.since(seq, current) if buffer else None
+
+
+def missed_events(room, since_at):
+    """
+    Rebuild the events of `room` after `since_at` from the database: messages, tombstones of
+    deleted messages and the current read watermarks. Returns None when the gap is too old
+    or too large to replay, the client then has to reload the room.
+    """
+    now = timezone.now()
+    if since_at < now - timedelta(days=settings.CHAT_SYNC_RETENTION_DAYS):
+        return None
+    since_at -= timedelta(seconds=settings.CHAT_SYNC_MARGIN)
+
+    messages = list(
+        Message.objects.filter(room=room, timestamp__gt=since_at)
+        .select_related('sender', 'attachment').only(*MESSAGE_FIELDS)
+        .order_by('timestamp', 'id')[:settings.CHAT_SYNC_MAX_MESSAGES + 1]
+    )
+    if len(messages) > settings.CHAT_SYNC_MAX_MESSAGES:
+        return None
+    apply_read_state(room, messages)
+
+    events = [{'type': 'chat_message', **serialize_message(message)} for message in messages]
+    events += [
+        {'type': 'message_deleted', 'message_id': str(message_id)}
+        for message_id in MessageTombstone.objects.filter(
+            room=room, created_at__gt=since_at
+        ).values_list('message_id', flat=True)
+    ]
+    events += [
+        {'type': 'messages_read', 'user_id': str(user_id), 'last_read_at': last_read_at.isoformat()}
+        for user_id, last_read_at in RoomMembership.objects.read_watermarks(room).items()
+        if last_read_at is not None
+    ]
+    return [encode_room_event(room.id, event) for event in events]
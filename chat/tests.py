@@ -1,3 +1,824 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from importlib.util import find_spec
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import re_path, reverse
+from django.utils import timezone
+
+from accounts.models import User
+from .caches import room_events, room_participants, sent_messages
+from .consumers import RoomChannel, UserConsumer, get_member_room
+from .executors import get_executor
+from .models import Attachment, ChatRoom, Message, RoomMembership, RoomMembershipManager, UploadSession
+from .pipeline import MessageWriter
+from .uploads import file_checksum, part_path
+from .routing import websocket_urlpatterns
+from .search import search_messages
+from .thumbnails import process_attachment
+
+application = URLRouter(websocket_urlpatterns)
+
+
+def create_room(test):
+    test.alice = User.objects.create_user('Alice', 'A', 'alice@example.com', 'password', username='alice')
+    test.bob = User.objects.create_user('Bob', 'B', 'bob@example.com', 'password', username='bob')
+    user1, user2 = sorted([test.alice, test.bob], key=lambda u: str(u.id))
+    test.room = ChatRoom.objects.create(user1=user1, user2=user2)
+    RoomMembership.objects.ensure_for_room(test.room)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ChatSocketTestCase(TransactionTestCase):
+    """
+    Two users sharing a room, talking over sockets. Socket handlers query the database from
+    executor threads, which only see committed rows, hence TransactionTestCase.
+    """
+
+    def setUp(self):
+        room_participants.clear()
+        sent_messages.clear()
+        room_events.clear()
+        create_room(self)
+
+    async def open_socket(self, user, path='/ws/chat/', app=application):
+        communicator = WebsocketCommunicator(app, path, subprotocols=['json'])
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def close_socket(self, communicator):
+        try:
+            await communicator.disconnect()
+        except asyncio.CancelledError:
+            pass
+
+    async def send(self, communicator, **frame):
+        frame.setdefault('room_id', str(self.room.id))
+        await communicator.send_to(text_data=json.dumps(frame))
+
+    async def drain(self, communicator, wait=0.3):
+        """
+        Return the frames the socket sends until it stays quiet for `wait` seconds.
+        """
+        frames = []
+        while not await communicator.receive_nothing(wait):
+            frames.append(json.loads(await communicator.receive_from()))
+        return frames
+
+    def of_type(self, frames, frame_type):
+        return [frame for frame in frames if frame['type'] == frame_type]
+
+
+class SyncCursorTests(ChatSocketTestCase):
+
+    async def test_page_cursor_replays_nothing_already_rendered(self):
+        bob = await self.open_socket(self.bob)
+        await self.send(bob, type='subscribe')
+        for n in range(3):
+            await self.send(bob, type='chat_message', message=f"message {n}")
+        self.assertEqual(len(self.of_type(await self.drain(bob), 'chat_message')), 3)
+
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse('chat_room', args=[self.bob.id]))
+        self.assertEqual(len(response.context['chat_messages']), 3)
+
+        alice = await self.open_socket(self.alice)
+        await self.send(alice, type='subscribe', since=response.context['sync_cursor'])
+        frames = await self.drain(alice)
+        self.assertEqual(self.of_type(frames, 'chat_message'), [])
+        self.assertEqual(len(self.of_type(frames, 'synced')), 1)
+
+        await self.close_socket(alice)
+        await self.close_socket(bob)
+
+
+class SubscribeReadTests(ChatSocketTestCase):
+
+    def unread_count(self, user):
+        return RoomMembership.objects.filter(room=self.room, user=user).values_list('unread_count', flat=True).aget()
+
+    async def test_only_subscribe_with_read_marks_the_room_read(self):
+        alice = await self.open_socket(self.alice)
+        await self.send(alice, type='subscribe')
+        for n in range(3):
+            await self.send(alice, type='chat_message', message=f"message {n}")
+        await self.drain(alice)
+
+        # A sidebar subscription keeps the unread badge
+        bob = await self.open_socket(self.bob)
+        await self.send(bob, type='subscribe')
+        await self.drain(bob)
+        self.assertEqual(await self.unread_count(self.bob), 3)
+        await self.send(bob, type='unsubscribe')
+
+        # The open room page asks for it
+        await self.send(bob, type='subscribe', read=True)
+        self.assertEqual(len(self.of_type(await self.drain(alice), 'messages_read')), 1)
+        self.assertEqual(await self.unread_count(self.bob), 0)
+
+        await self.close_socket(alice)
+        await self.close_socket(bob)
+
+    async def test_room_socket_marks_the_room_read_on_connect(self):
+        alice = await self.open_socket(self.alice)
+        await self.send(alice, type='subscribe')
+        await self.send(alice, type='chat_message', message="hello")
+        await self.drain(alice)
+
+        bob = await self.open_socket(self.bob, f'/ws/chat/{self.room.id}/')
+        await self.drain(bob)
+        self.assertEqual(await self.unread_count(self.bob), 0)
+
+        await self.close_socket(alice)
+        await self.close_socket(bob)
+
+
+class IdempotentSendTests(ChatSocketTestCase):
+    """
+    Every fifth send loses its ack and is retried, half of those on a process that never saw
+    the first attempt. benchmarks/idempotent_send.py runs the same replay with 10k sends.
+    """
+
+    sends = 1000
+    # Generous for a loaded CI machine, a send is acked in a few milliseconds
+    max_p99_latency = 1.0
+
+    async def test_retried_sends_are_stored_once_and_acked(self):
+        retries = 0
+        alice = await self.open_socket(self.alice)
+        await self.send(alice, type='subscribe')
+        await self.drain(alice)
+
+        acks = defaultdict(list)
+        latencies = []
+
+        async def send_and_wait(n, client_id):
+            await self.send(alice, type='chat_message', message=f"message {n}", client_id=client_id)
+            while True:
+                frame = json.loads(await alice.receive_from(timeout=5))
+                if frame['type'] == 'ack':
+                    self.assertEqual(frame['client_id'], client_id)
+                    acks[client_id].append(frame)
+                    return
+
+        for n in range(self.sends):
+            client_id = str(uuid.uuid4())
+            started = time.monotonic()
+            await send_and_wait(n, client_id)
+            if n % 5 == 0:
+                # The ack never reached the client, it sends the message again
+                retries += 1
+                if n % 10 == 0:
+                    # A retry reaching a process that never saw the first attempt
+                    sent_messages.clear()
+                await send_and_wait(n, client_id)
+            latencies.append(time.monotonic() - started)
+        await self.drain(alice)
+        await self.close_socket(alice)
+
+        messages = Message.objects.filter(room=self.room)
+        self.assertEqual(await messages.acount(), self.sends)
+        duplicates = messages.values('sender', 'client_id').annotate(rows=Count('id')).filter(rows__gt=1)
+        self.assertEqual(await duplicates.acount(), 0)
+        self.assertEqual(len(acks), self.sends)
+        for client_id, frames in acks.items():
+            self.assertEqual(len({frame['message_id'] for frame in frames}), 1)
+            self.assertEqual([frame['duplicate'] for frame in frames], [False, True][:len(frames)])
+        self.assertEqual(sum(len(frames) == 2 for frames in acks.values()), retries)
+        self.assertEqual(await RoomMembership.objects.filter(user=self.bob, unread_count=self.sends).acount(), 1)
+
+        # Time until the client holds the ack it keeps, including the retry for lost ones
+        latencies.sort()
+        self.assertLess(latencies[int(len(latencies) * 0.99)], self.max_p99_latency)
+
+
+class ExecutorIsolationTests(ChatSocketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Read marking blocks in its bulk pool thread until released
+        self.release = threading.Event()
+        mark_read = RoomMembershipManager.mark_read
+
+        def slow_mark_read(manager, room, user):
+            self.release.wait(10)
+            return mark_read(manager, room, user)
+
+        self.slow_mark_read = mock.patch.object(RoomMembershipManager, 'mark_read', slow_mark_read)
+
+    async def open_room_sockets(self, *users):
+        sockets = []
+        for user in users:
+            communicator = await self.open_socket(user)
+            await self.send(communicator, type='subscribe')
+            await self.drain(communicator)
+            sockets.append(communicator)
+        return sockets
+
+    async def close_sockets(self, sockets):
+        self.release.set()
+        # Let the released threads finish before the test database is flushed
+        while get_executor('bulk').stats()['running']:
+            await asyncio.sleep(0.01)
+        for communicator in sockets:
+            await self.close_socket(communicator)
+
+    async def test_slow_read_marking_does_not_delay_acks(self):
+        # One stuck read marking per bulk pool thread
+        workers = get_executor('bulk').max_workers
+        alice, *bobs = await self.open_room_sockets(self.alice, *[self.bob] * workers)
+        with self.slow_mark_read:
+            for bob in bobs:
+                await self.send(bob, type='mark_read')
+            await asyncio.sleep(0.1)
+            self.assertEqual(get_executor('bulk').stats()['running'], workers)
+
+            started = time.monotonic()
+            await self.send(alice, type='chat_message', message="hello", client_id=str(uuid.uuid4()))
+            while True:
+                frame = json.loads(await alice.receive_from(timeout=5))
+                if frame['type'] == 'ack':
+                    break
+            self.assertLess(time.monotonic() - started, 1)
+            # The read marking is still running
+            self.assertEqual(get_executor('bulk').stats()['running'], workers)
+            await self.close_sockets([alice, *bobs])
+
+    async def test_timeout_is_reported_as_error_frame(self):
+        alice, bob = await self.open_room_sockets(self.alice, self.bob)
+        with self.slow_mark_read, mock.patch.object(get_executor('bulk'), 'timeout', 0.2):
+            await self.send(bob, type='mark_read')
+            frame = json.loads(await bob.receive_from(timeout=5))
+            self.assertEqual(frame['type'], 'error')
+            self.assertEqual(frame['code'], 'timeout')
+            self.assertEqual(frame['request'], 'mark_read')
+            await self.close_sockets([alice, bob])
+
+
+class PresenceSubscriptionTests(ChatSocketTestCase):
+
+    async def connect_new_user(self, name):
+        user = await sync_to_async(User.objects.create_user)(
+            name, name, f'{name}@example.com', 'password', username=name
+        )
+        return user, await self.open_socket(user)
+
+    async def test_presence_only_reaches_subscribed_sockets(self):
+        alice = await self.open_socket(self.alice)
+        await self.drain(alice)
+
+        carol, carol_socket = await self.connect_new_user('carol')
+        self.assertEqual(self.of_type(await self.drain(alice), 'presence_update'), [])
+
+        await self.send(alice, type='subscribe_presence')
+        dave, dave_socket = await self.connect_new_user('dave')
+        updates = self.of_type(await self.drain(alice), 'presence_update')
+        self.assertEqual([(update['user_id'], update['is_online']) for update in updates], [(str(dave.id), True)])
+
+        await self.send(alice, type='unsubscribe_presence')
+        erin, erin_socket = await self.connect_new_user('erin')
+        self.assertEqual(self.of_type(await self.drain(alice), 'presence_update'), [])
+
+        for socket in (alice, carol_socket, dave_socket, erin_socket):
+            await self.close_socket(socket)
+
+
+class TypingTests(ChatSocketTestCase):
+
+    @override_settings(CHAT_TYPING_TIMEOUT=0.5)
+    async def test_typing_frames_are_coalesced(self):
+        alice = await self.open_socket(self.alice)
+        bob = await self.open_socket(self.bob)
+        for communicator in (alice, bob):
+            await self.send(communicator, type='subscribe')
+            await self.drain(communicator)
+
+        for _ in range(20):
+            await self.send(alice, type='typing', typing=True)
+        frames = self.of_type(await self.drain(bob, wait=0.2), 'user_typing')
+        self.assertEqual([frame['typing'] for frame in frames], [True])
+
+        # No stop frame from the client, the server expires the indicator
+        frames = self.of_type(await self.drain(bob, wait=1), 'user_typing')
+        self.assertEqual([frame['typing'] for frame in frames], [False])
+        self.assertEqual(frames[0]['user_id'], str(self.alice.id))
+
+        await self.close_socket(alice)
+        await self.close_socket(bob)
+
+    @override_settings(CHAT_TYPING_MIN_INTERVAL=5)
+    async def test_typing_after_a_sent_message_is_shown_at_once(self):
+        alice = await self.open_socket(self.alice)
+        bob = await self.open_socket(self.bob)
+        for communicator in (alice, bob):
+            await self.send(communicator, type='subscribe')
+            await self.drain(communicator)
+
+        await self.send(alice, type='typing', typing=True)
+        await self.send(alice, type='chat_message', message="hello")
+        await self.send(alice, type='typing', typing=True)
+        frames = self.of_type(await self.drain(bob), 'user_typing')
+        self.assertEqual([frame['typing'] for frame in frames], [True, False, True])
+
+        # A client flapping between stop and start frames is still held back
+        await self.send(alice, type='typing', typing=False)
+        await self.send(alice, type='typing', typing=True)
+        frames = self.of_type(await self.drain(bob), 'user_typing')
+        self.assertEqual([frame['typing'] for frame in frames], [False])
+
+        await self.close_socket(alice)
+        await self.close_socket(bob)
+
+
+class AttachmentReadyTests(ChatSocketTestCase):
+
+    async def test_thumbnail_worker_announces_on_the_server_loop(self):
+        from PIL import Image
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        image = BytesIO()
+        Image.new('RGB', (640, 480), 'red').save(image, 'PNG')
+        image.name = 'photo.png'
+        image.seek(0)
+
+        bob = await self.open_socket(self.bob)
+        await self.send(bob, type='subscribe')
+        await self.drain(bob)
+
+        # The view runs in a thread of the test's loop, the worker thread has to send through
+        # that loop, where the layer's queues and connections live
+        layer = get_channel_layer()
+        group_send = layer.group_send
+        loops = []
+
+        async def recording_group_send(group, message):
+            loops.append(asyncio.get_running_loop())
+            await group_send(group, message)
+
+        with self.settings(MEDIA_ROOT=temp_dir.name, CHAT_THUMBNAIL_SIZES=[320]), \
+                mock.patch.object(layer, 'group_send', recording_group_send):
+            await self.async_client.aforce_login(self.alice)
+            response = await self.async_client.post(reverse('upload_file'), {'room_id': self.room.id, 'file': image})
+            self.assertIsNone(response.json()['preview'])
+            frames = self.of_type(await self.drain(bob, wait=2), 'attachment_ready')
+
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]['message_id'], response.json()['message_id'])
+        self.assertEqual(frames[0]['preview']['width'], 640)
+        self.assertEqual(set(loops), {asyncio.get_running_loop()})
+
+        await self.close_socket(bob)
+
+
+class RemoteUserConsumer(UserConsumer):
+    # The same consumer on a channel layer instance of its own, like a second worker process
+    channel_layer_alias = 'remote'
+
+
+remote_application = URLRouter([re_path(r'^ws/chat/$', RemoteUserConsumer.as_asgi())])
+
+
+@skipUnless(find_spec('fakeredis'), "fakeredis is not installed")
+class CrossProcessDeliveryTests(ChatSocketTestCase):
+    """
+    Room events cross between workers sharing a Redis channel layer, each with its own layer
+    instance, with a fakeredis TCP server standing in for Redis.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from fakeredis import TcpFakeServer
+
+        cls.redis_server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=cls.redis_server.serve_forever, daemon=True).start()
+        host, port = cls.redis_server.server_address
+        cls.redis_url = f"redis://{host}:{port}/0"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis_server.shutdown()
+        cls.redis_server.server_close()
+        super().tearDownClass()
+
+    async def assert_room_events_cross(self, backend):
+        layer = {'BACKEND': backend, 'CONFIG': {'hosts': [self.redis_url]}}
+        with self.settings(CHANNEL_LAYERS={'default': layer, 'remote': layer}):
+            alice = await self.open_socket(self.alice)
+            bob = await self.open_socket(self.bob, app=remote_application)
+            for socket in (alice, bob):
+                await self.send(socket, type='subscribe')
+                await self.drain(socket)
+
+            await self.send(alice, type='chat_message', message="hello")
+            await self.send(alice, type='typing', typing=True)
+            frames = await self.drain(bob, wait=1)
+            self.assertEqual([frame['message'] for frame in self.of_type(frames, 'chat_message')], ["hello"])
+            self.assertEqual(len(self.of_type(frames, 'user_typing')), 1)
+            # Unread counts go to the user's own group, which the other worker holds
+            self.assertEqual(len(self.of_type(frames, 'unread_update')), 1)
+            await self.drain(alice)
+
+            # And back from the other worker's socket to this one's
+            await self.send(bob, type='mark_read')
+            await self.send(bob, type='chat_message', message="hi")
+            frames = await self.drain(alice, wait=1)
+            self.assertEqual(len(self.of_type(frames, 'messages_read')), 1)
+            self.assertEqual([frame['message'] for frame in self.of_type(frames, 'chat_message')], ["hi"])
+            self.assertTrue(all(frame['room_id'] == str(self.room.id) for frame in frames if 'room_id' in frame))
+
+            await self.close_socket(alice)
+            await self.close_socket(bob)
+
+    async def test_room_events_cross_pubsub_layers(self):
+        await self.assert_room_events_cross('channels_redis.pubsub.RedisPubSubChannelLayer')
+
+    @skipUnless(find_spec('lupa'), "fakeredis needs lupa to run scripts")
+    async def test_room_events_cross_redis_layers(self):
+        await self.assert_room_events_cross('channels_redis.core.RedisChannelLayer')
+
+    @skipUnless(find_spec('lupa'), "fakeredis needs lupa to run scripts")
+    async def test_presence_count_survives_reconnect_on_another_process(self):
+        from .presence import RedisConnectionCounter
+
+        here, there = (RedisConnectionCounter(self.redis_url, ttl=60) for _ in range(2))
+        await here.incr(self.alice.id)
+        for _ in range(50):
+            # The user's socket moves to the other process, both sides run at once
+            await asyncio.gather(here.decr(self.alice.id), there.incr(self.alice.id))
+            self.assertEqual(await here.get(self.alice.id), 1)
+            here, there = there, here
+        self.assertEqual(await here.decr(self.alice.id), 0)
+        self.assertEqual(await there.get(self.alice.id), 0)
+
+    @skipUnless(find_spec('lupa'), "fakeredis needs lupa to run scripts")
+    async def test_presence_count_outlives_its_expiry_while_connected(self):
+        from .presence import PresenceRegistry, RedisConnectionCounter
+
+        counter = RedisConnectionCounter(self.redis_url, ttl=60)
+        registry = PresenceRegistry(counter, offline_grace=0, flush_interval=60, touch_interval=0)
+        key = counter.key(self.alice.id)
+        for _ in range(2):
+            await registry.connect(self.alice.id)
+        self.addCleanup(registry.flush_task.cancel)
+
+        # Close to expiring, as after a day of open sockets
+        await counter.redis.expire(key, 1)
+        await registry.touch()
+        self.assertGreater(await counter.redis.ttl(key), 1)
+
+        await counter.redis.expire(key, 1)
+        await registry.disconnect(self.alice.id)
+        self.assertGreater(await counter.redis.ttl(key), 1)
+        self.assertEqual(await counter.get(self.alice.id), 1)
+
+
+class AttachmentStoreTests(TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=temp_dir.name))
+
+    def test_reuse_restarts_the_collection_grace_period(self):
+        attachment = Attachment.objects.store(ContentFile(b"content"), 'first.txt')
+        # Unreferenced for longer than the grace period, like a blob whose messages were deleted
+        Attachment.objects.filter(id=attachment.id).update(updated_at=timezone.now() - timedelta(hours=2))
+
+        # An upload of the same content, its message is not stored yet
+        reused = Attachment.objects.store(ContentFile(b"content"), 'second.txt')
+        self.assertEqual(reused.id, attachment.id)
+        call_command('gc_attachments', stdout=StringIO())
+
+        self.assertTrue(Attachment.objects.filter(id=attachment.id).exists())
+        self.assertTrue(reused.file.storage.exists(reused.file.name))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AttachmentServingTests(TestCase):
+
+    def setUp(self):
+        create_room(self)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=temp_dir.name, CHAT_THUMBNAIL_SIZES=[320]))
+        self.enterContext(mock.patch('chat.views.get_thumbnail_worker'))
+
+    def upload(self, name, content):
+        self.client.force_login(self.alice)
+        file = ContentFile(content, name=name)
+        response = self.client.post(reverse('upload_file'), {'room_id': self.room.id, 'file': file})
+        attachment = Message.objects.get(id=response.json()['message_id']).attachment
+        process_attachment(attachment)
+        # Downloaded by the other participant
+        self.client.force_login(self.bob)
+        return self.client.get(attachment.url)
+
+    def test_svg_is_downloaded_not_rendered(self):
+        response = self.upload('x.svg', b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+
+    def test_markup_named_like_an_image_is_downloaded(self):
+        response = self.upload('x.png', b'<html><script>alert(1)</script></html>')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+    def test_decoded_image_is_shown_inline(self):
+        from PIL import Image
+
+        image = BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(image, 'PNG')
+        response = self.upload('photo.png', image.getvalue())
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MessageWriterTests(TestCase):
+
+    def setUp(self):
+        create_room(self)
+
+    def unread_count(self, user):
+        return RoomMembership.objects.get(room=self.room, user=user).unread_count
+
+    def test_batch_counts_messages_as_unread(self):
+        batch = [Message(room=self.room, sender=self.alice, content=f"message {n}") for n in range(3)]
+        MessageWriter(batch_size=10, flush_interval=0.01, max_pending=10).write(batch)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 3)
+        self.assertEqual(self.unread_count(self.bob), 3)
+        self.assertEqual(self.unread_count(self.alice), 0)
+
+    def test_batch_skips_messages_read_before_they_were_written(self):
+        read = [Message(room=self.room, sender=self.alice, content=f"read {n}") for n in range(2)]
+        # The recipient's socket marks the room read while the batch is still queued
+        RoomMembership.objects.mark_read(self.room, self.bob)
+        unread = Message(room=self.room, sender=self.alice, content="unread")
+
+        MessageWriter(batch_size=10, flush_interval=0.01, max_pending=10).write(read + [unread])
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 3)
+        self.assertEqual(self.unread_count(self.bob), 1)
+        self.assertEqual(RoomMembership.objects.find_inconsistent(), [])
+
+
+@skipUnless(connection.vendor == 'sqlite', "the SQLite index is keyed on row numbers")
+class SearchIndexTests(TestCase):
+
+    def setUp(self):
+        create_room(self)
+
+    def test_rebuild_after_rows_are_renumbered(self):
+        Message.objects.create(room=self.room, sender=self.alice, content="needle in the haystack")
+        self.assertEqual(len(search_messages(self.bob, "needle")[0]), 1)
+
+        # What a VACUUM may do to a table without an INTEGER PRIMARY KEY
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE chat_message SET rowid = rowid + 1000')
+        self.assertEqual(search_messages(self.bob, "needle")[0], [])
+
+        call_command('rebuild_search_index', stdout=StringIO())
+        messages = search_messages(self.bob, "needle")[0]
+        self.assertEqual([message.content for message in messages], ["needle in the haystack"])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class QueriesPerFrameTests(TestCase):
+    """
+    Socket handlers run their database work on executor threads, called directly here so the
+    queries are counted on the test's connection.
+    """
+    # Counted inside the test's transaction, so atomic blocks show up as savepoints. Before the
+    # room cache every connect loaded the room and its users, and every message frame looked the
+    # room up again before the insert, with a savepoint of its own around the counter update.
+    BASELINE_CONNECT_QUERIES = 1
+    BASELINE_TEXT_MESSAGE_QUERIES = 7
+    CACHED_CONNECT_QUERIES = 0
+    TEXT_MESSAGE_QUERIES = 4
+
+    def setUp(self):
+        room_participants.clear()
+        create_room(self)
+
+    def room_channel(self, user):
+        room = get_member_room.__wrapped__(user, self.room.id)
+        return RoomChannel(SimpleNamespace(scope={'user': user}), room)
+
+    def test_baseline(self):
+        # The old code paths, so the counts asserted below are compared against a measured baseline
+        for user in (self.alice, self.bob):
+            with self.assertNumQueries(self.BASELINE_CONNECT_QUERIES):
+                room = ChatRoom.objects.select_related('user1', 'user2').get(id=self.room.id)
+                self.assertIn(user, (room.user1, room.user2))
+
+        with self.assertNumQueries(self.BASELINE_TEXT_MESSAGE_QUERIES):
+            room = ChatRoom.objects.get(id=self.room.id)
+            with transaction.atomic():
+                Message.objects.create(room=room, sender=self.alice, content="hello")
+                with transaction.atomic():
+                    RoomMembership.objects.filter(room=room, user=self.bob).update(
+                        unread_count=F('unread_count') + 1
+                    )
+
+        self.assertLess(self.CACHED_CONNECT_QUERIES, self.BASELINE_CONNECT_QUERIES)
+        self.assertLess(self.TEXT_MESSAGE_QUERIES, self.BASELINE_TEXT_MESSAGE_QUERIES)
+
+    def test_connect_hits_room_cache(self):
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(get_member_room.__wrapped__(self.alice, self.room.id))
+        with self.assertNumQueries(self.CACHED_CONNECT_QUERIES):
+            self.assertIsNotNone(get_member_room.__wrapped__(self.bob, self.room.id))
+            self.assertIsNotNone(get_member_room.__wrapped__(self.alice, self.room.id))
+
+    def test_text_message(self):
+        channel = self.room_channel(self.alice)
+        # Insert and unread counter update, inside a savepoint here
+        with self.assertNumQueries(self.TEXT_MESSAGE_QUERIES):
+            message, created = RoomChannel.save_message.__wrapped__(channel, "hello", uuid.uuid4())
+        self.assertTrue(created)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ChunkedUploadTests(TestCase):
+    size = 256 * 1024 * 1024
+    chunk_size = 4 * 1024 * 1024
+
+    def setUp(self):
+        create_room(self)
+        self.client.force_login(self.alice)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.enterContext(self.settings(
+            MEDIA_ROOT=os.path.join(temp_dir.name, 'media'),
+            CHAT_UPLOAD_TEMP_DIR=os.path.join(temp_dir.name, 'uploads'),
+            CHAT_UPLOAD_CHUNK_SIZE=self.chunk_size,
+            CHAT_UPLOAD_MAX_SIZE=self.size,
+            CHAT_UPLOAD_QUOTA=self.size
+        ))
+        self.enterContext(mock.patch('chat.views.get_thumbnail_worker'))
+
+        # Distinct content in every block so the file cannot pass for a shorter one
+        self.source = os.path.join(temp_dir.name, 'source.bin')
+        self.checksum = hashlib.sha256()
+        block = os.urandom(1024 * 1024)
+        with open(self.source, 'wb') as source:
+            for n in range(self.size // len(block)):
+                data = n.to_bytes(8, 'big') + block[8:]
+                source.write(data)
+                self.checksum.update(data)
+
+    def post_chunk(self, upload_id, offset, data, checksum=None):
+        return self.client.post(
+            reverse('upload_chunk', args=[upload_id]), data, content_type='application/octet-stream',
+            headers={
+                'X-Upload-Offset': str(offset),
+                'X-Chunk-Checksum': checksum or hashlib.sha256(data).hexdigest()
+            }
+        )
+
+    def test_chunked_upload(self):
+        response = self.client.post(reverse('upload_init'), {
+            'room_id': self.room.id,
+            'filename': 'large.bin',
+            'size': self.size,
+            'checksum': self.checksum.hexdigest()
+        })
+        self.assertEqual(response.status_code, 200)
+        upload_id = response.json()['upload_id']
+
+        with open(self.source, 'rb') as source:
+            first = source.read(self.chunk_size)
+            self.assertEqual(self.post_chunk(upload_id, 0, first).json()['offset'], self.chunk_size)
+
+            # A client that lost track of its offset is told where to resume
+            response = self.post_chunk(upload_id, 0, first)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['offset'], self.chunk_size)
+
+            second = source.read(self.chunk_size)
+            response = self.post_chunk(upload_id, self.chunk_size, second, checksum='0' * 64)
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(reverse('upload_detail', args=[upload_id]))
+            self.assertEqual(response.json()['offset'], self.chunk_size)
+
+            # Chunks are streamed to disk, buffering the upload would grow peak memory by its whole size
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            offset, data = self.chunk_size, second
+            while data:
+                response = self.post_chunk(upload_id, offset, data)
+                self.assertEqual(response.status_code, 200)
+                offset += len(data)
+                data = source.read(self.chunk_size)
+            self.assertEqual(offset, self.size)
+
+        self.assertFalse(Message.objects.filter(room=self.room).exists())
+        response = self.client.post(reverse('upload_complete', args=[upload_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - peak_rss, self.size // 2)
+
+        message = Message.objects.select_related('attachment').get(id=response.json()['message_id'])
+        self.assertEqual(message.attachment.sha256, self.checksum.hexdigest())
+        self.assertEqual(message.attachment.file.size, self.size)
+        self.assertFalse(UploadSession.objects.filter(id=upload_id).exists())
+        self.assertFalse(os.path.exists(part_path(SimpleNamespace(id=upload_id))))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UploadCompletionTests(TestCase):
+
+    def setUp(self):
+        create_room(self)
+        self.client.force_login(self.alice)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.enterContext(self.settings(
+            MEDIA_ROOT=os.path.join(temp_dir.name, 'media'),
+            CHAT_UPLOAD_TEMP_DIR=os.path.join(temp_dir.name, 'uploads'),
+            CHAT_UPLOAD_MAX_SIZE=1024,
+            CHAT_UPLOAD_QUOTA=2048
+        ))
+        self.enterContext(mock.patch('chat.views.get_thumbnail_worker'))
+
+    def upload(self, data):
+        response = self.client.post(reverse('upload_init'), {
+            'room_id': self.room.id, 'filename': 'file.bin', 'size': len(data)
+        })
+        upload_id = response.json()['upload_id']
+        response = self.client.post(
+            reverse('upload_chunk', args=[upload_id]), data, content_type='application/octet-stream',
+            headers={'X-Upload-Offset': '0'}
+        )
+        self.assertEqual(response.status_code, 200)
+        return upload_id
+
+    def test_concurrent_complete_creates_one_message(self):
+        upload_id = self.upload(b"content")
+        url = reverse('upload_complete', args=[upload_id])
+        concurrent = []
+
+        def checksum_and_complete_again(path):
+            # A second complete arrives while the first one is storing the file
+            concurrent.append(self.client.post(url))
+            return file_checksum(path)
+
+        with mock.patch('chat.views.file_checksum', side_effect=checksum_and_complete_again):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(concurrent[0].status_code, 409)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+        self.assertEqual(Attachment.objects.get().ref_count, 1)
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+    def test_failed_complete_can_be_retried(self):
+        upload_id = self.upload(b"content")
+        url = reverse('upload_complete', args=[upload_id])
+        with mock.patch('chat.views.file_checksum', side_effect=OSError), self.assertLogs('django.request', 'ERROR'):
+            with self.assertRaises(OSError):
+                self.client.post(url)
+        self.assertEqual(self.client.post(url).status_code, 200)
+
+    def test_direct_upload_checks_room_size_and_quota(self):
+        url = reverse('upload_file')
+        outsider = User.objects.create_user('Carol', 'C', 'carol@example.com', 'password', username='carol')
+        self.client.force_login(outsider)
+        response = self.client.post(url, {'room_id': self.room.id, 'file': ContentFile(b"x", name='x.txt')})
+        self.assertEqual(response.status_code, 404)
+
+        self.client.force_login(self.alice)
+        response = self.client.post(url, {'room_id': self.room.id, 'file': ContentFile(b"x" * 1025, name='x.txt')})
+        self.assertEqual(response.status_code, 413)
+
+        # Uploads in progress count against the quota
+        self.upload(b"y" * 1024)
+        self.upload(b"z" * 512)
+        response = self.client.post(url, {'room_id': self.room.id, 'file': ContentFile(b"x" * 1000, name='x.txt')})
+        self.assertEqual(response.status_code, 413)
+        response = self.client.post(url, {'room_id': self.room.id, 'file': ContentFile(b"x" * 500, name='x.txt')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .codecs import encode_room_event
+from .metrics import layer_send_seconds
+from .models import Attachment
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker waits for the server's event loop to hand attachment_ready to the layer
+ANNOUNCE_TIMEOUT = 10
+
+
+def thumbnail_path(attachment, size, extension):
+    return f"thumbnails/{attachment.sha256[:2]}/{attachment.sha256[2:4]}/{attachment.sha256}_{size}{extension}"
+
+
+def process_attachment(attachment):
+    """
+    Record the attachment's mime type and, for images, its dimensions and one thumbnail per
+    CHAT_THUMBNAIL_SIZES entry. Files Pillow cannot read are only given a mime type.
+    """
+    attachment.mime_type = mimetypes.guess_type(attachment.name)[0] or 'application/octet-stream'
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        Image = None
+
+    if Image is not None:
+        try:
+            with attachment.file.open('rb'), Image.open(attachment.file) as image:
+                attachment.mime_type = Image.MIME.get(image.format, attachment.mime_type)
+                image = ImageOps.exif_transpose(image)
+                attachment.width, attachment.height = image.size
+                attachment.thumbnails = save_thumbnails(attachment, image)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # Not an image, or one Pillow refuses to decode
+            logger.info("thumbnail skipped sha256=%s error=%r", attachment.sha256, e)
+
+    attachment.processed_at = timezone.now()
+    attachment.save(update_fields=['mime_type', 'width', 'height', 'thumbnails', 'processed_at', 'updated_at'])
+
+
+def save_thumbnails(attachment, image):
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    image_format, extension = ('PNG', '.png') if has_alpha else ('JPEG', '.jpg')
+
+    thumbnails = {}
+    for size in sorted(settings.CHAT_THUMBNAIL_SIZES):
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        buffer = BytesIO()
+        thumbnail.save(buffer, image_format, quality=85, optimize=True)
+        name = thumbnail_path(attachment, size, extension)
+        attachment.file.storage.delete(name)
+        thumbnails[str(size)] = attachment.file.storage.save(name, ContentFile(buffer.getvalue()))
+        if max(image.size) <= size:
+            # Larger sizes would only repeat the original resolution
+            break
+    return thumbnails
+
+
+class ThumbnailWorker:
+    """
+    Runs process_attachment off the request path on a small thread pool. At most `max_pending`
+    jobs are queued, further attachments are skipped and left for process_attachments.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, attachment_id, room_id, message_id):
+        if not self.slots.acquire(blocking=False):
+            logger.warning("thumbnail queue full attachment=%s", attachment_id)
+            return False
+        # The channel layer's queues and connections belong to the server's event loop, the
+        # worker hands its announcement back to that loop rather than starting its own
+        loop = async_to_sync(current_loop)()
+        future = self.executor.submit(self.run, attachment_id, room_id, message_id, loop)
+        future.add_done_callback(lambda _: self.slots.release())
+        return True
+
+    def run(self, attachment_id, room_id, message_id, loop):
+        close_old_connections()
+        try:
+            attachment = Attachment.objects.filter(id=attachment_id).first()
+            if attachment is None:
+                return
+            if attachment.processed_at is None:
+                process_attachment(attachment)
+            if attachment.preview:
+                announce_preview(attachment, room_id, message_id, loop)
+        except Exception:
+            logger.exception("thumbnail worker failed attachment=%s", attachment_id)
+        finally:
+            close_old_connections()
+
+
+async def current_loop():
+    return asyncio.get_running_loop()
+
+
+def announce_preview(attachment, room_id, message_id, loop):
+    # Clients that rendered the plain file link swap in the thumbnail
+    event = encode_room_event(room_id, {
+        'type': 'attachment_ready',
+        'message_id': str(message_id),
+        'file_url': attachment.url,
+        'preview': attachment.preview
+    })
+    with layer_send_seconds.time('attachment_ready'):
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(
+                get_channel_layer().group_send(f"chat_{room_id}", event), loop
+            ).result(timeout=ANNOUNCE_TIMEOUT)
+        else:
+            # Submitted outside a server loop (WSGI, a management command), nothing shares it
+            async_to_sync(get_channel_layer().group_send)(f"chat_{room_id}", event)
+
+
+_worker = None
+
+
+def get_thumbnail_worker():
+    global _worker
+    if _worker is None:
+        _worker = ThumbnailWorker(settings.CHAT_THUMBNAIL_WORKERS, settings.CHAT_THUMBNAIL_MAX_PENDING)
+    return _worker
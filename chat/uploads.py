@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class PartFile(File):
+    """
+    A completed part file. FileSystemStorage moves files that expose a temporary path
+    instead of copying them, so completing an upload does not rewrite the data.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def part_path(session):
+    return os.path.join(settings.CHAT_UPLOAD_TEMP_DIR, f"{session.id}.part")
+
+
+def receive_chunk(stream, length, checksum=None):
+    """
+    Stream `length` bytes from `stream` into a temporary file and return it, rewound. Chunks
+    are received before their upload session is locked, so a slow client holds no lock.
+    """
+    os.makedirs(settings.CHAT_UPLOAD_TEMP_DIR, exist_ok=True)
+    chunk = tempfile.TemporaryFile(dir=settings.CHAT_UPLOAD_TEMP_DIR)
+    digest = hashlib.sha256()
+    written = 0
+
+    try:
+        while written < length:
+            block = stream.read(min(READ_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            chunk.write(block)
+            digest.update(block)
+            written += len(block)
+
+        if written != length:
+            raise ChecksumMismatch(f"Expected {length} bytes, received {written}")
+        if checksum and digest.hexdigest() != checksum.lower():
+            raise ChecksumMismatch("Chunk checksum does not match")
+    except Exception:
+        chunk.close()
+        raise
+    chunk.seek(0)
+    return chunk
+
+
+def append_chunk(session, chunk):
+    """
+    Write a received chunk to the session's part file at `session.received`, cutting off
+    whatever an earlier failed append left behind.
+    """
+    path = part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as part:
+        part.truncate(session.received)
+        shutil.copyfileobj(chunk, part, READ_BLOCK_SIZE)
+
+
+def content_checksum(file):
+    """
+    Return the SHA-256 and size of a Django File without loading it into memory.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for block in file.chunks(READ_BLOCK_SIZE):
+        digest.update(block)
+        size += len(block)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for block in iter(lambda: part.read(READ_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discard_part(session):
+    try:
+        os.remove(part_path(session))
+    except FileNotFoundError:
+        pass
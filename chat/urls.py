@@ -4,4 +4,14 @@ from . import views
 urlpatterns = [
     path('chat/<uuid:user_id>/', views.chat_room, name='chat_room'),
     path('chat/upload/', views.upload_file, name='upload_file'),
+    path('chat/upload/init/', views.upload_init, name='upload_init'),
+    path('chat/upload/<uuid:upload_id>/', views.upload_detail, name='upload_detail'),
+    path('chat/upload/<uuid:upload_id>/chunk/', views.upload_chunk, name='upload_chunk'),
+    path('chat/upload/<uuid:upload_id>/complete/', views.upload_complete, name='upload_complete'),
+    path('chat/search/', views.search, name='search'),
+    path('chat/stats/', views.socket_stats, name='socket_stats'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('chat/room/<uuid:room_id>/history/', views.message_history, name='message_history'),
+    path('chat/attachment/<uuid:attachment_id>/', views.attachment_file, name='attachment_file'),
+    path('chat/attachment/<uuid:attachment_id>/thumbnail/<int:size>/', views.attachment_file, name='attachment_thumbnail'),
 ]
@@ -1,49 +1,364 @@
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 
-from .models import ChatRoom, Message
+from .models import ArchiveSegment, Attachment, ChatRoom, Message, RoomMembership, UploadSession
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q, Sum
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 from accounts.models import User
 
 
 User = get_user_model()
 
 
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from .executors import executor_stats
+from .history import get_history_page, serialize_message
+from .metrics import render_metrics, upload_bytes, upload_seconds
+from .outbound import outbound_stats
+from .search import search_messages
+from .serving import serve_file
+from .sync import encode_sync_cursor, get_sequencer
+from .thumbnails import get_thumbnail_worker
+from .uploads import (
+    ChecksumMismatch, PartFile, append_chunk, discard_part, file_checksum, part_path, receive_chunk
+)
 
 @login_required
 def chat_room(request, user_id):
     # ... existing code ...
-    other_user = get_object_or_404(User, id=user_id)
+    other_user = get_object_or_404(User.objects.only('id', 'username', 'is_online', 'last_seen'), id=user_id)
     user1, user2 = sorted([request.user, other_user], key=lambda u: str(u.id))
     room, created = ChatRoom.objects.get_or_create(user1=user1, user2=user2)
-    Message.objects.filter(room=room, sender=other_user, is_read=False).update(is_read=True)
-    chat_messages = Message.objects.filter(room=room)
+    if created:
+        RoomMembership.objects.ensure_for_room(room)
+    RoomMembership.objects.mark_read(room, request.user)
+    # Taken before the page is read, the socket replays anything that happens in between
+    sync_cursor = encode_sync_cursor(async_to_sync(get_sequencer().current)(str(room.id)), timezone.now())
+    # Only the newest page is rendered, older messages are loaded on scroll
+    chat_messages, next_cursor = get_history_page(room)
 
     return render(request, "chat/chat_room.html", {
         "room": room,
         "chat_messages": chat_messages,
+        "next_cursor": next_cursor,
+        "sync_cursor": sync_cursor,
         "other_user": other_user
     })
 
+
+@login_required
+def message_history(request, room_id):
+    room = get_object_or_404(ChatRoom, id=room_id)
+    if request.user.id not in (room.user1_id, room.user2_id):
+        raise Http404
+
+    try:
+        chat_messages, next_cursor = get_history_page(
+            room,
+            before=request.GET.get('before'),
+            limit=request.GET.get('limit')
+        )
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+
+    return JsonResponse({
+        'success': True,
+        'messages': [serialize_message(msg) for msg in chat_messages],
+        'next_cursor': next_cursor
+    })
+
+@login_required
+def search(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+
+    results, has_next = search_messages(request.user, query, page) if query else ([], False)
+    for message in results:
+        room = message.room
+        message.other_user = room.user2 if room.user1_id == request.user.id else room.user1
+
+    context = {
+        'query': query,
+        'results': results,
+        'page': page,
+        'has_next': has_next
+    }
+    return render(request, 'chat/search.html', context)
+
 @login_required
 def upload_file(request):
-    if request.method == 'POST' and request.FILES.get('file'):
-        file = request.FILES['file']
-        room_id = request.POST.get('room_id')
-        room = get_object_or_404(ChatRoom, id=room_id)
-        
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+    # Checked before the body is parsed so an oversized file is never spooled. The body may
+    # exceed the file by the form fields, which Django caps at DATA_UPLOAD_MAX_MEMORY_SIZE.
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > settings.CHAT_UPLOAD_MAX_SIZE + (settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0):
+        return JsonResponse({'success': False, 'error': 'File is too large'}, status=413)
+
+    file = request.FILES.get('file')
+    if file is None:
+        return JsonResponse({'success': False, 'error': 'Invalid request'})
+    try:
+        room = get_upload_room(request)
+    except ValidationError:
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=400)
+    error = check_upload_size(request.user, file.size)
+    if error:
+        return error
+
+    # Files over FILE_UPLOAD_MAX_MEMORY_SIZE arrive in a temporary file, which storage moves
+    # into place, so neither the upload nor the store holds the whole file in memory
+    with upload_seconds.time('direct'):
+        attachment = Attachment.objects.store(file, file.name)
+    upload_bytes.observe(file.size, 'direct')
+
+    with transaction.atomic():
         message = Message.objects.create(
             room=room,
             sender=request.user,
-            file=file,
+            attachment=attachment,
             content=""
         )
-        
-        return JsonResponse({
-            'success': True,
-            'file_url': message.file.url,
-            'message_id': str(message.id)
-        })
-    return JsonResponse({'success': False, 'error': 'Invalid request'})
+        RoomMembership.objects.record_message(room, message)
+
+    return attachment_response(attachment, message)
+
+
+def get_upload_room(request):
+    """
+    Return the room an upload is posted to, raising Http404 unless the user takes part in it.
+    """
+    room = get_object_or_404(ChatRoom, id=request.POST.get('room_id'))
+    if request.user.id not in (room.user1_id, room.user2_id):
+        raise Http404
+    return room
+
+
+def check_upload_size(user, size):
+    """
+    Return an error response when `size` is over the file size limit or the user's quota.
+    """
+    if size > settings.CHAT_UPLOAD_MAX_SIZE:
+        return JsonResponse({'success': False, 'error': 'File is too large'}, status=413)
+    # Bytes the user has reserved for uploads that are still in progress
+    reserved = UploadSession.objects.filter(user=user).aggregate(total=Sum('size'))['total'] or 0
+    if reserved + size > settings.CHAT_UPLOAD_QUOTA:
+        return JsonResponse({'success': False, 'error': 'Upload quota exceeded'}, status=413)
+    return None
+
+
+def upload_state(session):
+    return {
+        'success': True,
+        'upload_id': str(session.id),
+        'offset': session.received,
+        'size': session.size,
+        'chunk_size': settings.CHAT_UPLOAD_CHUNK_SIZE
+    }
+
+
+def offset_mismatch(session):
+    # Tells the client where to resume instead of accepting an out of order chunk
+    return JsonResponse({**upload_state(session), 'success': False, 'error': 'Offset mismatch'}, status=409)
+
+
+@login_required
+@require_POST
+def upload_init(request):
+    try:
+        room = get_upload_room(request)
+    except ValidationError:
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=400)
+
+    filename = request.POST.get('filename', '').strip()
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = -1
+    if not filename or size <= 0:
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=400)
+    error = check_upload_size(request.user, size)
+    if error:
+        return error
+
+    session = UploadSession.objects.create(
+        user=request.user,
+        room=room,
+        filename=filename[:255],
+        size=size,
+        checksum=request.POST.get('checksum') or None
+    )
+    return JsonResponse(upload_state(session))
+
+
+@login_required
+@require_GET
+def upload_detail(request, upload_id):
+    # Clients resume an interrupted upload from the returned offset
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+    return JsonResponse(upload_state(session))
+
+
+@login_required
+@require_POST
+def upload_chunk(request, upload_id):
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+
+    try:
+        offset = int(request.headers.get('X-Upload-Offset', ''))
+        length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid request'}, status=400)
+
+    if offset != session.received:
+        return offset_mismatch(session)
+    if length <= 0 or length > settings.CHAT_UPLOAD_CHUNK_SIZE or offset + length > session.size:
+        return JsonResponse({'success': False, 'error': 'Invalid chunk size'}, status=400)
+
+    try:
+        chunk = receive_chunk(request, length, checksum=request.headers.get('X-Chunk-Checksum'))
+    except ChecksumMismatch as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    with chunk, transaction.atomic():
+        # Concurrent posts of a chunk are serialized here and only the first one is appended
+        session = UploadSession.objects.select_for_update().filter(id=session.id).first()
+        if session is None:
+            raise Http404
+        if offset != session.received:
+            return offset_mismatch(session)
+
+        append_chunk(session, chunk)
+        updated = UploadSession.objects.filter(id=session.id, received=offset).update(
+            received=F('received') + length, updated_at=timezone.now()
+        )
+        if not updated:
+            return offset_mismatch(session)
+    session.received = offset + length
+    return JsonResponse(upload_state(session))
+
+
+@login_required
+@require_POST
+def upload_complete(request, upload_id):
+    with transaction.atomic():
+        # Claimed under the row lock before anything is stored, a concurrent complete of the
+        # same upload gets a 409 instead of creating a second message
+        session = get_object_or_404(
+            UploadSession.objects.select_for_update(of=('self',)).select_related('room'),
+            id=upload_id, user=request.user
+        )
+        if session.completed_at is not None:
+            return JsonResponse({**upload_state(session), 'success': False, 'error': 'Upload is completed'}, status=409)
+        if session.received != session.size:
+            return JsonResponse({**upload_state(session), 'success': False, 'error': 'Upload is incomplete'}, status=409)
+        session.completed_at = timezone.now()
+        UploadSession.objects.filter(id=session.id).update(completed_at=session.completed_at)
+
+    try:
+        path = part_path(session)
+        checksum = file_checksum(path)
+        if session.checksum and checksum != session.checksum.lower():
+            discard_part(session)
+            session.delete()
+            return JsonResponse({'success': False, 'error': 'File checksum does not match'}, status=400)
+
+        with open(path, 'rb') as part:
+            attachment = Attachment.objects.store(PartFile(part), session.filename, sha256=checksum)
+
+        with transaction.atomic():
+            message = Message.objects.create(
+                room=session.room,
+                sender=request.user,
+                attachment=attachment,
+                content=""
+            )
+            RoomMembership.objects.record_message(session.room, message)
+            session.delete()
+    except Exception:
+        # Released so the client can complete the upload again
+        UploadSession.objects.filter(id=session.id).update(completed_at=None)
+        raise
+    # Already moved into storage unless the content was a duplicate
+    discard_part(session)
+    upload_bytes.observe(session.size, 'chunked')
+    upload_seconds.observe((timezone.now() - session.created_at).total_seconds(), 'chunked')
+
+    return attachment_response(attachment, message)
+
+
+def attachment_response(attachment, message):
+    # New content is processed in the background, the room hears about it via attachment_ready
+    if attachment.processed_at is None:
+        get_thumbnail_worker().submit(attachment.id, message.room_id, message.id)
+
+    return JsonResponse({
+        'success': True,
+        'file_url': attachment.url,
+        'preview': attachment.preview,
+        'message_id': str(message.id)
+    })
+
+
+@login_required
+@require_GET
+def attachment_file(request, attachment_id, size=None):
+    # Attachments are shared between rooms, any room the user takes part in grants access
+    attachment = get_object_or_404(Attachment, id=attachment_id)
+    rooms = ChatRoom.objects.filter(Q(user1=request.user) | Q(user2=request.user))
+    if not (
+        attachment.messages.filter(room__in=rooms).exists()
+        or ArchiveSegment.objects.filter(room__in=rooms, attachments__has_key=str(attachment.id)).exists()
+    ):
+        raise Http404
+
+    if size is None:
+        return serve_file(
+            request, attachment.file.storage, attachment.file.name, attachment.sha256,
+            filename=attachment.name,
+            content_type=attachment.mime_type if attachment.inline else None,
+            as_attachment=not attachment.inline
+        )
+
+    name = attachment.thumbnails.get(str(size))
+    if name is None:
+        raise Http404
+    return serve_file(request, attachment.file.storage, name, f"{attachment.sha256}-{size}")
+
+
+@staff_member_required
+@require_GET
+def socket_stats(request):
+    # Counters of this process only, each ASGI worker reports its own sockets and pools
+    return JsonResponse({
+        'outbound': outbound_stats(),
+        'executors': executor_stats()
+    })
+
+
+@require_GET
+def metrics(request):
+    # Prometheus sends the bearer token, staff users can look from a browser
+    token = settings.METRICS_TOKEN
+    authorized = request.user.is_staff or (
+        token and constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}")
+    )
+    if not authorized:
+        raise Http404
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -8,6 +8,7 @@ django_asgi_app = get_asgi_application()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import chat.routing
+from chat.pipeline import lifespan
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -16,5 +17,6 @@ application = ProtocolTypeRouter({
             chat.routing.websocket_urlpatterns
         )
     ),
+    "lifespan": lifespan,
 })
 
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -77,12 +78,152 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'chatapp.wsgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+# Channel layer: "memory" only delivers within one process, "redis" and "redis_pubsub"
+# share groups between every Daphne process connected to the same Redis server
+CHANNEL_LAYER_BACKEND = config('CHANNEL_LAYER_BACKEND', default='memory')
+REDIS_URL = config('REDIS_URL', default='redis://127.0.0.1:6379/0')
+
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+                "capacity": config('CHANNEL_LAYER_CAPACITY', default=100, cast=int),
+                "expiry": config('CHANNEL_LAYER_EXPIRY', default=60, cast=int),
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'redis_pubsub':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown CHANNEL_LAYER_BACKEND: {CHANNEL_LAYER_BACKEND}")
+
+# Presence: connection counts are kept in memory or, for multi-process deployments, in Redis.
+# Users go offline after OFFLINE_GRACE seconds without sockets and the database is
+# updated in batches every FLUSH_INTERVAL seconds.
+PRESENCE_BACKEND = config('PRESENCE_BACKEND', default='memory')
+PRESENCE_OFFLINE_GRACE = config('PRESENCE_OFFLINE_GRACE', default=5, cast=float)
+PRESENCE_FLUSH_INTERVAL = config('PRESENCE_FLUSH_INTERVAL', default=2, cast=float)
+PRESENCE_REDIS_TTL = config('PRESENCE_REDIS_TTL', default=86400, cast=int)
+
+# Typing indicators expire after CHAT_TYPING_TIMEOUT seconds without a typing frame and a
+# new "start" is not broadcast sooner than CHAT_TYPING_MIN_INTERVAL seconds after a "stop"
+CHAT_TYPING_TIMEOUT = config('CHAT_TYPING_TIMEOUT', default=5, cast=float)
+CHAT_TYPING_MIN_INTERVAL = config('CHAT_TYPING_MIN_INTERVAL', default=1, cast=float)
+
+# Every WebSocket writes through a queue of its own. Queued typing, read and presence events are
+# dropped when a newer one replaces them. A socket whose queue holds more than CHAT_SEND_HIGH_WATER
+# events for CHAT_SEND_SLOW_TIMEOUT seconds, or CHAT_SEND_QUEUE_SIZE events at once, is closed with
+# code 4008 and catches up from its cursor when it reconnects.
+CHAT_SEND_QUEUE_SIZE = config('CHAT_SEND_QUEUE_SIZE', default=1000, cast=int)
+CHAT_SEND_HIGH_WATER = config('CHAT_SEND_HIGH_WATER', default=200, cast=int)
+CHAT_SEND_SLOW_TIMEOUT = config('CHAT_SEND_SLOW_TIMEOUT', default=10, cast=float)
+
+# Per-process LRU of room participants used by WebSocket connects
+CHAT_ROOM_CACHE_SIZE = config('CHAT_ROOM_CACHE_SIZE', default=10000, cast=int)
+CHAT_ROOM_CACHE_TTL = config('CHAT_ROOM_CACHE_TTL', default=300, cast=float)
+
+# Messages already stored per (sender, client id), so a retried send is acknowledged without
+# being stored again. Retries older than the TTL or seen by another process fall back to the
+# database's unique constraint.
+CHAT_SENT_CACHE_SIZE = config('CHAT_SENT_CACHE_SIZE', default=50000, cast=int)
+CHAT_SENT_CACHE_TTL = config('CHAT_SENT_CACHE_TTL', default=300, cast=float)
+
+# Write-behind message persistence: messages are broadcast first and inserted in batches of
+# up to CHAT_WRITE_BATCH_SIZE every CHAT_WRITE_FLUSH_INTERVAL seconds. Senders wait once
+# CHAT_WRITE_MAX_PENDING messages are queued.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BATCH_SIZE = config('CHAT_WRITE_BATCH_SIZE', default=100, cast=int)
+CHAT_WRITE_FLUSH_INTERVAL = config('CHAT_WRITE_FLUSH_INTERVAL', default=0.05, cast=float)
+CHAT_WRITE_MAX_PENDING = config('CHAT_WRITE_MAX_PENDING', default=5000, cast=int)
+
+# Thread pools for database calls made by WebSocket consumers: "critical" serves message saves
+# and membership checks, "bulk" read-marking and presence flushes, so a slow bulk call cannot
+# hold up messages. Calls beyond `queue` pending fail fast, callers give up after `timeout` seconds.
+CHAT_DB_EXECUTORS = {
+    'critical': {
+        'workers': config('CHAT_DB_CRITICAL_WORKERS', default=4, cast=int),
+        'queue': config('CHAT_DB_CRITICAL_QUEUE', default=500, cast=int),
+        'timeout': config('CHAT_DB_CRITICAL_TIMEOUT', default=5, cast=float),
+    },
+    'bulk': {
+        'workers': config('CHAT_DB_BULK_WORKERS', default=2, cast=int),
+        'queue': config('CHAT_DB_BULK_QUEUE', default=100, cast=int),
+        'timeout': config('CHAT_DB_BULK_TIMEOUT', default=30, cast=float),
     },
 }
 
+# Resumable uploads: part files are kept in CHAT_UPLOAD_TEMP_DIR until completed, each user may
+# have at most CHAT_UPLOAD_QUOTA bytes of uploads in progress
+CHAT_UPLOAD_TEMP_DIR = config('CHAT_UPLOAD_TEMP_DIR', default=os.path.join(BASE_DIR, 'uploads_tmp'))
+CHAT_UPLOAD_CHUNK_SIZE = config('CHAT_UPLOAD_CHUNK_SIZE', default=4 * 1024 * 1024, cast=int)
+CHAT_UPLOAD_MAX_SIZE = config('CHAT_UPLOAD_MAX_SIZE', default=1024 * 1024 * 1024, cast=int)
+CHAT_UPLOAD_QUOTA = config('CHAT_UPLOAD_QUOTA', default=2 * 1024 * 1024 * 1024, cast=int)
+
+# Image attachments get thumbnails (longest side in pixels) from a pool of
+# CHAT_THUMBNAIL_WORKERS threads, uploads beyond CHAT_THUMBNAIL_MAX_PENDING queued jobs are
+# left for the process_attachments command
+CHAT_THUMBNAIL_SIZES = config('CHAT_THUMBNAIL_SIZES', default='320,960', cast=Csv(int))
+CHAT_THUMBNAIL_WORKERS = config('CHAT_THUMBNAIL_WORKERS', default=2, cast=int)
+CHAT_THUMBNAIL_MAX_PENDING = config('CHAT_THUMBNAIL_MAX_PENDING', default=100, cast=int)
+
+# Internal nginx location that maps onto MEDIA_ROOT, when set attachment downloads are handed to
+# the proxy with X-Accel-Redirect after the participant check
+CHAT_MEDIA_ACCEL_REDIRECT = config('CHAT_MEDIA_ACCEL_REDIRECT', default='')
+
+# JSON codec for WebSocket frames: json, ujson, orjson or auto (fastest installed)
+CHAT_JSON_CODEC = config('CHAT_JSON_CODEC', default='auto')
+
+# Number of messages rendered when a chat is opened and returned per history request
+CHAT_HISTORY_PAGE_SIZE = config('CHAT_HISTORY_PAGE_SIZE', default=50, cast=int)
+
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS that both participants have read are moved by the
+# archive_messages command into gzip segment files of up to CHAT_ARCHIVE_SEGMENT_SIZE messages
+# under CHAT_ARCHIVE_ROOT, outside MEDIA_ROOT so they are never served directly
+CHAT_ARCHIVE_AFTER_DAYS = config('CHAT_ARCHIVE_AFTER_DAYS', default=90, cast=int)
+CHAT_ARCHIVE_SEGMENT_SIZE = config('CHAT_ARCHIVE_SEGMENT_SIZE', default=5000, cast=int)
+CHAT_ARCHIVE_ROOT = config('CHAT_ARCHIVE_ROOT', default=os.path.join(BASE_DIR, 'archive'))
+# Decoded segments kept in memory for paging back through archived history
+CHAT_ARCHIVE_CACHE_SIZE = config('CHAT_ARCHIVE_CACHE_SIZE', default=16, cast=int)
+CHAT_ARCHIVE_CACHE_TTL = config('CHAT_ARCHIVE_CACHE_TTL', default=300, cast=int)
+
+# Reconnect catch-up: room events carry a per-room sequence number kept in memory or, for
+# multi-process deployments, in Redis. The last CHAT_SYNC_BUFFER_SIZE events of up to
+# CHAT_SYNC_BUFFER_ROOMS rooms are replayed from memory, older gaps are rebuilt from the database
+# when they are younger than CHAT_SYNC_RETENTION_DAYS and hold at most CHAT_SYNC_MAX_MESSAGES
+# messages, otherwise the client reloads. Database catch-up starts CHAT_SYNC_MARGIN seconds before
+# the cursor to cover messages stamped before they were broadcast.
+CHAT_SYNC_BACKEND = config('CHAT_SYNC_BACKEND', default='memory')
+CHAT_SYNC_BUFFER_SIZE = config('CHAT_SYNC_BUFFER_SIZE', default=200, cast=int)
+CHAT_SYNC_BUFFER_ROOMS = config('CHAT_SYNC_BUFFER_ROOMS', default=1000, cast=int)
+CHAT_SYNC_BUFFER_TTL = config('CHAT_SYNC_BUFFER_TTL', default=3600, cast=float)
+CHAT_SYNC_RETENTION_DAYS = config('CHAT_SYNC_RETENTION_DAYS', default=7, cast=int)
+CHAT_SYNC_MAX_MESSAGES = config('CHAT_SYNC_MAX_MESSAGES', default=200, cast=int)
+CHAT_SYNC_MARGIN = config('CHAT_SYNC_MARGIN', default=10, cast=float)
+
+# Rooms one multiplexed socket (ws/chat/) may subscribe to at the same time
+CHAT_MAX_SUBSCRIPTIONS = config('CHAT_MAX_SUBSCRIPTIONS', default=50, cast=int)
+
+# Results per page of message search
+CHAT_SEARCH_PAGE_SIZE = config('CHAT_SEARCH_PAGE_SIZE', default=20, cast=int)
+
+# Number of contacts shown per page of the user list
+USER_LIST_PAGE_SIZE = config('USER_LIST_PAGE_SIZE', default=30, cast=int)
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
     'allauth.account.auth_backends.AuthenticationBackend',
@@ -112,12 +253,60 @@ AUTH_USER_MODEL = 'accounts.User'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE picks the profile: "sqlite" for a single node, "postgresql" when several Daphne
+# processes share the database
+DB_ENGINE = config('DB_ENGINE', default='sqlite')
+
+if DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': config('SQLITE_PATH', default=BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Writers take the lock when their transaction starts instead of failing to upgrade it later
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': config('SQLITE_BUSY_TIMEOUT', default=20, cast=int),
+            },
+        }
     }
-}
+    if config('SQLITE_WAL', default=True, cast=bool):
+        # WAL lets readers run while a write is in progress, NORMAL sync is durable in WAL mode
+        # except for the last transactions before a power loss
+        DATABASES['default']['OPTIONS']['init_command'] = (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            'PRAGMA temp_store=MEMORY;'
+            'PRAGMA cache_size=-32000;'
+            'PRAGMA mmap_size=134217728'
+        )
+elif DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME', default='chatapp'),
+            'USER': config('DB_USER', default='chatapp'),
+            'PASSWORD': config('DB_PASSWORD', default=''),
+            'HOST': config('DB_HOST', default='127.0.0.1'),
+            'PORT': config('DB_PORT', default='5432'),
+            # Keep connections open between requests and consumer calls, checking them before reuse
+            'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if config('DB_POOL', default=False, cast=bool):
+        # One connection per thread that can run sync code at once: asgiref sizes its
+        # executor from ASGI_THREADS, plus the consumer database pools and thumbnail workers
+        default_pool_size = config('ASGI_THREADS', default=min(32, (os.cpu_count() or 1) + 4), cast=int)
+        default_pool_size += sum(options['workers'] for options in CHAT_DB_EXECUTORS.values())
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+            'max_size': config('DB_POOL_MAX_SIZE', default=default_pool_size + CHAT_THUMBNAIL_WORKERS, cast=int),
+            'timeout': config('DB_POOL_TIMEOUT', default=10, cast=int),
+        }
+else:
+    raise ImproperlyConfigured(f"Unknown DB_ENGINE {DB_ENGINE!r}, use sqlite or postgresql")
 
 
 # Password validation
@@ -165,6 +354,43 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 # For production (use Whitenoise to serve the static files)
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Logs are written to stderr from a background thread as key=value lines. CHAT_LOG_LEVEL=DEBUG
+# adds a line for every WebSocket connect, room join and disconnect.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            'format': 'time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'background': {
+            'class': 'chat.log.BackgroundStreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'root': {
+        'handlers': ['background'],
+        'level': config('LOG_LEVEL', default='WARNING'),
+    },
+    'loggers': {
+        'chat': {
+            'level': config('CHAT_LOG_LEVEL', default='INFO'),
+        },
+        # Replaces Django's own console handler, which would print request errors a second time
+        'django': {
+            'handlers': ['background'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Prometheus scrapes /metrics/ with "Authorization: Bearer <METRICS_TOKEN>", staff users can open it
+# in a browser. Every ASGI process reports its own metrics, scrape each of them.
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 